@@ -0,0 +1,101 @@
+#!/usr/local/bin/python3
+#+
+# Copyright 2015 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+#
+# Inserts documents into a scratch serial-keyed collection from several
+# threads at once (the way the dispatcher logs tasks and subtasks) and
+# checks that every insert got a distinct key. Needs a running datastore.
+#
+
+import sys
+import time
+import argparse
+import threading
+import datastore
+
+
+COLLECTION = 'benchmark.serial'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', metavar='CONFIG', default=datastore.DEFAULT_CONFIGFILE, help='Middleware config file')
+    parser.add_argument('-t', metavar='THREADS', type=int, default=16, help='Number of inserting threads')
+    parser.add_argument('-n', metavar='COUNT', type=int, default=1000, help='Number of inserts per thread')
+    parser.add_argument('-b', metavar='BATCH', type=int, default=0, help='Use insert_many() with given batch size')
+    args = parser.parse_args()
+
+    try:
+        ds = datastore.get_datastore(args.c)
+    except datastore.DatastoreException as err:
+        print("Cannot initialize datastore: {0}".format(str(err)), file=sys.stderr)
+        sys.exit(1)
+
+    ds.collection_delete(COLLECTION)
+    ds.collection_create(COLLECTION, 'serial')
+    keys = [[] for _ in range(args.t)]
+    errors = []
+
+    def worker(idx):
+        try:
+            if args.b:
+                for i in range(0, args.n, args.b):
+                    count = min(args.b, args.n - i)
+                    keys[idx].extend(ds.insert_many(COLLECTION, [{'thread': idx, 'seq': i + j} for j in range(count)]))
+            else:
+                for i in range(args.n):
+                    keys[idx].append(ds.insert(COLLECTION, {'thread': idx, 'seq': i}))
+        except datastore.DatastoreException as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.t)]
+    start = time.monotonic()
+    for t in threads:
+        t.start()
+
+    for t in threads:
+        t.join()
+
+    elapsed = time.monotonic() - start
+    allocated = [k for i in keys for k in i]
+    total = args.t * args.n
+
+    print('{0} threads x {1} inserts: {2:.2f}s, {3:.0f} inserts/s'.format(args.t, args.n, elapsed, len(allocated) / elapsed))
+    print('Errors: {0}'.format(len(errors)))
+    print('Distinct keys: {0}/{1}'.format(len(set(allocated)), total))
+    print('Documents stored: {0}'.format(ds.query(COLLECTION, count=True)))
+    if allocated:
+        print('Key range: {0}..{1}'.format(min(allocated), max(allocated)))
+
+    ds.collection_delete(COLLECTION)
+    if errors or len(set(allocated)) != total:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
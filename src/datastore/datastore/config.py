@@ -26,9 +26,18 @@
 #####################################################################
 
 import re
+import copy
+import time
+import logging
+import threading
 from datastore import DatastoreException
 
 
+CHANGES_COLLECTION = 'config.changes'
+WATCH_RETRY_INTERVAL = 1
+logger = logging.getLogger('ConfigStore')
+
+
 class ConfigNode(object):
     def __init__(self, path, root):
         self.path = path
@@ -90,33 +99,126 @@ class ConfigNode(object):
 
 
 class ConfigStore(object):
-    def __init__(self, datastore):
+    """
+    Access to the 'config' collection.
+
+    With cache=True values and children listings are kept in a process-local
+    cache. set() invalidates the key, its subtree and every cached listing
+    above it, and publishes the key in the 'config.changes' capped collection;
+    a watcher thread tails that collection to invalidate keys changed by other
+    processes. Caching is disabled if 'config.changes' doesn't exist or the
+    driver can't tail collections (no listen()/tail()).
+    """
+    def __init__(self, datastore, cache=False):
         self.__datastore = datastore
         if not self.__datastore.collection_exists('config'):
             raise DatastoreException("'config' collection doesn't exist")
 
+        self.lock = threading.RLock()
+        self.cache = {}
+        self.children_cache = {}
+        self.cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+        self.notify = self.__datastore.collection_exists(CHANGES_COLLECTION)
+        self.cache_enabled = cache and self.notify and \
+            hasattr(self.__datastore, 'listen') and hasattr(self.__datastore, 'tail')
+
+        if self.cache_enabled:
+            self.watcher = threading.Thread(target=self.__watch, daemon=True, name='ConfigStore watcher')
+            self.watcher.start()
+
     @staticmethod
     def create(datastore):
         datastore.collection_create('config', 'ltree', 'config')
 
+    def __watch(self):
+        while True:
+            try:
+                # Tailable cursors die if nothing matches the query initially,
+                # so start at the most recent entry
+                last = self.__datastore.query(CHANGES_COLLECTION, sort='-created_at', single=True)
+                if not last:
+                    self.__datastore.insert(CHANGES_COLLECTION, {'key': None})
+                    continue
+
+                cur = self.__datastore.listen(CHANGES_COLLECTION, ('created_at', '>=', last['created_at']))
+                for i in self.__datastore.tail(cur):
+                    if i['key'] is not None:
+                        self.invalidate(i['key'])
+            except Exception as err:
+                logger.warning('Config changes watch interrupted: {0}'.format(str(err)))
+
+            # Changes could have been missed in the meantime
+            self.invalidate()
+            time.sleep(WATCH_RETRY_INTERVAL)
+
+    def __cached(self, cache, key, fetch):
+        if not self.cache_enabled:
+            return fetch()
+
+        with self.lock:
+            try:
+                value = cache[key]
+                self.cache_stats['hits'] += 1
+            except KeyError:
+                self.cache_stats['misses'] += 1
+                value = cache[key] = fetch()
+
+            return copy.deepcopy(value)
+
+    def invalidate(self, key=None):
+        with self.lock:
+            self.cache_stats['invalidations'] += 1
+            if key is None:
+                self.cache.clear()
+                self.children_cache.clear()
+                return
+
+            prefix = key + '.'
+            for k in [k for k in self.cache if k == key or k.startswith(prefix)]:
+                del self.cache[k]
+
+            for k in [k for k in self.children_cache if k[1] is None or prefix.startswith(k[1] + '.')]:
+                del self.children_cache[k]
+
+    def get_cache_stats(self):
+        with self.lock:
+            return dict(
+                self.cache_stats,
+                enabled=self.cache_enabled,
+                size=len(self.cache),
+                children_size=len(self.children_cache)
+            )
+
     def exists(self, key):
+        if self.cache_enabled:
+            return self.get(key, self) is not self
+
         return self.__datastore.exists('config', ('id', '=', key))
 
     def get(self, key, default=None):
-        ret = self.__datastore.get_one('config', ('id', '=', key))
+        ret = self.__cached(self.cache, key, lambda: self.__datastore.get_one('config', ('id', '=', key)))
         return ret['value'] if ret is not None else default
 
     def set(self, key, value):
         self.__datastore.upsert('config', key, value, config=True)
+        self.invalidate(key)
+        if self.notify:
+            self.__datastore.insert(CHANGES_COLLECTION, {'key': key})
 
     def list_children(self, key=None):
-        if key is None:
-            return self.__datastore.query('config', wrap=False)
-        return self.__datastore.query('config', ('id', '~', '^' + key + '\..*'), wrap=False)
+        def fetch():
+            if key is None:
+                return self.__datastore.query('config', wrap=False)
+            return self.__datastore.query('config', ('id', '~', '^' + key + '\..*'), wrap=False)
+
+        return self.__cached(self.children_cache, ('list', key), fetch)
 
     def children_dict(self, root):
+        def fetch():
+            return self.__datastore.query('config', ('id', '~', '^' + re.escape(root) + '\.[a-zA-Z0-9_]+\.'))
+
         result = {}
-        for item in self.__datastore.query('config', ('id', '~', '^' + re.escape(root) + '\.[a-zA-Z0-9_]+\.')):
+        for item in self.__cached(self.children_cache, ('dict', root), fetch):
             matched = item['id'][len(root) + 1:]
             key, _, value = matched.partition('.')
 
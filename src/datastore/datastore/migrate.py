@@ -27,6 +27,7 @@
 
 import os
 import json
+import time
 import glob
 import imp
 import copy
@@ -35,6 +36,7 @@ import jsonpatch
 from datastore import DatastoreException
 
 
+MIGRATION_BATCH_SIZE = 500
 logfile = None
 
 
@@ -42,6 +44,27 @@ class MigrationException(DatastoreException):
     pass
 
 
+class DryRunDatastore(object):
+    """
+    Passes reads through to the wrapped datastore and turns writes into
+    no-ops, so that migrations writing through `ds` can be dry run.
+    """
+    WRITE_METHODS = {
+        'collection_create', 'collection_delete', 'collection_set_pkey_type', 'collection_set_attrs',
+        'collection_record_migration', 'collection_set_migration_checkpoint',
+        'insert', 'insert_many', 'update', 'update_many', 'upsert', 'upsert_many', 'delete', 'delete_many'
+    }
+
+    def __init__(self, ds):
+        self.ds = ds
+
+    def __getattr__(self, item):
+        if item in self.WRITE_METHODS:
+            return lambda *args, **kwargs: None
+
+        return getattr(self.ds, item)
+
+
 def log(s):
     print(s)
     print(s, file=logfile)
@@ -52,8 +75,7 @@ def log_indented(f, s):
         f(' ' * 2 + line)
 
 
-def apply_migrations(ds, collection, directory, force=False):
-    log("Running migrations for collection {0}".format(collection))
+def load_migrations(directory):
     for f in sorted(glob.glob(os.path.join(directory, "*.py"))):
         name, _ = os.path.splitext(os.path.basename(f))
 
@@ -64,62 +86,156 @@ def apply_migrations(ds, collection, directory, force=False):
             log_indented(log, traceback.format_exc())
             raise MigrationException(traceback.format_exc())
 
-        def mig_log(s):
-            log('[{0}, {1}] {2}'.format(collection, name, s))
-
-        migrated = 0
-        total = 0
-
-        log("[{0}] Applying migration {1}".format(collection, name))
-
-        if ds.collection_has_migration(collection, name) and not force:
-            mig_log("Migration already applied")
-            continue
-
-        for i in ds.query(collection, sort='id', dir='asc'):
-            total += 1
+        yield name, mod
+
+
+def apply_migration(ds, collection, name, mod, verbose=False, dry_run=False, batch_size=None):
+    """
+    Applies single migration to the collection, streaming documents in
+    batches sorted by id and writing each batch back with bulk operations.
+    The last id of every written batch is saved as a checkpoint, so that an
+    interrupted migration continues where it stopped. In dry run mode nothing
+    is written back and the migration gets a datastore ignoring writes.
+    """
+    def mig_log(s):
+        log('[{0}, {1}] {2}'.format(collection, name, s))
+
+    result = {
+        'collection': collection,
+        'name': name,
+        'total': 0,
+        'migrated': 0,
+        'changed': 0,
+        'deleted': 0,
+        'time': 0
+    }
+
+    batch_size = batch_size or MIGRATION_BATCH_SIZE
+    if dry_run:
+        ds = DryRunDatastore(ds)
+
+    started_at = time.monotonic()
+    checkpoint = None if dry_run else ds.collection_get_migration_checkpoint(collection)
+    last_id = None
+    if checkpoint and checkpoint['name'] == name:
+        last_id = checkpoint['last_id']
+        mig_log('Resuming after object <id:{0}>'.format(last_id))
+
+    # Ids of objects renamed by this migration, so they are not processed twice
+    renamed = set()
+
+    while True:
+        filter = [('id', '>', last_id)] if last_id is not None else []
+        batch = ds.query(collection, *filter, sort='id', limit=batch_size)
+        if not batch:
+            break
+
+        updates = []
+        deletes = []
+        last_id = batch[-1]['id']
+
+        for i in batch:
+            if i['id'] in renamed:
+                continue
+
+            result['total'] += 1
             try:
                 if not mod.probe(i, ds):
-                    mig_log('Object <id:{0}> fails probe() condition, skipping'.format(i['id']))
+                    if verbose:
+                        mig_log('Object <id:{0}> fails probe() condition, skipping'.format(i['id']))
                     continue
             except:
                 mig_log('probe() failed on object <id:{0}>'.format(i['id']))
                 log_indented(mig_log, traceback.format_exc())
                 raise MigrationException(traceback.format_exc())
 
-            old_obj = copy.deepcopy(i)
+            old_id = i['id']
+            old_obj = copy.deepcopy(i) if verbose or dry_run else None
             try:
                 new_obj = mod.apply(i, ds)
-                diff = jsonpatch.make_patch(old_obj, new_obj)
             except:
-                mig_log('apply() failed on object <id:{0}>:'.format(old_obj['id']))
+                mig_log('apply() failed on object <id:{0}>:'.format(old_id))
                 log_indented(mig_log, traceback.format_exc())
                 raise MigrationException(traceback.format_exc())
 
-            mig_log('Sucessfully migrated object <id:{0}>'.format(i['id']))
-            if diff.patch:
-                mig_log('JSON delta:')
-                log_indented(mig_log, json.dumps(diff.patch, indent=4))
-            else:
-                mig_log('Object unchanged after migration')
+            if verbose:
+                mig_log('Sucessfully migrated object <id:{0}>'.format(old_id))
+                diff = jsonpatch.make_patch(old_obj, new_obj or {})
+                if diff.patch:
+                    mig_log('JSON delta:')
+                    log_indented(mig_log, json.dumps(diff.patch, indent=4, default=str))
+                else:
+                    mig_log('Object unchanged after migration')
+
+            if old_obj is not None and new_obj == old_obj:
+                result['migrated'] += 1
+                continue
 
             if not new_obj:
-                ds.delete(collection, old_obj['id'])
-                mig_log('Object deleted by migration')
+                deletes.append(old_id)
+                result['deleted'] += 1
+                if verbose:
+                    mig_log('Object deleted by migration')
             else:
-                try:
-                    ds.update(collection, old_obj['id'], new_obj)
-                except DatastoreException as err:
-                    mig_log('failed to upsert migrated object <id:{0}>: {1}'.format(new_obj['id'], str(err)))
-                    continue
+                updates.append((old_id, new_obj))
+                result['changed'] += 1
+                if new_obj.get('id', old_id) != old_id:
+                    renamed.add(new_obj['id'])
+
+            result['migrated'] += 1
 
-            migrated += 1
+        if dry_run:
+            continue
+
+        if deletes:
+            ds.delete_many(collection, deletes)
 
-        mig_log("{0} out of {1} objects migrated".format(migrated, total))
+        if updates:
+            try:
+                ds.update_many(collection, updates)
+            except DatastoreException as err:
+                mig_log('failed to bulk update migrated objects, retrying one by one: {0}'.format(str(err)))
+                for pkey, obj in updates:
+                    try:
+                        ds.update(collection, pkey, obj)
+                    except DatastoreException as err:
+                        mig_log('failed to upsert migrated object <id:{0}>: {1}'.format(pkey, str(err)))
+
+        ds.collection_set_migration_checkpoint(collection, {'name': name, 'last_id': last_id})
+
+    result['time'] = time.monotonic() - started_at
+    mig_log("{0} out of {1} objects migrated ({2} changed, {3} deleted) in {4:.3f}s{5}".format(
+        result['migrated'],
+        result['total'],
+        result['changed'],
+        result['deleted'],
+        result['time'],
+        ' (dry run)' if dry_run else ''
+    ))
+
+    if not dry_run:
         ds.collection_record_migration(collection, name)
+        ds.collection_set_migration_checkpoint(collection, None)
 
+    return result
 
-def migrate_collection(ds, dump, directory, force=False):
+
+def apply_migrations(ds, collection, directory, force=False, verbose=False, dry_run=False, batch_size=None):
+    log("Running migrations for collection {0}".format(collection))
+    results = []
+    for name, mod in load_migrations(directory):
+        log("[{0}] Applying migration {1}".format(collection, name))
+
+        if ds.collection_has_migration(collection, name) and not force:
+            log('[{0}, {1}] Migration already applied'.format(collection, name))
+            continue
+
+        results.append(apply_migration(ds, collection, name, mod, verbose, dry_run, batch_size))
+
+    return results
+
+
+def migrate_collection(ds, dump, directory, force=False, verbose=False, dry_run=False, batch_size=None):
     metadata = dump['metadata']
     data = dump['data']
     name = metadata['name']
@@ -127,8 +243,12 @@ def migrate_collection(ds, dump, directory, force=False):
     upsert = metadata['migration'] in ('merge-overwrite', 'replace')
     configstore = metadata['attributes'].get('configstore', False)
 
+    results = []
     if metadata['migration'] != 'replace' and directory and os.path.isdir(directory) and ds.collection_exists(name):
-        apply_migrations(ds, name, directory, force)
+        results = apply_migrations(ds, name, directory, force, verbose, dry_run, batch_size)
+
+    if dry_run:
+        return results
 
     if metadata['migration'] == 'replace':
         ds.collection_delete(name)
@@ -140,23 +260,30 @@ def migrate_collection(ds, dump, directory, force=False):
     ds.collection_set_pkey_type(name, metadata['pkey-type'])
 
     if metadata['migration'] == 'keep':
-        return
+        return results
 
-    for key, row in list(data.items()):
-        pkey = int(key) if integer else key
-        if metadata['migration'] == 'merge-preserve':
-            if not ds.exists(name, ('id', '=', pkey)):
-                try:
-                    ds.insert(name, row, pkey=pkey, config=configstore)
-                except DatastoreException:
-                    pass
+    rows = [(int(key) if integer else key, row) for key, row in data.items()]
+    if metadata['migration'] == 'merge-preserve':
+        existing = set(ds.query(name, ('id', 'in', [pkey for pkey, _ in rows]), select='id'))
+        rows = [(pkey, row) for pkey, row in rows if pkey not in existing]
+        try:
+            ds.insert_many(name, [row for _, row in rows], pkeys=[pkey for pkey, _ in rows], config=configstore)
+        except DatastoreException:
+            # Fall back to inserting one by one, skipping conflicting objects
+            for pkey, row in rows:
+                if not ds.exists(name, ('id', '=', pkey)):
+                    try:
+                        ds.insert(name, row, pkey=pkey, config=configstore)
+                    except DatastoreException:
+                        pass
 
-            continue
+        return results
 
-        ds.update(name, pkey, row, upsert=upsert, config=configstore)
+    ds.update_many(name, rows, upsert=upsert, config=configstore)
+    return results
 
 
-def migrate_db(ds, dump, migpath=None, types=None, force=False):
+def migrate_db(ds, dump, migpath=None, types=None, force=False, verbose=False, dry_run=False, batch_size=None):
     global logfile
 
     # Open logfile
@@ -173,14 +300,13 @@ def migrate_db(ds, dump, migpath=None, types=None, force=False):
         if types and 'type' in attrs.keys() and attrs['type'] not in types:
             continue
 
-        if not ds.collection_exists(name):
+        if not ds.collection_exists(name) and not dry_run:
             ds.collection_create(name, metadata['pkey-type'], metadata['attributes'])
-            for key, row in list(data.items()):
-                pkey = int(key) if integer else key
-                ds.insert(name, row, pkey=pkey)
+            ds.insert_many(name, list(data.values()), pkeys=[int(key) if integer else key for key in data.keys()])
 
             print("Created missing collection {0}".format(name))
 
+    results = []
     for i in dump:
         metadata = i['metadata']
         attrs = metadata['attributes']
@@ -188,7 +314,15 @@ def migrate_db(ds, dump, migpath=None, types=None, force=False):
             continue
 
         directory = os.path.join(migpath, metadata['name']) if migpath else None
-        migrate_collection(ds, i, directory, force)
+        results.extend(migrate_collection(ds, i, directory, force, verbose, dry_run, batch_size))
         print("Migrated collection {0}".format(metadata['name']), file=logfile)
 
+    if results:
+        log('Migration timings{0}:'.format(' (dry run)' if dry_run else ''))
+        for r in sorted(results, key=lambda r: r['time'], reverse=True):
+            log('  {0}/{1}: {2} objects, {3} changed, {4} deleted, {5:.3f}s'.format(
+                r['collection'], r['name'], r['total'], r['changed'], r['deleted'], r['time']
+            ))
+
     logfile.close()
+    return results
@@ -25,12 +25,22 @@
 #
 #####################################################################
 
+import json
+import queue
+import threading
 from freenas.utils import exclude
 
 
+RESTORE_BATCH_SIZE = 1000
+RESTORE_QUEUE_SIZE = 4
+RESTORE_WORKERS = 4
+
+
 def restore_collection(ds, dump):
-    metadata = dump['metadata']
-    data = dump['data']
+    restore_collection_rows(ds, dump['metadata'], [list(dump['data'].items())])
+
+
+def restore_collection_rows(ds, metadata, batches):
     name = metadata['name']
     integer = metadata['pkey-type'] in ('integer', 'serial')
 
@@ -38,32 +48,99 @@ def restore_collection(ds, dump):
     ds.collection_create(name, metadata['pkey-type'], metadata['attributes'])
     configstore = metadata['attributes'].get('configstore', False)
 
-    for key, row in list(data.items()):
-        pkey = int(key) if integer else key
-        ds.insert(name, row, pkey=pkey, config=configstore)
+    for batch in batches:
+        pkeys = [int(key) if integer else key for key, _ in batch]
+        ds.insert_many(name, [row for _, row in batch], pkeys=pkeys, config=configstore)
+
+
+def restore_db(ds, dump, types=None, progress_callback=None, workers=RESTORE_WORKERS):
+    """
+    Restores collections from either a list of {'metadata', 'data'} dicts
+    (the legacy dump format) or (metadata, rows) pairs returned by
+    load_dump_stream(). Up to `workers` collections are restored at once,
+    progress_callback is called from the calling thread.
+    """
+    def collections():
+        for i in dump:
+            if isinstance(i, dict):
+                yield i['metadata'], iter(i['data'].items())
+            else:
+                yield i
+
+    done = queue.Queue()
+    errors = []
+    running = 0
+
+    def worker(metadata, batches):
+        finished = []
 
+        def read():
+            yield from iter(batches.get, None)
+            finished.append(True)
 
-def restore_db(ds, dump, types=None, progress_callback=None):
-    for i in dump:
-        metadata = i['metadata']
+        error = None
+        try:
+            if errors:
+                raise errors[0]
+
+            restore_collection_rows(ds, metadata, read())
+        except BaseException as err:
+            error = err
+            # Drain the queue so that the reader doesn't block on a failed collection
+            if not finished:
+                for _ in read():
+                    pass
+        finally:
+            done.put((metadata['name'], error))
+
+    def wait():
+        nonlocal running
+        name, error = done.get()
+        running -= 1
+        if error:
+            errors.append(error)
+        elif progress_callback:
+            progress_callback(name)
+
+    for metadata, rows in collections():
         attrs = metadata['attributes']
         if types and 'type' in attrs.keys() and attrs['type'] not in types:
+            for _ in rows:
+                pass
+
             continue
 
-        restore_collection(ds, i)
-        if progress_callback:
-            progress_callback(metadata['name'])
+        while running >= workers:
+            wait()
 
+        if errors:
+            break
 
-def dump_collection(ds, name):
-    metadata = {
-        'name': name,
-        'pkey-type': ds.collection_get_pkey_type(name),
-        'attributes': ds.collection_get_attrs(name),
-        'migration': ds.collection_get_migration_policy(name),
-        'migrations': ds.collection_get_migrations(name)
-    }
+        batches = queue.Queue(RESTORE_QUEUE_SIZE)
+        threading.Thread(target=worker, args=(metadata, batches), daemon=True).start()
+        running += 1
+
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= RESTORE_BATCH_SIZE:
+                batches.put(batch)
+                batch = []
+
+        if batch:
+            batches.put(batch)
+
+        batches.put(None)
+
+    while running:
+        wait()
+
+    if errors:
+        raise errors[0]
 
+
+def dump_collection(ds, name):
+    metadata = dump_collection_metadata(ds, name)
     configstore = metadata['attributes'].get('configstore', False)
 
     def collect():
@@ -76,3 +153,101 @@ def dump_collection(ds, name):
         'metadata': metadata,
         'data': collect_configstore() if configstore else collect()
     }
+
+
+def dump_collection_metadata(ds, name):
+    return {
+        'name': name,
+        'pkey-type': ds.collection_get_pkey_type(name),
+        'attributes': ds.collection_get_attrs(name),
+        'migration': ds.collection_get_migration_policy(name),
+        'migrations': ds.collection_get_migrations(name)
+    }
+
+
+def dump_collection_stream(ds, name):
+    """
+    Yields a metadata header followed by one item per document, each of
+    which is serialized as a single line of the streaming dump format.
+    """
+    metadata = dump_collection_metadata(ds, name)
+    configstore = metadata['attributes'].get('configstore', False)
+    yield {'metadata': metadata}
+
+    for x in ds.query_stream(name):
+        key = x.pop('id')
+        yield {'id': key, 'data': x['value'] if configstore else x}
+
+
+def dump_db_stream(ds, f, collections=None, types=None, dumps=json.dumps):
+    for name in collections or ds.collection_list():
+        attrs = ds.collection_get_attrs(name)
+        if types and 'type' in attrs.keys() and attrs['type'] not in types:
+            continue
+
+        for item in dump_collection_stream(ds, name):
+            f.write(dumps(item))
+            f.write('\n')
+
+
+def dump_db(ds, f, collections=None, types=None, dumps=json.dumps):
+    """
+    Writes the legacy dump format (a single JSON array) understood by every
+    loader, one document at a time instead of building it in memory.
+    """
+    f.write('[')
+    first = True
+    for name in collections or ds.collection_list():
+        attrs = ds.collection_get_attrs(name)
+        if types and 'type' in attrs.keys() and attrs['type'] not in types:
+            continue
+
+        items = dump_collection_stream(ds, name)
+        f.write('{0}\n{{"metadata": {1}, "data": {{'.format('' if first else ',', dumps(next(items)['metadata'])))
+        first = False
+
+        for idx, item in enumerate(items):
+            f.write('{0}\n{1}: {2}'.format(',' if idx else '', dumps(str(item['id'])), dumps(item['data'])))
+
+        f.write('}}')
+
+    f.write('\n]\n')
+
+
+def load_dump_stream(f, loads=json.loads):
+    """
+    Reads a dump written either by dump_db_stream() or in the legacy
+    format (a single JSON array) and yields (metadata, rows) pairs, where
+    rows iterates over (pkey, document) tuples. rows has to be consumed
+    before advancing to the next collection.
+    """
+    first = f.read(1)
+    while first and first.isspace():
+        first = f.read(1)
+
+    if first == '[':
+        for i in loads(first + f.read()):
+            yield i['metadata'], iter(i['data'].items())
+
+        return
+
+    lines = (first + line if idx == 0 else line for idx, line in enumerate(f))
+    lines = (line for line in lines if line.strip())
+    pending = [None]
+
+    def rows():
+        for line in lines:
+            item = loads(line)
+            if 'metadata' in item:
+                pending[0] = item['metadata']
+                return
+
+            yield item['id'], item['data']
+
+    for line in lines:
+        pending[0] = loads(line)['metadata']
+        break
+
+    while pending[0]:
+        metadata, pending[0] = pending[0], None
+        yield metadata, rows()
@@ -25,6 +25,7 @@
 #
 #####################################################################
 
+import re
 import time
 import copy
 import uuid
@@ -40,6 +41,9 @@ from datastore import DatastoreException, DuplicateKeyException
 from freenas.utils.query import get, delete
 
 
+DUPLICATE_KEY_ERROR = 11000
+
+
 def auto_retry(fn):
     def wrapped(*args, **kwargs):
         for i in range(0, 15):
@@ -58,11 +62,26 @@ def auto_retry(fn):
     return wrapped
 
 
+def bulk_write_exception(message, err):
+    errors = err.details.get('writeErrors', [])
+    errmsg = errors[0]['errmsg'] if errors else str(err)
+    if errors and all(e.get('code') == DUPLICATE_KEY_ERROR for e in errors):
+        return DuplicateKeyException('{0}: {1}'.format(message, errmsg))
+
+    return DatastoreException('{0}: {1}'.format(message, errmsg))
+
+
 class MongodbDatastore(object):
     def __init__(self):
         self.conn_db = None
         self.db = None
         self.connected = False
+        self.collections = {}
+        self.cache_stats = {
+            'hits': 0,
+            'misses': 0,
+            'invalidations': 0
+        }
         self.operators_table = {
             '>': '$gt',
             '<': '$lt',
@@ -134,13 +153,80 @@ class MongodbDatastore(object):
 
         return {'$and': result} if len(result) > 0 else {}
 
+    def _get_collection(self, collection):
+        item = self.collections.get(collection)
+        if item is not None:
+            self.cache_stats['hits'] += 1
+            return item
+
+        self.cache_stats['misses'] += 1
+        item = self.db['collections'].find_one({"_id": collection})
+        if item is not None:
+            self.collections[collection] = item
+
+        return item
+
     def _get_db(self, collection):
-        c = self.db['collections'].find_one({"_id": collection})
+        c = self._get_collection(collection)
         if not c:
             raise DatastoreException('Collection {0} not found'.format(collection))
 
         return self.db[collection]
 
+    def invalidate_collection_cache(self, name=None):
+        self.cache_stats['invalidations'] += 1
+        if name is None:
+            self.collections.clear()
+            return
+
+        self.collections.pop(name, None)
+
+    def get_cache_stats(self):
+        return dict(self.cache_stats, size=len(self.collections))
+
+    def _prepare_object(self, obj, config=False, copier=copy.copy):
+        if hasattr(obj, '__getstate__'):
+            return obj.__getstate__()
+
+        if type(obj) is not dict or config:
+            return {'value': obj}
+
+        return copier(obj)
+
+    def _next_serial_pkey(self, collection):
+        ret = self._get_db(collection).find_one(
+            {
+                '$or': [
+                    {'_id': {'$type': 16}},  # BSON int32
+                    {'_id': {'$type': 18}}   # BSON int64
+                ]
+            },
+            sort=[('_id', pymongo.DESCENDING)]
+        )
+        return ret['_id'] + 1 if ret else 1
+
+    def _sync_sequence(self, collection):
+        self.db['sequences'].update_one(
+            {'_id': collection},
+            {'$max': {'value': self._next_serial_pkey(collection) - 1}},
+            upsert=True
+        )
+
+    def _allocate_serial_pkeys(self, collection, count=1):
+        # Returns first of `count` consecutive keys reserved atomically in the
+        # per-collection sequence document
+        seq = self.db['sequences'].find_one_and_update(
+            {'_id': collection},
+            {'$inc': {'value': count}},
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+
+        if seq is None:
+            self._sync_sequence(collection)
+            return self._allocate_serial_pkeys(collection, count)
+
+        return seq['value'] - count + 1
+
     def connect(self, dsn, database='freenas'):
         self.conn_db = MongoClient(dsn)
         self.db = self.conn_db[database]
@@ -162,6 +248,7 @@ class MongodbDatastore(object):
                 'pkey-type': pkey_type,
                 'attributes': attributes
             })
+            self.invalidate_collection_cache(name)
 
         db = self._get_db(name).database
 
@@ -184,12 +271,12 @@ class MongodbDatastore(object):
 
     @auto_retry
     def collection_exists(self, name):
-        return self.db['collections'].find_one({"_id": name}) is not None
+        return self._get_collection(name) is not None
 
     @auto_retry
     def collection_get_attrs(self, name):
-        item = self.db['collections'].find_one({"_id": name})
-        return item['attributes']
+        item = self._get_collection(name)
+        return copy.deepcopy(item['attributes'])
 
     @auto_retry
     def collection_set_attrs(self, name):
@@ -198,17 +285,17 @@ class MongodbDatastore(object):
 
     @auto_retry
     def collection_get_migration_policy(self, name):
-        item = self.db['collections'].find_one({"_id": name})
+        item = self._get_collection(name)
         return item.get('migration', 'keep')
 
     @auto_retry
     def collection_get_migrations(self, name):
-        item = self.db['collections'].find_one({"_id": name})
-        return item.get('migrations', [])
+        item = self._get_collection(name)
+        return list(item.get('migrations', []))
 
     @auto_retry
     def collection_has_migration(self, name, migration_name):
-        item = self.db['collections'].find_one({"_id": name})
+        item = self._get_collection(name)
         return migration_name in item.get('migrations', [])
 
     @auto_retry
@@ -217,10 +304,30 @@ class MongodbDatastore(object):
         migs = item.setdefault('migrations', [])
         migs.append(migration_name)
         self.db['collections'].update({'_id': name}, item)
+        self.collections[name] = item
+
+    @auto_retry
+    def collection_get_migration_checkpoint(self, name):
+        item = self._get_collection(name)
+        return copy.deepcopy(item.get('migration-checkpoint'))
+
+    @auto_retry
+    def collection_set_migration_checkpoint(self, name, checkpoint):
+        if checkpoint is None:
+            self.db['collections'].update_one({'_id': name}, {'$unset': {'migration-checkpoint': ''}})
+        else:
+            self.db['collections'].update_one({'_id': name}, {'$set': {'migration-checkpoint': checkpoint}})
+
+        self.invalidate_collection_cache(name)
 
     @auto_retry
     def collection_list(self):
-        return [x['_id'] for x in self.db['collections'].find()]
+        result = []
+        for x in self.db['collections'].find():
+            self.collections[x['_id']] = x
+            result.append(x['_id'])
+
+        return result
 
     @auto_retry
     def collection_delete(self, name):
@@ -229,10 +336,12 @@ class MongodbDatastore(object):
 
         self._get_db(name).drop()
         self.db['collections'].remove({'_id': name})
+        self.db['sequences'].delete_one({'_id': name})
+        self.invalidate_collection_cache(name)
 
     @auto_retry
     def collection_get_pkey_type(self, name):
-        item = self.db['collections'].find_one({"_id": name})
+        item = self._get_collection(name)
         return item['pkey-type']
 
     @auto_retry
@@ -240,17 +349,21 @@ class MongodbDatastore(object):
         item = self.db['collections'].find_one({"_id": name})
         item['pkey-type'] = type
         self.db['collections'].replace_one({'_id': name}, item)
+        self.collections[name] = item
 
     @auto_retry
     def collection_get_next_pkey(self, name, prefix):
-        counter = 0
-        while True:
-            pkey = prefix + str(counter)
-            if not self.exists(name, ('id', '=', pkey)):
-                return pkey
+        taken = set()
+        pattern = '^{0}[0-9]+$'.format(re.escape(prefix))
+        for i in self._get_db(name).find({'_id': {'$regex': pattern}}, ['_id']):
+            taken.add(int(i['_id'][len(prefix):]))
 
+        counter = 0
+        while counter in taken:
             counter += 1
 
+        return prefix + str(counter)
+
     @auto_retry
     def query(self, collection, *args, **kwargs):
         single = kwargs.get('single', False)
@@ -393,12 +506,7 @@ class MongodbDatastore(object):
 
     @auto_retry
     def insert(self, collection, obj, pkey=None, timestamp=True, config=False):
-        if hasattr(obj, '__getstate__'):
-            obj = obj.__getstate__()
-        elif type(obj) is not dict or config:
-            obj = {'value': obj}
-        else:
-            obj = copy.copy(obj)
+        obj = self._prepare_object(obj, config)
 
         pkey_type = self.collection_get_pkey_type(collection)
         autopkey = pkey is None and 'id' not in obj
@@ -413,16 +521,7 @@ class MongodbDatastore(object):
         while True:
             if autopkey:
                 if pkey_type in ('serial', 'integer'):
-                    ret = self._get_db(collection).find_one(
-                        {
-                            '$or': [
-                                {'_id': {'$type': 16}},  # BSON int32
-                                {'_id': {'$type': 18}}   # BSON int64
-                            ]
-                        },
-                        sort=[('_id', pymongo.DESCENDING)]
-                    )
-                    pkey = ret['_id'] + 1 if ret else 1
+                    pkey = self._allocate_serial_pkeys(collection)
                 elif pkey_type == 'uuid':
                     pkey = str(uuid.uuid4())
 
@@ -437,6 +536,10 @@ class MongodbDatastore(object):
                 db.insert_one(obj)
             except pymongo.errors.DuplicateKeyError:
                 if autopkey and retries > 0:
+                    if pkey_type in ('serial', 'integer'):
+                        # Keys were inserted bypassing the sequence, catch up with them
+                        self._sync_sequence(collection)
+
                     retries -= 1
                     continue
 
@@ -444,14 +547,56 @@ class MongodbDatastore(object):
 
             return pkey
 
+    @auto_retry
+    def insert_many(self, collection, objs, pkeys=None, timestamp=True, config=False):
+        objs = [self._prepare_object(o, config) for o in objs]
+        pkeys = list(pkeys) if pkeys is not None else [None] * len(objs)
+        if not objs:
+            return []
+
+        pkey_type = self.collection_get_pkey_type(collection)
+        next_serial = None
+        t = datetime.utcnow()
+
+        for idx, obj in enumerate(objs):
+            pkeys[idx] = obj.pop('id', pkeys[idx])
+
+        explicit_serial = False
+        if pkey_type in ('serial', 'integer'):
+            missing = pkeys.count(None)
+            explicit_serial = missing < len(pkeys)
+            if missing:
+                next_serial = self._allocate_serial_pkeys(collection, missing)
+
+        for idx, obj in enumerate(objs):
+            pkey = pkeys[idx]
+            if pkey is None:
+                if pkey_type in ('serial', 'integer'):
+                    pkey = next_serial
+                    next_serial += 1
+                elif pkey_type == 'uuid':
+                    pkey = str(uuid.uuid4())
+            elif pkey_type == 'uuid':
+                pkey = pkey.lower()
+
+            obj['_id'] = pkeys[idx] = pkey
+            if timestamp:
+                obj['updated_at'] = t
+                obj['created_at'] = t
+
+        try:
+            self._get_db(collection).insert_many(objs)
+        except pymongo.errors.BulkWriteError as err:
+            raise bulk_write_exception('Cannot insert documents', err)
+
+        if explicit_serial:
+            self._sync_sequence(collection)
+
+        return pkeys
+
     @auto_retry
     def update(self, collection, pkey, obj, upsert=False, timestamp=True, config=False):
-        if hasattr(obj, '__getstate__'):
-            obj = obj.__getstate__()
-        elif type(obj) is not dict or config:
-            obj = {'value': obj}
-        else:
-            obj = copy.deepcopy(obj)
+        obj = self._prepare_object(obj, config, copy.deepcopy)
 
         if 'id' in obj and pkey != obj['id']:
             # We gonna remove the document and reinsert it to change the id...
@@ -477,14 +622,60 @@ class MongodbDatastore(object):
         except pymongo.errors.DuplicateKeyError:
             raise DuplicateKeyException('Document with given key already exists')
 
+    @auto_retry
+    def update_many(self, collection, items, upsert=False, timestamp=True, config=False):
+        requests = []
+        items = [(pkey, self._prepare_object(obj, config, copy.deepcopy)) for pkey, obj in items]
+        if not items:
+            return
+
+        db = self._get_db(collection)
+        if timestamp:
+            t = datetime.utcnow()
+            existing = {i['_id'] for i in db.find({'_id': {'$in': [pkey for pkey, _ in items]}}, ['_id'])}
+
+        for pkey, obj in items:
+            if 'id' in obj and pkey != obj['id']:
+                # Changing the id requires reinserting the document, can't be batched
+                self.update(collection, pkey, obj, upsert=upsert, timestamp=timestamp)
+                continue
+
+            obj.pop('id', None)
+            if timestamp:
+                obj['updated_at'] = t
+                if pkey not in existing:
+                    obj['created_at'] = t
+
+            requests.append(pymongo.ReplaceOne({'_id': pkey}, obj, upsert=upsert))
+
+        if not requests:
+            return
+
+        try:
+            db.bulk_write(requests)
+        except pymongo.errors.BulkWriteError as err:
+            raise bulk_write_exception('Cannot update documents', err)
+
     def upsert(self, collection, pkey, obj, config=False):
         return self.update(collection, pkey, obj, upsert=True, config=config)
 
+    def upsert_many(self, collection, items, config=False):
+        return self.update_many(collection, items, upsert=True, config=config)
+
     @auto_retry
     def delete(self, collection, pkey):
         db = self._get_db(collection)
         db.delete_one({'_id': pkey})
 
+    @auto_retry
+    def delete_many(self, collection, pkeys):
+        pkeys = list(pkeys)
+        if not pkeys:
+            return
+
+        db = self._get_db(collection)
+        db.delete_many({'_id': {'$in': pkeys}})
+
     def lock(self):
         self.conn_db.fsync(lock=True)
 
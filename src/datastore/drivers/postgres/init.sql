@@ -11,6 +11,6 @@ GRANT ALL ON DATABASE freenas TO freenas;
 -- Create initial metadata collection
 \c freenas freenas
 CREATE TABLE __collections (
-  id character varying,
-  data json
+  id character varying PRIMARY KEY,
+  data jsonb
 );
\ No newline at end of file
@@ -25,11 +25,65 @@
 #
 #####################################################################
 
-import logging
+import re
+import sys
+import copy
 import json
+import collections
+import uuid
+import logging
+import threading
+import contextlib
 import psycopg2
+import psycopg2.pool
 import psycopg2.extras
-from datastore import DuplicateKeyException
+import psycopg2.extensions
+from datetime import datetime
+from six import string_types
+from datastore import DatastoreException, DuplicateKeyException
+from freenas.utils.query import get, delete
+
+
+POOL_MIN_CONNECTIONS = 1
+POOL_MAX_CONNECTIONS = 16
+PKEY_COLUMN_TYPES = {
+    'uuid': 'uuid DEFAULT uuid_generate_v4()',
+    'integer': 'serial',
+}
+
+
+def json_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+
+    raise TypeError('{0!r} is not JSON serializable'.format(obj))
+
+
+def jsonb(obj):
+    return psycopg2.extras.Json(obj, dumps=lambda o: json.dumps(o, default=json_default))
+
+
+def quote_table(name):
+    return '"{0}"'.format(name.replace('"', '""'))
+
+
+def gevent_wait_callback(conn, timeout=None):
+    from gevent.socket import wait_read, wait_write
+
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            break
+        elif state == psycopg2.extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError('Bad result from poll: {0}'.format(state))
+
 
 class PostgresSelectQuery(object):
     ASC = 'ASC'
@@ -40,223 +94,552 @@ class PostgresSelectQuery(object):
         self.table = table
         self.connect = 'AND'
         self.where_conditions = []
-        self.projection_func = None
-        self.sort_field = None
-        self.sort_dir = PostgresSelectQuery.DESC
+        self.count_only = False
+        self.sort_fields = []
         self.limit_value = None
+        self.offset_value = None
+
+    def __sql(self, fmt, *args):
+        return self.cur.mogrify(fmt, args).decode('utf-8')
 
     def __convert_path(self, path):
-        return '(data->' + '->'.join(["'" + i + "'" for i in path.split('.')]) + ')::text'
+        if path == 'id':
+            return 'id'
+
+        return self.__sql('(data #> %s)', path.split('.'))
+
+    def __nested(self, path, value):
+        for i in reversed(path.split('.')):
+            value = {i: value}
+
+        return value
+
+    def __predicate(self, *args):
+        if len(args) == 2:
+            return self.__joint_predicate(*args)
+
+        if len(args) in (3, 4):
+            return self.__operator_predicate(*args[:3])
+
+        raise DatastoreException('Invalid predicate: {0}'.format(args))
 
-    def __build_where(self):
-        items = []
-        for left, op, right in self.where_conditions:
-            if left == 'id':
-                path = left
-                items.append(self.cur.mogrify("{0} {1} %s".format(path, op), (right,)))
-            else:
-                path = self.__convert_path(left)
-                items.append(self.cur.mogrify("{0} {1} %s".format(path, op), (psycopg2.extras.Json(right),)))
+    def __joint_predicate(self, op, value):
+        items = [self.__predicate(*i) for i in value]
+        if not items:
+            return 'FALSE' if op == 'or' else 'TRUE'
 
-        return self.connect.join(items)
+        if op == 'and':
+            return '(' + ' AND '.join(items) + ')'
 
-    def projection(self, projection):
-        self.projection_func = projection
+        if op == 'or':
+            return '(' + ' OR '.join(items) + ')'
 
-    def where(self, left, op, right):
-        self.where_conditions.append((left, op, right))
+        if op == 'nor':
+            return 'NOT (' + ' OR '.join(items) + ')'
 
-    def sort(self, field, dir):
-        self.sort_field = self.__convert_path(field)
-        self.sort_dir = dir
+        raise DatastoreException('Unsupported operator: {0}'.format(op))
+
+    def __operator_predicate(self, left, op, right):
+        path = self.__convert_path(left)
+        value = right if left == 'id' else jsonb(right)
+
+        if op in ('in', 'nin'):
+            right = right if isinstance(right, (list, tuple)) else [right]
+            if not right:
+                return 'FALSE' if op == 'in' else 'TRUE'
+
+            values = tuple(right) if left == 'id' else tuple(jsonb(i) for i in right)
+            expr = self.__sql('{0} IN %s'.format(path), values)
+            return expr if op == 'in' else 'NOT coalesce({0}, FALSE)'.format(expr)
+
+        if op in ('contains', 'ncontains'):
+            expr = self.__sql('{0} @> %s'.format(path), jsonb([right]))
+            return expr if op == 'contains' else 'NOT coalesce({0}, FALSE)'.format(expr)
+
+        if op == '~':
+            text = 'id::text' if left == 'id' else self.__sql('(data #>> %s)', left.split('.'))
+            return self.__sql('{0} ~ %s'.format(text), right)
+
+        if left != 'id' and right is None:
+            # Like MongoDB, null matches missing fields too
+            expr = "coalesce(jsonb_typeof({0}), 'null') = 'null'".format(path)
+            if op == '=':
+                return expr
+
+            if op == '!=':
+                return 'NOT ' + expr
+
+        if op == '=':
+            if left != 'id' and not isinstance(right, (list, tuple, dict)):
+                # Containment can be answered from the GIN index
+                return self.__sql('data @> %s', jsonb(self.__nested(left, right)))
+
+            return self.__sql('{0} = %s'.format(path), value)
+
+        if op == '!=':
+            return self.__sql('{0} IS DISTINCT FROM %s'.format(path), value)
+
+        if op in ('>', '<', '>=', '<='):
+            return self.__sql('{0} {1} %s'.format(path, op), value)
+
+        raise DatastoreException('Unsupported operator: {0}'.format(op))
+
+    def where(self, *args):
+        self.where_conditions.append(args)
+
+    def count(self):
+        self.count_only = True
+
+    def sort(self, field, dir=ASC):
+        self.sort_fields.append((self.__convert_path(field), dir))
 
     def limit(self, limit):
         self.limit_value = limit
 
+    def offset(self, offset):
+        self.offset_value = offset
+
     def sql(self):
         result = []
 
-        if self.projection_func:
-            result.append('SELECT {0}(id, data) FROM {1}'.format(self.projection_func, self.table))
+        if self.count_only:
+            result.append('SELECT count(*) FROM {0}'.format(quote_table(self.table)))
         else:
-            result.append('SELECT id, data FROM {0}'.format(self.table))
+            result.append('SELECT id, data FROM {0}'.format(quote_table(self.table)))
 
         if self.where_conditions:
-            result.append('WHERE {0}'.format(self.__build_where()))
+            result.append('WHERE {0}'.format(' {0} '.format(self.connect).join(
+                self.__predicate(*i) for i in self.where_conditions
+            )))
 
-        if self.sort_field:
-            result.append('ORDER BY {0} {1}'.format(self.sort_field, self.sort_dir))
+        if self.sort_fields and not self.count_only:
+            result.append('ORDER BY {0}'.format(', '.join('{0} {1}'.format(f, d) for f, d in self.sort_fields)))
 
         if self.limit_value:
-            result.append('LIMIT {0}'.format(self.limit_value))
+            result.append('LIMIT {0}'.format(int(self.limit_value)))
+
+        if self.offset_value:
+            result.append('OFFSET {0}'.format(int(self.offset_value)))
 
         return ' '.join(result)
 
 
+# Change notification (listen()/tail()) isn't implemented, so ConfigStore
+# runs uncached on top of this driver
 class PostgresDatastore(object):
     def __init__(self):
         self.logger = logging.getLogger('PostgresDatastore')
+        self.pool = None
+        self.pool_semaphore = None
+        self.collections = {}
+
+    @contextlib.contextmanager
+    def __connection(self):
+        # ThreadedConnectionPool raises when exhausted, so wait for a free slot instead
+        with self.pool_semaphore:
+            conn = self.pool.getconn()
+            try:
+                yield conn
+                conn.commit()
+            except psycopg2.IntegrityError as e:
+                conn.rollback()
+                raise DuplicateKeyException(e)
+            except:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                self.pool.putconn(conn, close=bool(conn.closed))
+
+    @contextlib.contextmanager
+    def __cursor(self):
+        with self.__connection() as conn:
+            with conn.cursor() as cur:
+                yield cur
+
+    def __prepare_object(self, obj, config=False):
+        if hasattr(obj, '__getstate__'):
+            return obj.__getstate__()
+
+        if type(obj) is not dict or config:
+            return {'value': obj}
+
+        return copy.deepcopy(obj)
+
+    def __get_collection(self, collection):
+        item = self.collections.get(collection)
+        if item is None:
+            with self.__cursor() as cur:
+                cur.execute('SELECT data FROM __collections WHERE id = %s', (collection,))
+                row = cur.fetchone()
+
+            if row is None:
+                raise DatastoreException('Collection {0} not found'.format(collection))
+
+            item = self.collections[collection] = row.data
+
+        return item
+
+    def __set_collection(self, collection, item):
+        with self.__cursor() as cur:
+            cur.execute('UPDATE __collections SET data = %s WHERE id = %s', (jsonb(item), collection))
+
+        self.collections[collection] = item
+
+    def __sync_sequence(self, cur, collection):
+        cur.execute(
+            'SELECT setval(pg_get_serial_sequence(%s, %s), coalesce(max(id), 0) + 1, false) FROM {0}'.format(
+                quote_table(collection)
+            ),
+            (quote_table(collection), 'id')
+        )
+
+    def __row(self, row):
+        data = row.data
+        data['id'] = row.id
+        return data
+
+    def connect(self, dsn, database=None):
+        kwargs = {'cursor_factory': psycopg2.extras.NamedTupleCursor}
+        if database:
+            kwargs['dbname'] = database
+
+        if 'gevent.monkey' in sys.modules:
+            import gevent.monkey
+            if gevent.monkey.is_module_patched('socket'):
+                psycopg2.extensions.set_wait_callback(gevent_wait_callback)
+
+        self.pool = psycopg2.pool.ThreadedConnectionPool(POOL_MIN_CONNECTIONS, POOL_MAX_CONNECTIONS, dsn, **kwargs)
+        self.pool_semaphore = threading.BoundedSemaphore(POOL_MAX_CONNECTIONS)
+
+        with self.__cursor() as cur:
+            cur.execute('CREATE TABLE IF NOT EXISTS __collections (id varchar PRIMARY KEY, data jsonb)')
+
+    def close(self):
+        self.pool.closeall()
+
+    def get_cache_stats(self):
+        return {
+            'size': len(self.collections),
+            'connections_used': len(self.pool._used),
+            'connections_idle': len(self.pool._pool)
+        }
+
+    def collection_create(self, collection, pkey_type='uuid', attributes=None):
+        table = quote_table(collection)
+        with self.__cursor() as cur:
+            cur.execute('CREATE TABLE IF NOT EXISTS {0} (id {1} PRIMARY KEY, data jsonb)'.format(
+                table,
+                PKEY_COLUMN_TYPES.get(pkey_type, pkey_type)
+            ))
+            cur.execute('CREATE INDEX IF NOT EXISTS {0} ON {1} USING GIN (data jsonb_path_ops)'.format(
+                quote_table(collection + '_data_idx'),
+                table
+            ))
+            cur.execute('INSERT INTO __collections (id, data) VALUES (%s, %s) ON CONFLICT (id) DO NOTHING', (
+                collection,
+                jsonb({'pkey-type': pkey_type, 'attributes': attributes or {}})
+            ))
 
-    def __get_column_datatype(self, table):
-        with self.conn.cursor() as cur:
-            cur.execute("SELECT data_type FROM information_schema.columns WHERE table_name = %s", (table))
-            return cur.fetchone()[0]
-
-    def connect(self, dsn):
-        self.conn = psycopg2.connect(dsn, cursor_factory=psycopg2.extras.NamedTupleCursor)
-        psycopg2.extras.register_uuid(self.conn)
-
-    def collection_create(self, collection, pkey_type='uuid', attributes={}):
-        with self.conn.cursor() as cur:
-            cur.execute("CREATE TABLE {0} (id {1} PRIMARY KEY, data json)".format(collection, pkey_type))
-            self.insert('__collections', attributes, pkey=collection)
-
-        self.conn.commit()
+        self.collections.pop(collection, None)
 
     def collection_get_pkey_type(self, collection):
-        with self.conn.cursor() as cur:
-            cur.execute("SELECT data_type, udt_name FROM information_schema.columns " +
-                        "WHERE table_name = %s AND column_name = 'id'", [collection])
-            result = cur.fetchone()
-            return result[0] if result[0] != 'USER-DEFINED' else result[1]
+        return self.__get_collection(collection)['pkey-type']
+
+    def collection_set_pkey_type(self, collection, type):
+        item = copy.deepcopy(self.__get_collection(collection))
+        item['pkey-type'] = type
+        self.__set_collection(collection, item)
 
     def collection_get_attrs(self, collection):
-        return self.get_by_id('__collections', collection)
+        return copy.deepcopy(self.__get_collection(collection)['attributes'])
 
     def collection_set_attrs(self, collection, attributes):
-        self.update('__collections', collection, attributes)
+        item = copy.deepcopy(self.__get_collection(collection))
+        item['attributes'] = attributes
+        self.__set_collection(collection, item)
+
+    def collection_get_migration_policy(self, collection):
+        return self.__get_collection(collection).get('migration', 'keep')
+
+    def collection_get_migrations(self, collection):
+        return list(self.__get_collection(collection).get('migrations', []))
+
+    def collection_has_migration(self, collection, migration_name):
+        return migration_name in self.__get_collection(collection).get('migrations', [])
+
+    def collection_record_migration(self, collection, migration_name):
+        item = copy.deepcopy(self.__get_collection(collection))
+        item.setdefault('migrations', []).append(migration_name)
+        self.__set_collection(collection, item)
+
+    def collection_get_migration_checkpoint(self, collection):
+        return copy.deepcopy(self.__get_collection(collection).get('migration-checkpoint'))
+
+    def collection_set_migration_checkpoint(self, collection, checkpoint):
+        item = copy.deepcopy(self.__get_collection(collection))
+        if checkpoint is None:
+            item.pop('migration-checkpoint', None)
+        else:
+            item['migration-checkpoint'] = checkpoint
+
+        self.__set_collection(collection, item)
 
     def collection_exists(self, collection):
-        with self.conn.cursor() as cur:
-            cur.execute("SELECT exists(SELECT * FROM information_schema.tables " +
-                        "WHERE table_name = %s)", (collection,))
+        if collection in self.collections:
+            return True
+
+        with self.__cursor() as cur:
+            cur.execute('SELECT exists(SELECT 1 FROM __collections WHERE id = %s)', (collection,))
             return cur.fetchone()[0]
 
     def collection_delete(self, collection):
-        with self.conn.cursor() as cur:
-            cur.execute("DROP TABLE {0}".format(collection))
+        with self.__cursor() as cur:
+            cur.execute('DROP TABLE IF EXISTS {0}'.format(quote_table(collection)))
+            cur.execute('DELETE FROM __collections WHERE id = %s', (collection,))
 
-        self.conn.commit()
+        self.collections.pop(collection, None)
 
     def collection_list(self):
-        with self.conn.cursor() as cur:
-            cur.execute("SELECT table_name FROM information_schema.tables " +
-                        "WHERE table_schema = %s", ('public',))
-            for i in cur:
-                if i[0].startswith('__'):
-                    continue
+        with self.__cursor() as cur:
+            cur.execute('SELECT id FROM __collections')
+            return [i.id for i in cur]
+
+    def collection_get_next_pkey(self, collection, prefix):
+        taken = set()
+        pattern = '^{0}[0-9]+$'.format(re.escape(prefix))
+        for i in self.query(collection, ('id', '~', pattern), select='id'):
+            taken.add(int(i[len(prefix):]))
 
-                yield i[0]
+        counter = 0
+        while counter in taken:
+            counter += 1
+
+        return prefix + str(counter)
 
     def query(self, collection, *args, **kwargs):
-        wrap = kwargs.pop('wrap', True)
-        with self.conn.cursor() as cur:
+        single = kwargs.get('single', False)
+        count = kwargs.get('count', False)
+
+        if single or count:
+            return self.query_stream(collection, *args, **kwargs)
+
+        return list(self.query_stream(collection, *args, **kwargs))
+
+    def query_stream(self, collection, *args, **kwargs):
+        sort = kwargs.pop('sort', None)
+        dir = kwargs.pop('dir', None)
+        limit = kwargs.pop('limit', None)
+        offset = kwargs.pop('offset', None)
+        single = kwargs.pop('single', False)
+        count = kwargs.pop('count', False)
+        reverse = kwargs.pop('reverse', False)
+        postprocess = kwargs.pop('callback', None)
+        select = kwargs.pop('select', None)
+        exclude = kwargs.pop('exclude', None)
+        kwargs.pop('wrap', None)
+
+        def build(cur):
             query = PostgresSelectQuery(collection, cur)
             for i in args:
                 query.where(*i)
 
-            if 'sort' in kwargs and 'dir' in kwargs:
-                query.sort(kwargs.pop('sort'), kwargs.pop('dir'))
+            if count:
+                query.count()
+                return query.sql()
 
-            if 'limit' in kwargs:
-                query.limit(kwargs.pop('limit'))
+            if sort:
+                for s in [sort] if isinstance(sort, string_types) else sort:
+                    if s.startswith('-'):
+                        query.sort(s[1:], PostgresSelectQuery.DESC)
+                    elif dir and dir.lower() == 'desc':
+                        query.sort(s, PostgresSelectQuery.DESC)
+                    else:
+                        query.sort(s, PostgresSelectQuery.ASC)
 
-            cur.execute(query.sql())
+            query.limit(1 if single else limit)
+            query.offset(offset)
+            return query.sql()
 
-            for i in cur:
-                if not wrap:
-                    yield i
-                    continue
+        if exclude:
+            def exclude_fn(fn, obj):
+                obj = fn(obj) if fn else obj
 
-                row = i.data
-                row["id"] = i.id
-                yield row
+                if isinstance(exclude, (list, tuple)):
+                    for i in exclude:
+                        delete(obj, i)
 
-    def get_count(self, collection, *args):
-         with self.conn.cursor() as cur:
-            query = PostgresSelectQuery(collection, cur)
-            for i in args:
-                query.where(*i)
+                if isinstance(exclude, str):
+                    delete(obj, exclude)
 
-            query.projection('count')
-            cur.execute(query.sql())
+                return obj
 
-            i = cur.fetchone()
-            return i[0]
+            before_exclude = postprocess
+            postprocess = lambda o: exclude_fn(before_exclude, o)
 
-    def get_one(self, collection, *args, **kwargs):
-        wrap = kwargs.pop('wrap', True)
-        with self.conn.cursor() as cur:
-            query = PostgresSelectQuery(collection, cur)
-            for i in args:
-                query.where(*i)
+        if select:
+            def select_fn(fn, obj):
+                obj = fn(obj) if fn else obj
 
-            query.limit(1)
-            cur.execute(query.sql())
+                if isinstance(select, (list, tuple)):
+                    return [get(obj, i) for i in select]
 
-            i = cur.fetchone()
-            if i is None:
-                return None
+                if isinstance(select, str):
+                    return get(obj, select)
+
+            before_select = postprocess
+            postprocess = lambda o: select_fn(before_select, o)
+
+        if count or single:
+            with self.__cursor() as cur:
+                cur.execute(build(cur))
+                i = cur.fetchone()
 
-            if not wrap:
+            if count:
+                return i[0]
+
+            if i is None:
                 return i
 
-            row = i.data
-            row["id"] = i.id
-            return row
+            i = self.__row(i)
+            return postprocess(i) if postprocess else i
 
-    def get_by_id(self, collection, pkey):
-        return self.get_one(collection, ('id', '=', pkey))
+        # Rows are fetched before returning, so the pooled connection isn't
+        # held while the caller iterates (or abandons) the generator
+        with self.__cursor() as cur:
+            cur.execute(build(cur))
+            rows = cur.fetchall()
 
-    def insert(self, collection, obj, pkey=None):
-        if hasattr(obj, '__getstate__'):
-            obj = obj.__getstate__()
+        if reverse:
+            rows.reverse()
 
-        if type(obj) is dict and 'id' in obj:
-            pkey = obj.pop('id')
+        def gen():
+            for i in rows:
+                i = self.__row(i)
+                r = postprocess(i) if postprocess else i
+                if r is not None:
+                    yield r
 
-        with self.conn.cursor() as cur:
-            pkey = 'default' if pkey is None else cur.mogrify('%s', [pkey])
-            try:
-                cur.execute("INSERT INTO {0} (id, data) VALUES ({1}, %s) RETURNING id".format(
-                    collection,
-                    pkey
-                ), (psycopg2.extras.Json(obj),))
-            except psycopg2.IntegrityError as e:
-                self.conn.rollback()
-                raise DuplicateKeyException(e)
-            else:
-                self.conn.commit()
+        return gen()
 
-            result = cur.fetchone()
-            self.conn.commit()
-            return result[0]
+    def get_count(self, collection, *args):
+        return self.query(collection, *args, count=True)
 
-    def update(self, collection, pkey, obj):
-        if hasattr(obj, '__getstate__'):
-            obj = obj.__getstate__()
+    def get_one(self, collection, *args, **kwargs):
+        return self.query_stream(collection, *args, single=True, **kwargs)
 
-        with self.conn.cursor() as cur:
-            cur.execute("UPDATE {0} SET data = %s WHERE id = %s".format(collection), (
-                psycopg2.extras.Json(obj),
-                pkey
-            ))
+    def get_by_id(self, collection, pkey):
+        return self.get_one(collection, ('id', '=', pkey))
 
-            self.conn.commit()
+    def exists(self, collection, *args):
+        return self.get_one(collection, *args) is not None
 
-    def upsert(self, collection, pkey, obj):
-        if self.exists(collection, [('id', '=', pkey)]):
-            return self.update(collection, pkey, obj)
-        else:
-            return self.insert(collection, obj, pkey)
+    def insert(self, collection, obj, pkey=None, timestamp=True, config=False):
+        return self.insert_many(collection, [obj], pkeys=[pkey], timestamp=timestamp, config=config)[0]
+
+    def insert_many(self, collection, objs, pkeys=None, timestamp=True, config=False):
+        objs = [self.__prepare_object(o, config) for o in objs]
+        pkeys = list(pkeys) if pkeys is not None else [None] * len(objs)
+        if not objs:
+            return []
+
+        t = datetime.utcnow()
+        for idx, obj in enumerate(objs):
+            pkeys[idx] = obj.pop('id', pkeys[idx])
+            if timestamp:
+                obj['updated_at'] = t
+                obj['created_at'] = t
+
+        explicit = [(pkeys[i], jsonb(o)) for i, o in enumerate(objs) if pkeys[i] is not None]
+        default = [(jsonb(o),) for i, o in enumerate(objs) if pkeys[i] is None]
+        table = quote_table(collection)
+
+        # Resolved before taking a cursor, a metadata cache miss needs a pool slot of its own
+        sync_sequence = explicit and self.collection_get_pkey_type(collection) in ('serial', 'integer')
+
+        with self.__cursor() as cur:
+            if explicit:
+                psycopg2.extras.execute_values(cur, 'INSERT INTO {0} (id, data) VALUES %s'.format(table), explicit)
+                if sync_sequence:
+                    self.__sync_sequence(cur, collection)
+
+            if default:
+                generated = iter(psycopg2.extras.execute_values(
+                    cur,
+                    'INSERT INTO {0} (id, data) VALUES %s RETURNING id'.format(table),
+                    default,
+                    template='(DEFAULT, %s)',
+                    fetch=True
+                ))
+
+                pkeys = [next(generated)[0] if p is None else p for p in pkeys]
+
+        return [str(p) if isinstance(p, uuid.UUID) else p for p in pkeys]
+
+    def update(self, collection, pkey, obj, upsert=False, timestamp=True, config=False):
+        self.update_many(collection, [(pkey, obj)], upsert=upsert, timestamp=timestamp, config=config)
+
+    def update_many(self, collection, items, upsert=False, timestamp=True, config=False):
+        table = quote_table(collection)
+        t = datetime.utcnow()
+        rows = []
+
+        for pkey, obj in items:
+            obj = self.__prepare_object(obj, config)
+            newkey = obj.pop('id', pkey)
+            if timestamp:
+                obj['updated_at'] = t
+                obj['created_at'] = t
+
+            rows.append((pkey, newkey, jsonb(obj)))
+
+        if not rows:
+            return
+
+        # Keep original creation time of updated documents
+        data = "data || jsonb_strip_nulls(jsonb_build_object('created_at', t.data->'created_at'))"
+        with self.__cursor() as cur:
+            if upsert:
+                # A single INSERT ... ON CONFLICT can't touch the same row twice, last write wins
+                values = collections.OrderedDict()
+                for pkey, newkey, obj in rows:
+                    if pkey == newkey:
+                        values[newkey] = obj
+
+                psycopg2.extras.execute_values(
+                    cur,
+                    'INSERT INTO {0} AS t (id, data) VALUES %s ON CONFLICT (id) DO UPDATE SET data = EXCLUDED.{1}'.format(
+                        table,
+                        data if timestamp else 'data'
+                    ),
+                    list(values.items())
+                )
+
+                rows = [r for r in rows if r[0] != r[1]]
+
+            if rows:
+                psycopg2.extras.execute_batch(
+                    cur,
+                    'UPDATE {0} AS t SET id = %s, data = %s::jsonb{1} WHERE id = %s'.format(
+                        table,
+                        " || jsonb_strip_nulls(jsonb_build_object('created_at', t.data->'created_at'))" if timestamp else ''
+                    ),
+                    [(newkey, obj, pkey) for pkey, newkey, obj in rows]
+                )
+
+    def upsert(self, collection, pkey, obj, config=False):
+        return self.update(collection, pkey, obj, upsert=True, config=config)
+
+    def upsert_many(self, collection, items, config=False):
+        return self.update_many(collection, items, upsert=True, config=config)
 
     def delete(self, collection, pkey):
-        with self.conn.cursor() as cur:
-            cur.execute("DELETE FROM {0} WHERE id = %s".format(collection), (
-                pkey,
-            ))
+        self.delete_many(collection, [pkey])
 
-            self.conn.commit()
+    def delete_many(self, collection, pkeys):
+        pkeys = tuple(pkeys)
+        if not pkeys:
+            return
 
-    def exists(self, collection, *args):
-        return self.get_one(collection, *args) is not None
+        with self.__cursor() as cur:
+            cur.execute('DELETE FROM {0} WHERE id IN %s'.format(quote_table(collection)), (pkeys,))
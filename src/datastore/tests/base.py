@@ -0,0 +1,120 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+######################################################################
+
+import copy
+
+
+class MemoryDatastore(object):
+    """
+    Minimal in-memory stand-in for the datastore driver API, implementing
+    just the calls made by the restore and migration code.
+    """
+    def __init__(self):
+        self.collections = {}
+        self.metadata = {}
+        self.checkpoints = {}
+        self.migrations = {}
+        self.writes = []
+
+    def collection_list(self):
+        return list(self.collections)
+
+    def collection_exists(self, name):
+        return name in self.collections
+
+    def collection_create(self, name, pkey_type='uuid', attributes=None):
+        self.writes.append(('collection_create', name))
+        self.collections[name] = {}
+        self.metadata[name] = {'pkey-type': pkey_type, 'attributes': attributes or {}}
+
+    def collection_delete(self, name):
+        self.writes.append(('collection_delete', name))
+        self.collections.pop(name, None)
+        self.metadata.pop(name, None)
+
+    def collection_get_attrs(self, name):
+        return self.metadata[name]['attributes']
+
+    def collection_get_pkey_type(self, name):
+        return self.metadata[name]['pkey-type']
+
+    def collection_get_migration_policy(self, name):
+        return 'keep'
+
+    def collection_get_migrations(self, name):
+        return self.migrations.get(name, [])
+
+    def collection_has_migration(self, name, migration):
+        return migration in self.collection_get_migrations(name)
+
+    def collection_record_migration(self, name, migration):
+        self.writes.append(('collection_record_migration', name))
+        self.migrations.setdefault(name, []).append(migration)
+
+    def collection_get_migration_checkpoint(self, name):
+        return self.checkpoints.get(name)
+
+    def collection_set_migration_checkpoint(self, name, checkpoint):
+        self.writes.append(('collection_set_migration_checkpoint', name))
+        self.checkpoints[name] = checkpoint
+
+    def insert_many(self, name, objs, pkeys=None, config=False):
+        self.writes.append(('insert_many', name))
+        for pkey, obj in zip(pkeys, objs):
+            self.collections[name][pkey] = {'value': obj} if config else copy.deepcopy(obj)
+
+    def update(self, name, pkey, obj):
+        self.update_many(name, [(pkey, obj)])
+
+    def update_many(self, name, objs, upsert=False, config=False):
+        self.writes.append(('update_many', name))
+        for pkey, obj in objs:
+            obj = copy.deepcopy(obj)
+            new_pkey = obj.pop('id', pkey)
+            if new_pkey != pkey:
+                del self.collections[name][pkey]
+
+            self.collections[name][new_pkey] = obj
+
+    def delete_many(self, name, pkeys):
+        self.writes.append(('delete_many', name))
+        for pkey in pkeys:
+            self.collections[name].pop(pkey, None)
+
+    def query(self, name, *filter, sort=None, limit=None):
+        items = sorted(self.collections[name].items(), key=lambda i: i[0])
+        for field, op, value in filter:
+            assert field == 'id' and op == '>'
+            items = [(k, v) for k, v in items if k > value]
+
+        if limit:
+            items = items[:limit]
+
+        return [dict(copy.deepcopy(v), id=k) for k, v in items]
+
+    def query_stream(self, name):
+        return iter(self.query(name))
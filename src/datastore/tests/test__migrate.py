@@ -0,0 +1,134 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+######################################################################
+
+import os
+import sys
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from datastore.migrate import MigrationException, apply_migration
+from base import MemoryDatastore
+
+
+def make_migration(fail_on=None):
+    # Renames 'name' to 'username', deletes disabled users and leaves already migrated ones alone
+    applied = []
+
+    def probe(obj, ds):
+        return 'name' in obj
+
+    def apply(obj, ds):
+        if obj['id'] == fail_on:
+            raise ValueError('cannot migrate')
+
+        applied.append(obj['id'])
+        if obj.get('disabled'):
+            return None
+
+        obj['username'] = obj.pop('name')
+        return obj
+
+    mod = types.ModuleType('0001_rename_name')
+    mod.probe = probe
+    mod.apply = apply
+    mod.applied = applied
+    return mod
+
+
+def make_datastore():
+    ds = MemoryDatastore()
+    ds.collection_create('users', 'serial')
+    for i in range(1, 11):
+        ds.collections['users'][i] = {'name': 'user{0}'.format(i), 'disabled': i % 5 == 0}
+
+    ds.collections['users'][11] = {'username': 'user11'}
+    ds.writes.clear()
+    return ds
+
+
+def expected_users():
+    users = {i: {'username': 'user{0}'.format(i), 'disabled': False} for i in range(1, 11) if i % 5}
+    users[11] = {'username': 'user11'}
+    return users
+
+
+class TestApplyMigration(unittest.TestCase):
+    def test_apply(self):
+        ds = make_datastore()
+        result = apply_migration(ds, 'users', '0001_rename_name', make_migration(), batch_size=3)
+        self.assertEqual(ds.collections['users'], expected_users())
+        self.assertEqual(result['total'], 11)
+        self.assertEqual(result['migrated'], 10)
+        self.assertEqual(result['changed'], 8)
+        self.assertEqual(result['deleted'], 2)
+        self.assertEqual(ds.migrations['users'], ['0001_rename_name'])
+        self.assertIsNone(ds.checkpoints['users'])
+
+    def test_checkpoint_resume(self):
+        ds = make_datastore()
+        with self.assertRaises(MigrationException):
+            apply_migration(ds, 'users', '0001_rename_name', make_migration(fail_on=8), batch_size=3)
+
+        # First two batches made it, the failing one didn't
+        self.assertEqual(ds.checkpoints['users'], {'name': '0001_rename_name', 'last_id': 6})
+        self.assertEqual(ds.collections['users'][6], {'username': 'user6', 'disabled': False})
+        self.assertEqual(ds.collections['users'][7], {'name': 'user7', 'disabled': False})
+        self.assertNotIn('users', ds.migrations)
+
+        mod = make_migration()
+        apply_migration(ds, 'users', '0001_rename_name', mod, batch_size=3)
+        self.assertEqual(mod.applied, [7, 8, 9, 10])
+        self.assertEqual(ds.collections['users'], expected_users())
+        self.assertEqual(ds.migrations['users'], ['0001_rename_name'])
+        self.assertIsNone(ds.checkpoints['users'])
+
+    def test_checkpoint_of_other_migration(self):
+        ds = make_datastore()
+        ds.checkpoints['users'] = {'name': '0000_other', 'last_id': 6}
+        mod = make_migration()
+        apply_migration(ds, 'users', '0001_rename_name', mod, batch_size=3)
+        self.assertEqual(mod.applied, list(range(1, 11)))
+        self.assertEqual(ds.collections['users'], expected_users())
+
+    def test_dry_run(self):
+        ds = make_datastore()
+        ds.checkpoints['users'] = {'name': '0001_rename_name', 'last_id': 6}
+        mod = make_migration()
+        result = apply_migration(ds, 'users', '0001_rename_name', mod, dry_run=True, batch_size=3)
+        self.assertEqual(mod.applied, list(range(1, 11)))
+        self.assertEqual(result['changed'], 8)
+        self.assertEqual(result['deleted'], 2)
+        self.assertEqual(ds.writes, [])
+        self.assertEqual(ds.collections['users'], make_datastore().collections['users'])
+        self.assertEqual(ds.checkpoints['users'], {'name': '0001_rename_name', 'last_id': 6})
+
+
+if __name__ == '__main__':
+    unittest.main()
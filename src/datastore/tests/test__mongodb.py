@@ -0,0 +1,72 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+######################################################################
+
+import os
+import sys
+import unittest
+import pymongo.errors
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'drivers', 'mongodb'))
+
+from datastore import DatastoreException, DuplicateKeyException
+from mongodb import DUPLICATE_KEY_ERROR, bulk_write_exception
+
+
+def bulk_write_error(*codes):
+    return pymongo.errors.BulkWriteError({
+        'writeErrors': [{'index': i, 'code': c, 'errmsg': 'error {0}'.format(c)} for i, c in enumerate(codes)],
+        'writeConcernErrors': [],
+        'nInserted': 0
+    })
+
+
+class TestBulkWriteException(unittest.TestCase):
+    def test_duplicate_keys(self):
+        err = bulk_write_exception('Cannot insert documents', bulk_write_error(DUPLICATE_KEY_ERROR, DUPLICATE_KEY_ERROR))
+        self.assertIsInstance(err, DuplicateKeyException)
+        self.assertEqual(str(err), 'Cannot insert documents: error 11000')
+
+    def test_other_error(self):
+        err = bulk_write_exception('Cannot insert documents', bulk_write_error(121))
+        self.assertIsInstance(err, DatastoreException)
+        self.assertNotIsInstance(err, DuplicateKeyException)
+
+    def test_mixed_errors(self):
+        err = bulk_write_exception('Cannot insert documents', bulk_write_error(DUPLICATE_KEY_ERROR, 121))
+        self.assertNotIsInstance(err, DuplicateKeyException)
+
+    def test_write_concern_error(self):
+        err = bulk_write_exception('Cannot insert documents', pymongo.errors.BulkWriteError({
+            'writeErrors': [],
+            'writeConcernErrors': [{'code': 64, 'errmsg': 'waiting for replication timed out'}]
+        }))
+        self.assertNotIsInstance(err, DuplicateKeyException)
+
+
+if __name__ == '__main__':
+    unittest.main()
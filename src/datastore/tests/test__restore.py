@@ -0,0 +1,138 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+######################################################################
+
+import io
+import os
+import sys
+import json
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from datastore import restore
+from datastore.restore import dump_db, dump_db_stream, load_dump_stream, restore_db
+from base import MemoryDatastore
+
+
+def make_datastore():
+    ds = MemoryDatastore()
+    ds.collection_create('users', 'serial', {'type': 'config'})
+    for i in range(2500):
+        ds.collections['users'][i] = {'username': 'user{0}'.format(i), 'groups': [i % 3]}
+
+    ds.collection_create('config', 'uuid', {'configstore': True, 'type': 'config'})
+    for i in range(5):
+        ds.collections['config']['key{0}'.format(i)] = {'value': {'nested': [i]}}
+
+    ds.collection_create('tasks', 'serial', {'type': 'log'})
+    ds.collections['tasks'][1] = {'name': 'test'}
+    ds.collection_create('empty', 'uuid', {})
+    return ds
+
+
+class TestDumpRestore(unittest.TestCase):
+    def round_trip(self, dump, **kwargs):
+        source = make_datastore()
+        f = io.StringIO()
+        dump(source, f)
+        f.seek(0)
+
+        target = MemoryDatastore()
+        progress = []
+
+        def progress_callback(name):
+            progress.append((name, threading.current_thread() is threading.main_thread()))
+
+        restore_db(target, load_dump_stream(f), progress_callback=progress_callback, **kwargs)
+        return source, target, progress, f.getvalue()
+
+    def test_stream_round_trip(self):
+        source, target, progress, _ = self.round_trip(dump_db_stream, workers=2)
+        self.assertEqual(target.collections, source.collections)
+        self.assertEqual(target.metadata, source.metadata)
+        self.assertEqual(sorted(name for name, _ in progress), sorted(source.collections))
+        self.assertTrue(all(main for _, main in progress))
+
+    def test_legacy_round_trip(self):
+        source, target, progress, dump = self.round_trip(dump_db, workers=1)
+        self.assertEqual(target.collections, source.collections)
+        self.assertEqual(target.metadata, source.metadata)
+        self.assertEqual(sorted(name for name, _ in progress), sorted(source.collections))
+
+        # Legacy format is a single JSON document
+        collections = json.loads(dump)
+        self.assertEqual([i['metadata']['name'] for i in collections], source.collection_list())
+        self.assertEqual(collections[1]['data']['key1'], {'nested': [1]})
+
+    def test_legacy_list(self):
+        source = make_datastore()
+        f = io.StringIO()
+        dump_db(source, f)
+        target = MemoryDatastore()
+        restore_db(target, json.loads(f.getvalue()))
+        self.assertEqual(target.collections, source.collections)
+
+    def test_batches(self):
+        source, target, _, _ = self.round_trip(dump_db_stream)
+        batches = [name for op, name in target.writes if op == 'insert_many']
+        self.assertEqual(batches.count('users'), -(-2500 // restore.RESTORE_BATCH_SIZE))
+
+    def test_types(self):
+        source = make_datastore()
+        f = io.StringIO()
+        dump_db_stream(source, f, types=['config'])
+        f.seek(0)
+        target = MemoryDatastore()
+        restore_db(target, load_dump_stream(f))
+        self.assertEqual(sorted(target.collections), ['config', 'empty', 'users'])
+
+        f.seek(0)
+        dump_db_stream(source, f)
+        f.seek(0)
+        target = MemoryDatastore()
+        restore_db(target, load_dump_stream(f), types=['log'])
+        self.assertEqual(sorted(target.collections), ['empty', 'tasks'])
+
+    def test_error(self):
+        class FailingDatastore(MemoryDatastore):
+            def insert_many(self, name, objs, pkeys=None, config=False):
+                if name == 'config':
+                    raise RuntimeError('insert failed')
+
+                super(FailingDatastore, self).insert_many(name, objs, pkeys, config)
+
+        f = io.StringIO()
+        dump_db_stream(make_datastore(), f)
+        f.seek(0)
+        with self.assertRaises(RuntimeError):
+            restore_db(FailingDatastore(), load_dump_stream(f), workers=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/local/bin/python3
+#+
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+#
+# Measures throughput of internal queries made through
+# DispatcherRpcContext.call_sync() on a 10k-dataset provider shaped like
+# zfs.dataset.query, with thawed results (the default), frozen=True and
+# no_copy=True.
+#
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from main import DispatcherRpcContext
+from freenas.dispatcher.rpc import RpcService, generator
+from freenas.utils import query as q
+
+
+DATASETS = 10000
+ROUNDS = 5
+
+
+def make_dataset(i):
+    name = 'tank/ds{0}'.format(i)
+    return {
+        'id': name,
+        'name': name,
+        'pool': 'tank',
+        'type': 'FILESYSTEM',
+        'mountpoint': '/mnt/' + name,
+        'properties': {
+            p: {'source': 'DEFAULT', 'value': str(i), 'rawvalue': str(i), 'parsed': i}
+            for p in ('used', 'available', 'compression', 'atime', 'quota', 'refquota', 'recordsize', 'dedup')
+        },
+        'children': [],
+        'permissions_type': 'PERM',
+    }
+
+
+class DatasetProvider(RpcService):
+    def __init__(self, datasets):
+        self.datasets = datasets
+
+    @generator
+    def query(self, filter=None, params=None):
+        return q.query(self.datasets, *(filter or []), stream=True, **(params or {}))
+
+
+def run(rpc, **kwargs):
+    count = 0
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for item in rpc.call_sync('bench.dataset.query', [('pool', '=', 'tank')], **kwargs):
+            # Typical read access pattern of a consumer
+            item['properties']['used']['parsed']
+            count += 1
+
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    rpc = DispatcherRpcContext(None)
+    rpc.register_service_instance('bench.dataset', DatasetProvider([make_dataset(i) for i in range(DATASETS)]))
+
+    print('{0:>10} {1:>14}'.format('mode', 'items/s'))
+    for name, kwargs in (('thaw', {}), ('frozen', {'frozen': True}), ('no_copy', {'no_copy': True})):
+        print('{0:>10} {1:>14.0f}'.format(name, run(rpc, **kwargs)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/local/bin/python3
+#+
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+#
+# Compares event fan-out throughput of the old "every mask of every
+# connection" matching against EventSubscriptionIndex.
+#
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from event import EventSubscriptionIndex
+from bsd import fnmatch as cfnmatch
+
+
+CONNECTIONS = (10, 100, 1000)
+EVENTS = 20000
+MASKS = [
+    ['entity-subscriber.*.changed', 'task.*', 'alert.*'],
+    ['statd.*.pulse', 'task.progress', 'server.*'],
+    ['entity-subscriber.volume.changed', 'entity-subscriber.disk.changed'],
+    ['*'],
+]
+EVENT_NAMES = [
+    'task.progress',
+    'task.updated',
+    'statd.localhost.cpu-0.cpu-user.value.pulse',
+    'entity-subscriber.volume.changed',
+    'entity-subscriber.zfs.dataset.changed',
+    'server.client_connected',
+    'alert.changed',
+    'network.changed',
+]
+
+
+class FakeConnection(object):
+    def __init__(self, masks):
+        self.event_masks = set(masks)
+        self.delivered = 0
+
+
+def bench_naive(connections, events):
+    start = time.perf_counter()
+    for name in events:
+        for conn in connections:
+            for mask in conn.event_masks:
+                if cfnmatch(name, mask):
+                    conn.delivered += 1
+                    break
+
+    return len(events) / (time.perf_counter() - start)
+
+
+def bench_index(connections, events):
+    index = EventSubscriptionIndex()
+    for conn in connections:
+        index.subscribe(conn, conn.event_masks)
+
+    start = time.perf_counter()
+    for name in events:
+        for conn in index.match(name):
+            conn.delivered += 1
+
+    return len(events) / (time.perf_counter() - start)
+
+
+def main():
+    random.seed(0)
+    events = [random.choice(EVENT_NAMES) for _ in range(EVENTS)]
+    print('{0:>12} {1:>16} {2:>16}'.format('connections', 'naive ev/s', 'indexed ev/s'))
+    for count in CONNECTIONS:
+        connections = [FakeConnection(MASKS[i % len(MASKS)]) for i in range(count)]
+        naive = bench_naive(connections, events)
+        indexed = bench_index(connections, events)
+        print('{0:>12} {1:>16.0f} {2:>16.0f}'.format(count, naive, indexed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/local/bin/python3
+#+
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+#
+# Stress test for Balancer scheduling: submits thousands of tasks contending
+# on a handful of volumes and measures how fast they drain.
+#
+
+import os
+import sys
+import time
+import random
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from resources import Resource, ResourceGraph
+from balancer import Balancer, Task
+from task import TaskState
+
+
+VOLUMES = 4
+DATASETS_PER_VOLUME = 16
+TASK_COUNTS = (1000, 5000, 10000)
+
+
+class FakeDatastore(object):
+    def __init__(self):
+        self.next_id = 0
+
+    def insert(self, collection, obj):
+        self.next_id += 1
+        return self.next_id
+
+    def update(self, collection, id, obj):
+        pass
+
+    def delete(self, collection, id):
+        pass
+
+
+class FakeDispatcher(object):
+    def __init__(self):
+        self.resource_graph = ResourceGraph()
+        self.datastore_log = FakeDatastore()
+        self.tasks = {}
+        self.balancer = None
+
+    def require_collection(self, *args, **kwargs):
+        pass
+
+    def register_event_type(self, *args, **kwargs):
+        pass
+
+    def dispatch_event(self, *args, **kwargs):
+        pass
+
+
+def setup():
+    dispatcher = FakeDispatcher()
+    balancer = Balancer(dispatcher)
+    dispatcher.balancer = balancer
+    resources = []
+
+    for v in range(VOLUMES):
+        vol = 'zpool:vol{0}'.format(v)
+        dispatcher.resource_graph.add_resource(Resource(vol))
+        resources.append(vol)
+        for d in range(DATASETS_PER_VOLUME):
+            ds = 'zfs:vol{0}/ds{1}'.format(v, d)
+            dispatcher.resource_graph.add_resource(Resource(ds), parents=[vol])
+            resources.append(ds)
+
+    return dispatcher, balancer, resources
+
+
+def run(count):
+    dispatcher, balancer, resources = setup()
+    running = collections.deque()
+    Task.start = lambda task: running.append(task)
+
+    start = time.perf_counter()
+    for i in range(count):
+        task = Task(dispatcher, 'bench.task')
+        task.id = dispatcher.datastore_log.insert('tasks', task)
+        task.resources = [random.choice(resources)]
+        task.set_state(TaskState.WAITING)
+        balancer.add_task(task)
+        balancer.schedule_tasks([task])
+
+        # Let roughly one task finish per two submitted to build up contention
+        if i % 2 and running:
+            task = running.popleft()
+            task.set_state(TaskState.FINISHED)
+            balancer.task_exited(task)
+
+    while running:
+        task = running.popleft()
+        task.set_state(TaskState.FINISHED)
+        balancer.task_exited(task)
+
+    elapsed = time.perf_counter() - start
+    assert not balancer.waiting_tasks
+    return count / elapsed
+
+
+def main():
+    random.seed(0)
+    print('{0:>8} {1:>12}'.format('tasks', 'tasks/s'))
+    for count in TASK_COUNTS:
+        print('{0:>8} {1:>12.0f}'.format(count, run(count)))
+
+
+if __name__ == '__main__':
+    main()
@@ -102,7 +102,7 @@ class BootPoolProvider(Provider):
     @returns(bool)
     def made_of_good_disks(self):
         pool = self.dispatcher.call_sync('boot.pool.query')
-        disks = self.dispatcher.call_sync('disk.query', [('id', 'in', pool['disks'])])
+        disks = self.dispatcher.call_sync('disk.query', [('id', 'in', pool['disks'])], frozen=True)
 
         for d in disks:
             if q.get(d, 'controller.controller_name') == 'umass-sim':
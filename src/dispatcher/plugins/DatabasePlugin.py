@@ -28,8 +28,8 @@
 import os
 import errno
 from datastore import DatastoreException
-from datastore.restore import restore_db, dump_collection
-from freenas.dispatcher.jsonenc import dump, load
+from datastore.restore import restore_db, dump_db, load_dump_stream
+from freenas.dispatcher.jsonenc import dumps, loads
 from freenas.dispatcher.fd import FileDescriptor
 from freenas.dispatcher.rpc import description, accepts
 from task import Task, ProgressTask, TaskException, TaskDescription
@@ -52,13 +52,9 @@ class DownloadDatabaseTask(Task):
         return ['root']
 
     def run(self, fd):
-        result = []
-        for i in self.datastore.collection_list():
-            result.append(dump_collection(self.datastore, i))
-
         try:
             with os.fdopen(fd.fd, mode='w', closefd=False) as f:
-                dump(result, f)
+                dump_db(self.datastore, f, dumps=dumps)
         except OSError as err:
             raise TaskException(err.errno, err.strerror)
 
@@ -77,19 +73,23 @@ class UploadDatabaseTask(ProgressTask):
         return ['root']
 
     def run(self, fd):
+        collections = self.datastore.collection_list()
+        restored = []
+
+        def progress(name):
+            restored.append(name)
+            self.set_progress(
+                min(99, len(restored) * 100 / max(len(collections), 1)),
+                'Restored collection {0}'.format(name)
+            )
+
         try:
             with os.fdopen(fd.fd, 'r', closefd=False) as f:
-                dump = load(f)
+                restore_db(self.datastore, load_dump_stream(f, loads=loads), progress_callback=progress)
         except IOError as err:
             raise TaskException(errno.ENOENT, "Cannot open input file: {0}".format(str(err)))
         except ValueError as err:
             raise TaskException(errno.EINVAL, "Cannot parse input file: {0}".format(str(err)))
-
-        def progress(name):
-            self.set_progress(50, 'Restored collection {0}'.format(name))
-
-        try:
-            restore_db(self.datastore, dump, progress_callback=progress)
         except DatastoreException as err:
             raise TaskException(errno.EFAULT, 'Cannot restore factory database: {0}'.format(str(err)))
 
@@ -80,6 +80,10 @@ class SessionProvider(Provider):
         if not target:
             raise RpcException(errno.ENOENT, 'Session {0} not found'.format(id))
 
+        # Connections don't filter outgoing events themselves
+        if target not in self.dispatcher.event_subscriptions.match('session.message'):
+            return
+
         target.outgoing_events.put(('session.message', {
             'sender_id': sender.session_id,
             'sender_name': sender.user.name if sender.user else None,
@@ -90,13 +94,12 @@ class SessionProvider(Provider):
     @accepts(str)
     @pass_sender
     def send_to_all(self, message, sender):
-        for srv in self.dispatcher.ws_servers:
-            for target in srv.connections:
-                target.outgoing_events.put(('session.message', {
-                    'sender_id': sender.session_id,
-                    'sender_name': sender.user.name if sender.user else None,
-                    'message': message
-                }))
+        for target in self.dispatcher.event_subscriptions.match('session.message'):
+            target.outgoing_events.put(('session.message', {
+                'sender_id': sender.session_id,
+                'sender_name': sender.user.name if sender.user else None,
+                'message': message
+            }))
 
 
 def _init(dispatcher, plugin):
@@ -54,7 +54,7 @@ class SwapProvider(Provider):
 
 def get_available_disks(dispatcher):
     disks = []
-    for i in dispatcher.call_sync('volume.query', [], {'select': 'id'}):
+    for i in dispatcher.call_sync('volume.query', [], {'select': 'id'}, frozen=True):
         try:
             disks += dispatcher.call_sync('volume.get_volume_disks', i)
         except RpcException as err:
@@ -65,7 +65,7 @@ def get_available_disks(dispatcher):
 
 
 def get_swap_partition(dispatcher, disk):
-    disk = dispatcher.call_sync('disk.query', [('id', '=', disk)], {'single': True})
+    disk = dispatcher.call_sync('disk.query', [('id', '=', disk)], {'single': True}, frozen=True)
     if not disk:
         return None
 
@@ -386,7 +386,7 @@ class VolumeProvider(Provider):
         for dev in boot_pool['disks']:
             ret[dev['disk_id']] = {'type': 'BOOT'}
 
-        for vol in self.dispatcher.call_sync('volume.query'):
+        for vol in self.dispatcher.call_sync('volume.query', frozen=True):
             if vol['status'] in ('UNAVAIL', 'UNKNOWN'):
                 continue
 
@@ -3400,7 +3400,7 @@ def _init(dispatcher, plugin):
 
     @sync
     def on_disk_attached(args):
-        for vol in dispatcher.call_sync('volume.query', [('status', '=', 'UNKNOWN')]):
+        for vol in dispatcher.call_sync('volume.query', [('status', '=', 'UNKNOWN')], frozen=True):
             if vol.get('key_encrypted') or vol.get('password_encrypted'):
                 continue
 
@@ -3415,7 +3415,7 @@ def _init(dispatcher, plugin):
                         dispatcher.call_task_sync('zfs.mount', vol['id'], True)
 
     def on_server_ready(args):
-        for vol in dispatcher.call_sync('volume.query'):
+        for vol in dispatcher.call_sync('volume.query', frozen=True):
             if vol.get('providers_presence', 'ALL') == 'NONE':
                 if vol.get('auto_unlock') and vol.get('key_encrypted') and not vol.get('password_encrypted'):
                     dispatcher.call_task_sync('volume.unlock', vol['id'])
@@ -1393,8 +1393,8 @@ def sync_zpool_cache(dispatcher, pool, guid=None):
     except libzfs.ZFSException as e:
         if e.code == libzfs.Error.NOENT:
             pools.remove(pool)
-            snapshots.remove_predicate(lambda i: i['pool'] == pool)
-            datasets.remove_predicate(lambda i: i['pool'] == pool)
+            snapshots.remove_predicate([('pool', '=', pool)])
+            datasets.remove_predicate([('pool', '=', pool)])
             return
 
         logger.warning("Cannot read pool status from pool {0}".format(pool))
@@ -1424,7 +1424,7 @@ def sync_dataset_cache(dispatcher, dataset, old_dataset=None, recursive=False, s
     except libzfs.ZFSException as e:
         if e.code == libzfs.Error.NOENT:
             if datasets.remove(dataset):
-                snapshots.remove_predicate(lambda i: i['dataset'] == dataset)
+                snapshots.remove_predicate([('dataset', '=', dataset)])
                 datasets.remove_predicate(lambda i: is_child(i['name'], dataset))
 
             return
@@ -1510,14 +1510,14 @@ def _init(dispatcher, plugin):
     @sync
     def on_pool_import(args):
         logger.info('New pool imported: {0} <{1}>'.format(args['pool'], args['guid']))
-        with dispatcher.get_lock('zfs-cache'):
+        with dispatcher.get_lock('zfs-cache'), datasets.batch(), snapshots.batch():
             sync_zpool_cache(dispatcher, args['pool'], args['guid'])
             sync_dataset_cache(dispatcher, args['pool'], recursive=True, snaps=True)
 
     @sync
     def on_pool_destroy(args):
         logger.info('Pool {0} <{1}> destroyed'.format(args['pool'], args['guid']))
-        with dispatcher.get_lock('zfs-cache'):
+        with dispatcher.get_lock('zfs-cache'), datasets.batch(), snapshots.batch():
             sync_zpool_cache(dispatcher, args['pool'], args['guid'])
 
     @sync
@@ -1554,7 +1554,7 @@ def _init(dispatcher, plugin):
 
     @sync
     def on_dataset_rename(args):
-        with dispatcher.get_lock('zfs-cache'):
+        with dispatcher.get_lock('zfs-cache'), datasets.batch(), snapshots.batch():
             if '@' in args['ds']:
                 logger.info('Snapshot {0} renamed to: {1}'.format(args['ds'], args['new_ds']))
                 sync_snapshot_cache(dispatcher, args['new_ds'], args['ds'])
@@ -1583,7 +1583,8 @@ def _init(dispatcher, plugin):
             if '@' in args['ds']:
                 sync_snapshot_cache(dispatcher, args['ds'])
             else:
-                sync_dataset_cache(dispatcher, args['ds'], recursive=True)
+                with datasets.batch():
+                    sync_dataset_cache(dispatcher, args['ds'], recursive=True)
 
     @sync
     def on_vfs_mount_or_unmount(type, args):
@@ -1623,7 +1624,7 @@ def _init(dispatcher, plugin):
 
     @sync
     def on_disk_attached(args):
-        for volume in dispatcher.call_sync('volume.query', [('status', 'in', ('DEGRADED', 'UNAVAIL'))]):
+        for volume in dispatcher.call_sync('volume.query', [('status', 'in', ('DEGRADED', 'UNAVAIL'))], frozen=True):
             if volume.get('key_encrypted') or volume.get('password_encrypted'):
                 continue
 
@@ -2035,8 +2036,14 @@ def _init(dispatcher, plugin):
             return par, base, snap
 
         pools = EventCacheStore(dispatcher, 'zfs.pool', sort_func)
-        datasets = EventCacheStore(dispatcher, 'zfs.dataset', sort_func)
-        snapshots = EventCacheStore(dispatcher, 'zfs.snapshot', snap_sort_func)
+        datasets = EventCacheStore(dispatcher, 'zfs.dataset', sort_func, indexes=[
+            'pool',
+            'properties.mountpoint.value'
+        ])
+        snapshots = EventCacheStore(dispatcher, 'zfs.snapshot', snap_sort_func, indexes=[
+            'pool',
+            'dataset'
+        ])
 
         pools_dict = {}
         for i in dispatcher.threaded(lambda: [p.__getstate__(False) for p in zfs.pools]):
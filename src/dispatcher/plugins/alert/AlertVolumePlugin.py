@@ -53,7 +53,7 @@ def _init(dispatcher, plugin):
             })
 
     def volumes_upgraded():
-        for volume in dispatcher.rpc.call_sync('volume.query'):
+        for volume in dispatcher.rpc.call_sync('volume.query', frozen=True):
             if volume['status'] in ('UNAVAIL', 'LOCKED'):
                 continue
 
@@ -70,7 +70,7 @@ def _init(dispatcher, plugin):
                 'description': 'New feature flags are available for volume {0}'.format(volume['id']),
             })
 
-    for i in dispatcher.call_sync('volume.query'):
+    for i in dispatcher.call_sync('volume.query', frozen=True):
         volume_status(i)
 
     def on_volume_change(args):
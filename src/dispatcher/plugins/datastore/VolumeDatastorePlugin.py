@@ -42,7 +42,7 @@ class VolumeDatastoreProvider(Provider):
     @private
     @generator
     def discover(self):
-        for vol in self.dispatcher.call_sync('volume.query', [], {'select': 'id'}):
+        for vol in self.dispatcher.call_sync('volume.query', [], {'select': 'id'}, frozen=True):
             yield {
                 'id': vol,
                 'name': vol,
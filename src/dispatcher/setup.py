@@ -38,6 +38,7 @@ files = [
     "src/cache.py",
     "src/debug.py",
     "src/event.py",
+    "src/frozen.py",
     "src/main.py",
     "src/query.py",
     "src/resources.py",
@@ -26,6 +26,7 @@
 #####################################################################
 
 import os
+import time
 import gevent
 import logging
 import traceback
@@ -59,6 +60,10 @@ import collections
 
 
 TASKWORKER_PATH = '/usr/local/libexec/taskworker'
+TASK_FLUSH_INTERVAL = 1
+EXECUTOR_REAP_INTERVAL = 30
+EXECUTORS_MAX_DEFAULT = 32
+FINISHED_TASKS_SIZE = 1000
 ERROR_TYPES = {
     'RpcException': RpcException,
     'TaskException': TaskException,
@@ -100,6 +105,8 @@ class TaskExecutor(object):
         self.result = AsyncResult()
         self.exiting = False
         self.killed = False
+        self.idle_since = None
+        self.claimed = False
         self.thread = gevent.spawn(self.executor)
         self.cv = Condition()
         self.status_lock = RLock()
@@ -109,8 +116,11 @@ class TaskExecutor(object):
             self.balancer.logger.debug('Check-in of worker #{0} (key {1})'.format(self.index, self.key))
             self.conn = conn
             self.state = WorkerState.IDLE
+            self.idle_since = time.monotonic()
             self.cv.notify_all()
 
+        self.balancer.start_executor_waiters()
+
     def put_progress(self, progress):
         st = TaskStatus(None)
         st.__setstate__(progress)
@@ -160,10 +170,6 @@ class TaskExecutor(object):
         self.conn.call_sync('taskproxy.update_env', env)
 
     def run(self, task):
-        def match_file(module, f):
-            name, ext = os.path.splitext(f)
-            return module == name and ext in ['.py', '.pyc', '.so']
-
         with self.cv:
             self.cv.wait_for(lambda: self.state == WorkerState.ASSIGNED)
             self.result = AsyncResult()
@@ -174,22 +180,8 @@ class TaskExecutor(object):
 
         self.balancer.logger.debug('Actually starting task {0}'.format(task.id))
 
-        filename = None
         module_name = inspect.getmodule(task.clazz).__name__
-        for dir in self.balancer.dispatcher.plugin_dirs:
-            found = False
-            try:
-                for root, _, files in os.walk(dir):
-                    file = first_or_default(lambda f: match_file(module_name, f), files)
-                    if file:
-                        filename = os.path.join(root, file)
-                        found = True
-                        break
-
-                if found:
-                    break
-            except OSError:
-                continue
+        filename = self.balancer.dispatcher.get_module_file(module_name)
 
         try:
             self.conn.call_sync('taskproxy.run', {
@@ -238,6 +230,7 @@ class TaskExecutor(object):
 
                 if self.state == WorkerState.EXECUTING:
                     self.state = WorkerState.IDLE
+                    self.idle_since = time.monotonic()
                     self.cv.notify_all()
 
             self.balancer.task_exited(self.task)
@@ -249,6 +242,7 @@ class TaskExecutor(object):
             self.task.ended.set()
             if self.state == WorkerState.EXECUTING:
                 self.state = WorkerState.IDLE
+                self.idle_since = time.monotonic()
                 self.cv.notify_all()
 
         self.balancer.task_exited(self.task)
@@ -267,7 +261,7 @@ class TaskExecutor(object):
             self.terminate()
 
             # Now kill all the subtasks
-            for subtask in filter(lambda t: t.parent is self.task, self.balancer.task_list):
+            for subtask in self.balancer.get_subtasks(self.task):
                 self.balancer.logger.warning("Aborting subtask {0} because parent task {1} died".format(
                     subtask.id,
                     self.task.id
@@ -301,7 +295,7 @@ class TaskExecutor(object):
                 line = line.decode('utf8')
                 self.balancer.logger.debug('Executor #{0}: {1}'.format(self.index, line.strip()))
                 if self.task:
-                    self.task.output += line
+                    self.task.append_output(line)
 
             self.proc.wait()
 
@@ -333,6 +327,104 @@ class TaskExecutor(object):
             self.terminate()
 
 
+class TaskLogWriter(object):
+    """
+    Write-behind persistence of task documents to the log datastore.
+
+    Updates are coalesced per task id and written every TASK_FLUSH_INTERVAL
+    seconds. Terminal states are written immediately. While a task is
+    running, its output is appended to `tasks.output` in chunks instead of
+    being rewritten as part of the task document; the full output is stored
+    in the task document once the task ends.
+    """
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.logger = logging.getLogger('TaskLogWriter')
+        self.pending = collections.OrderedDict()
+        self.output_offsets = {}
+        self.output_chunks = {}
+        self.lock = RLock()
+        self.thread = None
+
+    @property
+    def datastore(self):
+        return self.dispatcher.datastore_log
+
+    def start(self):
+        if not self.datastore.collection_exists('tasks.output'):
+            self.datastore.collection_create('tasks.output', 'uuid', {'type': 'log'})
+
+        self.thread = gevent.spawn(self.flush_thread)
+
+    def update(self, task, flush=False, output_reset=False):
+        with self.lock:
+            if output_reset:
+                self.drop_output_chunks(task.id)
+
+            self.pending[task.id] = task
+            if flush:
+                self.flush(task.id)
+
+    def flush(self, id=None):
+        with self.lock:
+            if id is None:
+                tasks = list(self.pending.values())
+                self.pending.clear()
+            else:
+                task = self.pending.pop(id, None)
+                tasks = [task] if task else []
+
+            for task in tasks:
+                try:
+                    self.write(task)
+                except Exception as err:
+                    # Keep it around, next flush will retry
+                    self.logger.warning('Cannot persist task {0}: {1}'.format(task.id, str(err)))
+                    self.pending.setdefault(task.id, task)
+
+    def write(self, task):
+        state = task.__getstate__()
+        if task.state in (TaskState.FINISHED, TaskState.FAILED, TaskState.ABORTED):
+            self.datastore.update('tasks', task.id, state)
+            self.drop_output_chunks(task.id)
+            return
+
+        offset = self.output_offsets.get(task.id, 0)
+        if len(task.output) > offset:
+            chunk_id = self.datastore.insert('tasks.output', {
+                'task_id': task.id,
+                'offset': offset,
+                'data': task.output[offset:]
+            })
+
+            self.output_chunks.setdefault(task.id, []).append(chunk_id)
+            self.output_offsets[task.id] = len(task.output)
+
+        state['output'] = None
+        self.datastore.update('tasks', task.id, state)
+
+    def drop_output_chunks(self, id):
+        self.output_offsets.pop(id, None)
+        for i in self.output_chunks.pop(id, []):
+            self.datastore.delete('tasks.output', i)
+
+    def collect_output(self, id):
+        if not self.datastore.collection_exists('tasks.output'):
+            return ''
+
+        chunks = self.datastore.query('tasks.output', ('task_id', '=', id), sort='offset')
+        for i in chunks:
+            self.datastore.delete('tasks.output', i['id'])
+
+        return ''.join(i['data'] for i in chunks)
+
+    def flush_thread(self):
+        while True:
+            gevent.sleep(TASK_FLUSH_INTERVAL)
+            if self.pending:
+                self.flush()
+
+
 class Task(object):
     def __init__(self, dispatcher, name=None):
         self.dispatcher = dispatcher
@@ -404,9 +496,9 @@ class Task(object):
         try:
             self.balancer.assign_executor(self)
         except OverflowError:
-            self.set_state(TaskState.FAILED, error='Out of executors')
-            self.ended.set()
-            self.balancer.task_exited(self)
+            # Pool is at its maximum, task starts once an executor gets idle
+            self.balancer.queue_for_executor(self)
+            return
 
         # Start actual task
         return gevent.spawn(self.executor.run, self)
@@ -439,7 +531,10 @@ class Task(object):
                 self.progress = TaskStatus(0)
 
             self.dispatcher.dispatch_event('task.created' if self.state == TaskState.CREATED else 'task.updated', event)
-            self.dispatcher.datastore_log.update('tasks', self.id, self)
+            self.balancer.task_writer.update(
+                self,
+                flush=self.state in (TaskState.FINISHED, TaskState.FAILED, TaskState.ABORTED)
+            )
             self.dispatcher.dispatch_event('task.changed', {
                 'operation': 'create' if state == TaskState.CREATED else 'update',
                 'ids': [self.id]
@@ -450,29 +545,23 @@ class Task(object):
                 self.__emit_progress()
 
             if self.state in (TaskState.FINISHED, TaskState.FAILED, TaskState.ABORTED):
-                try:
-                    # Remove all subtasks
-                    for i in filter(lambda t: t.parent is self, self.balancer.task_list):
-                        self.balancer.task_list.remove(i)
-
-                    # If top-level task, also remove self
-                    if self.parent is None:
-                        self.balancer.task_list.remove(self)
-                except ValueError:
-                    # failed in verify stage
-                    pass
+                self.balancer.remove_task(self)
 
     def set_env(self, key, value):
         self.environment[key] = value
-        self.dispatcher.datastore_log.update('tasks', self.id, self)
+        self.balancer.task_writer.update(self)
 
     def set_output(self, output):
         self.output = output
-        self.dispatcher.datastore_log.update('tasks', self.id, self)
+        self.balancer.task_writer.update(self, output_reset=True)
+
+    def append_output(self, output):
+        self.output += output
+        self.balancer.task_writer.update(self)
 
     def add_warning(self, warning):
         self.warnings.append(warning)
-        self.dispatcher.datastore_log.update('tasks', self.id, self)
+        self.balancer.task_writer.update(self)
         self.dispatcher.dispatch_event('task.changed', {
             'operation': 'update',
             'ids': [self.id]
@@ -494,11 +583,23 @@ class Task(object):
 class Balancer(object):
     def __init__(self, dispatcher):
         self.dispatcher = dispatcher
-        self.task_list = []
+        self.task_index = {}
+        self.subtask_index = {}
+        self.finished_tasks = collections.OrderedDict()
         self.task_queue = Queue()
+        self.waiting_tasks = collections.OrderedDict()
+        self.executing_tasks = set()
+        self.resource_waiters = {}
         self.resource_graph = dispatcher.resource_graph
+        self.task_writer = TaskLogWriter(dispatcher)
         self.threads = []
         self.executors = []
+        self.executor_index = 0
+        self.executors_min = 0
+        self.executors_max = None
+        self.executors_spare = 0
+        self.executors_idle_timeout = 0
+        self.executor_waiters = collections.deque()
         self.logger = logging.getLogger('Balancer')
         self.dispatcher.require_collection('tasks', 'serial', type='log')
         self.create_initial_queues()
@@ -506,6 +607,9 @@ class Balancer(object):
         self.distribution_lock = RLock()
         self.debugger = None
         self.debugged_tasks = None
+        self.validators = {}
+        self.validator_hits = 0
+        self.validator_misses = 0
         self.dispatcher.register_event_type('task.changed')
 
     def clean_stale_tasks(self):
@@ -524,6 +628,7 @@ class Balancer(object):
 
             stale_task.update({
                 'state': 'FAILED',
+                'output': (stale_task.get('output') or '') + self.task_writer.collect_output(stale_task['id']),
                 'error': {
                     'type': 'TaskException',
                     'message': 'dispatcher process died',
@@ -539,14 +644,62 @@ class Balancer(object):
         self.resource_graph.add_resource(Resource('system'))
 
     def start_executors(self):
-        for i in range(0, max(get_sysctl("hw.ncpu"), 2)):
-            self.logger.info('Starting task executor #{0}...'.format(i))
-            self.executors.append(TaskExecutor(self, i))
+        configstore = self.dispatcher.configstore
+        self.executors_min = configstore.get('middleware.executors_min') or max(get_sysctl("hw.ncpu"), 2)
+        self.executors_max = configstore.get('middleware.executors_max') or EXECUTORS_MAX_DEFAULT
+        self.executors_spare = configstore.get('middleware.executors_spare') or 0
+        self.executors_idle_timeout = configstore.get('middleware.executors_idle_timeout') or 300
+
+        self.executors_max = max(self.executors_max, self.executors_min)
+
+        for i in range(0, self.executors_min):
+            self.spawn_executor()
+
+    def spawn_executor(self):
+        index = self.executor_index
+        self.executor_index += 1
+        self.logger.info('Starting task executor #{0}...'.format(index))
+        executor = TaskExecutor(self, index)
+        self.executors.append(executor)
+        return executor
+
+    def ensure_spare_executors(self):
+        # Pre-fork executors so bursts of tasks don't have to wait for a worker to start.
+        # Executors claimed by a pending assignment or queued tasks aren't spare.
+        spare = len([
+            i for i in self.executors
+            if i.state in (WorkerState.IDLE, WorkerState.STARTING) and not i.claimed
+        ]) - len(self.executor_waiters)
+
+        while spare < self.executors_spare:
+            if self.executors_max and len(self.executors) >= self.executors_max:
+                break
+
+            self.spawn_executor()
+            spare += 1
+
+    def reap_executors(self):
+        while True:
+            gevent.sleep(EXECUTOR_REAP_INTERVAL)
+            now = time.monotonic()
+            idle = [i for i in self.executors if i.state == WorkerState.IDLE and not i.claimed]
+            excess = min(len(idle) - self.executors_spare, len(self.executors) - self.executors_min)
+
+            for i in sorted(idle, key=lambda e: e.idle_since)[:max(excess, 0)]:
+                with i.cv:
+                    if i.state != WorkerState.IDLE or now - i.idle_since < self.executors_idle_timeout:
+                        continue
+
+                    self.logger.info('Reaping idle task executor #{0}'.format(i.index))
+                    self.executors.remove(i)
+                    i.die()
 
     def start(self):
         self.clean_stale_tasks()
         self.start_executors()
+        self.task_writer.start()
         self.threads.append(gevent.spawn(self.distribution_thread))
+        self.threads.append(gevent.spawn(self.reap_executors))
         self.logger.info("Started")
 
     def schema_to_list(self, schema):
@@ -557,17 +710,42 @@ class Balancer(object):
             'maxItems': len(schema)
         }
 
-    def verify_schema(self, clazz, args, strict=False):
+    def get_validator(self, clazz, strict=False):
+        key = (clazz, strict)
+        val = self.validators.get(key)
+        if val is not None:
+            self.validator_hits += 1
+            return val
+
+        self.validator_misses += 1
         params_schema = clazz._get_schema()
         if not params_schema:
-            return []
-
-        schema = self.schema_to_list(params_schema)
-        val = validator.create_validator(schema, resolver=self.dispatcher.rpc.get_schema_resolver(schema))
-        if strict:
-            val.fail_read_only = True
+            val = False
         else:
-            val.remove_read_only = True
+            schema = self.schema_to_list(params_schema)
+            val = validator.create_validator(schema, resolver=self.dispatcher.rpc.get_schema_resolver(schema))
+            if strict:
+                val.fail_read_only = True
+            else:
+                val.remove_read_only = True
+
+        self.validators[key] = val
+        return val
+
+    def invalidate_validators(self):
+        self.validators.clear()
+
+    def get_validator_stats(self):
+        return {
+            'size': len(self.validators),
+            'hits': self.validator_hits,
+            'misses': self.validator_misses
+        }
+
+    def verify_schema(self, clazz, args, strict=False):
+        val = self.get_validator(clazz, strict)
+        if not val:
+            return []
 
         return list(val.iter_errors(args))
 
@@ -602,6 +780,7 @@ class Balancer(object):
         task.id = self.dispatcher.datastore_log.insert("tasks", task)
         task.environment['SENDER_ADDRESS'] = sender.client_address
         task.environment['ID'] = task.id
+        self.add_task(task)
         task.set_state(TaskState.CREATED)
         self.task_queue.put(task)
         self.logger.info("Task %d submitted (type: %s, class: %s)", task.id, name, task.clazz)
@@ -693,8 +872,9 @@ class Balancer(object):
                 if fnmatch.fnmatch(name, m):
                     task.debugger = self.debugger
 
+        self.add_task(task)
         task.set_state(TaskState.CREATED)
-        self.task_list.append(task)
+        self.executing_tasks.add(task)
 
         task.start()
         return task
@@ -726,31 +906,115 @@ class Balancer(object):
                 task.set_state(TaskState.ABORTED, TaskStatus(0, "Aborted"))
                 self.logger.debug("Task ID: %d, name: %s aborted by user", task.id, task.name)
 
+            if task in self.executor_waiters:
+                # Task already holds its resources, release them
+                self.executor_waiters.remove(task)
+                self.task_exited(task)
+
+    def add_task(self, task):
+        self.task_index[task.id] = task
+        if task.parent:
+            self.subtask_index.setdefault(task.parent.id, collections.OrderedDict())[task.id] = task
+
+    def remove_task(self, task):
+        with self.schedule_lock:
+            self.executing_tasks.discard(task)
+            self.unblock_task(task)
+
+        # Remove all subtasks
+        for i in list(self.subtask_index.pop(task.id, {}).values()):
+            self.retire_task(i)
+
+        # If top-level task or parent is already gone, also remove self.
+        # Otherwise it stays around until parent ends, so parent can join it.
+        if task.parent is None or task.parent.id not in self.task_index:
+            self.retire_task(task)
+
+    def retire_task(self, task):
+        if self.task_index.pop(task.id, None) is None:
+            return
+
+        self.finished_tasks[task.id] = task
+        while len(self.finished_tasks) > FINISHED_TASKS_SIZE:
+            self.finished_tasks.popitem(last=False)
+
+    def block_task(self, task):
+        self.waiting_tasks[task.id] = task
+        for r in task.resources:
+            self.resource_waiters.setdefault(r, collections.OrderedDict())[task.id] = task
+
+    def unblock_task(self, task):
+        self.waiting_tasks.pop(task.id, None)
+        for r in task.resources:
+            waiters = self.resource_waiters.get(r)
+            if waiters is None:
+                continue
+
+            waiters.pop(task.id, None)
+            if not waiters:
+                del self.resource_waiters[r]
+
+    def get_resource_waiters(self, names):
+        # Releasing a resource can only unblock tasks waiting on that resource
+        # or on one of its ancestors
+        affected = set(names)
+        for name in names:
+            affected.update(self.resource_graph.get_resource_ancestors(name))
+
+        result = {}
+        for name in affected:
+            result.update(self.resource_waiters.get(name, {}))
+
+        return list(result.values())
+
+    def resources_changed(self):
+        # Graph shape changed, so any waiting task could be affected
+        if self.waiting_tasks:
+            self.schedule_tasks()
+
     def task_exited(self, task):
-        self.resource_graph.release(*task.resources)
-        self.schedule_tasks(True)
+        with self.schedule_lock:
+            self.executing_tasks.discard(task)
+            self.resource_graph.release(*task.resources)
+            self.schedule_tasks(self.get_resource_waiters(task.resources), True)
+
+        self.start_executor_waiters()
 
-    def schedule_tasks(self, exit=False):
+    def schedule_tasks(self, candidates=None, exit=False):
         """
         This function is called when:
-        1) any new task is submitted to any of the queues
-        2) any task exists
+        1) any new task is submitted to any of the queues (with just that task as candidate)
+        2) any task exits (with tasks waiting on released resources as candidates)
+        3) resource graph changes (with all waiting tasks as candidates)
         """
         with self.schedule_lock:
             started = 0
-            executing_tasks = [t for t in self.task_list if t.state == TaskState.EXECUTING]
-            waiting_tasks = [t for t in self.task_list if t.state == TaskState.WAITING]
+            if candidates is None:
+                candidates = list(self.waiting_tasks.values())
+
+            # Acquiring only makes other resources busier, so a resource set
+            # that failed once won't succeed again during this pass
+            blocked = set()
+            for task in sorted(candidates, key=lambda t: t.id):
+                if task.state != TaskState.WAITING or task in self.executing_tasks:
+                    continue
+
+                key = tuple(task.resources)
+                if key in blocked or not self.resource_graph.can_acquire(*key):
+                    blocked.add(key)
+                    if task.id not in self.waiting_tasks:
+                        self.block_task(task)
 
-            for task in waiting_tasks:
-                if not self.resource_graph.can_acquire(*task.resources):
                     continue
 
+                self.unblock_task(task)
                 self.resource_graph.acquire(*task.resources)
-                self.threads.append(task.start())
+                self.executing_tasks.add(task)
+                task.start()
                 started += 1
 
-            if not started and not executing_tasks and (exit or len(waiting_tasks) == 1):
-                for task in waiting_tasks:
+            if not started and not self.executing_tasks and (exit or len(self.waiting_tasks) == 1):
+                for task in list(self.waiting_tasks.values()):
                     # Check whether or not task waits on nonexistent resources. If it does,
                     # abort it 'cause there's no chance anymore that missing resources will appear.
                     missing_resources = [r for r in task.resources if self.resource_graph.get_resource(r) is None]
@@ -798,36 +1062,60 @@ class Balancer(object):
                 continue
 
             task.set_state(TaskState.WAITING)
-            self.task_list.append(task)
             self.distribution_lock.release()
-            self.schedule_tasks()
+            self.schedule_tasks([task])
             if task.resources:
                 self.logger.debug("Task %d assigned to resources %s", task.id, ','.join(task.resources))
 
     def assign_executor(self, task):
-        for i in self.executors:
+        for i in list(self.executors):
             with i.cv:
-                if i.state == WorkerState.IDLE:
+                if i.state == WorkerState.IDLE and not i.claimed:
                     self.logger.info("Task %d assigned to executor #%d", task.id, i.index)
                     task.executor = i
                     i.state = WorkerState.ASSIGNED
+                    self.ensure_spare_executors()
                     return
 
+        # Subtasks may spawn executors over the limit, their parents would
+        # otherwise hold all the executors while waiting for them
+        if self.executors_max and len(self.executors) >= self.executors_max and not task.parent:
+            raise OverflowError('Out of executors')
+
         # Out of executors! Need to spawn new one
-        executor = TaskExecutor(self, len(self.executors))
-        self.executors.append(executor)
+        executor = self.spawn_executor()
+        executor.claimed = True
+
         with executor.cv:
             executor.cv.wait_for(lambda: executor.state == WorkerState.IDLE)
             executor.state = WorkerState.ASSIGNED
+            executor.claimed = False
             task.executor = executor
             self.logger.info("Task %d assigned to executor #%d", task.id, executor.index)
 
+        self.ensure_spare_executors()
+
+    def queue_for_executor(self, task):
+        self.logger.debug("Task %d waiting for an executor", task.id)
+        self.executor_waiters.append(task)
+
+    def start_executor_waiters(self):
+        while self.executor_waiters:
+            task = self.executor_waiters[0]
+            try:
+                self.assign_executor(task)
+            except OverflowError:
+                return
+
+            self.executor_waiters.popleft()
+            gevent.spawn(task.executor.run, task)
+
     def dispose_executors(self):
         for i in self.executors:
             i.die()
 
     def get_active_tasks(self):
-        return [x for x in self.task_list if x.state in (
+        return [x for x in self.task_index.values() if x.state in (
             TaskState.CREATED,
             TaskState.WAITING,
             TaskState.EXECUTING
@@ -835,19 +1123,24 @@ class Balancer(object):
 
     def get_tasks(self, type=None):
         if type is None:
-            return self.task_list
+            return list(self.task_index.values())
 
-        return [x for x in self.task_list if x.state == type]
+        return [x for x in self.task_index.values() if x.state == type]
 
     def get_task(self, id):
-        self.distribution_lock.acquire()
-        t = first_or_default(lambda x: x.id == id, self.task_list)
-        if not t:
-            t = first_or_default(lambda x: x.id == id, self.task_queue.queue)
+        t = self.task_index.get(id)
+        if t:
+            return t
+
+        t = self.finished_tasks.get(id)
+        if t:
+            self.finished_tasks.move_to_end(id)
 
-        self.distribution_lock.release()
         return t
 
+    def get_subtasks(self, task):
+        return list(self.subtask_index.get(task.id, {}).values())
+
     def get_executor_by_key(self, key):
         return first_or_default(lambda t: t.key == key, self.executors)
 
@@ -25,13 +25,28 @@
 #
 #####################################################################
 
+import time
+import gevent
+import builtins
+import itertools
+import contextlib
+from collections import OrderedDict
 from gevent.event import Event
 from gevent.lock import RLock
-from freenas.utils.query import query, set
+from freenas.utils.query import query, get, set
 from sortedcontainers import SortedDict
 
 
 class CacheStore(object):
+    """
+    Sorted key-value cache with optional secondary indexes.
+
+    `indexes` is a list of field paths (eg. 'pool' or 'properties.origin.value')
+    maintained on every put/update/remove. query() uses them, along with the
+    store key itself when `key_field` is given, for '=' and 'in' filters and
+    only scans the matching items. Indexed fields must only be modified through
+    the CacheStore methods, not by mutating cached objects in place.
+    """
     class CacheItem(object):
         __slots__ = ('valid', 'data')
 
@@ -39,15 +54,55 @@ class CacheStore(object):
             self.valid = Event()
             self.data = None
 
-    def __init__(self, key=None):
+    def __init__(self, key=None, indexes=None, key_field=None):
         self.lock = RLock()
+        self.key = key
+        self.key_field = key_field
         self.store = SortedDict(key)
+        self.indexes = {i: {} for i in indexes or []}
+        self.unhashable = {i: builtins.set() for i in indexes or []}
+        self.indexed_values = {}
 
     def __getitem__(self, item):
         return self.get(item)
 
+    def __index(self, key, data):
+        if not self.indexes:
+            return
+
+        self.__unindex(key)
+        values = {}
+        for field, index in self.indexes.items():
+            value = get(data, field)
+            try:
+                index.setdefault(value, builtins.set()).add(key)
+            except TypeError:
+                self.unhashable[field].add(key)
+
+            values[field] = value
+
+        self.indexed_values[key] = values
+
+    def __unindex(self, key):
+        values = self.indexed_values.pop(key, None)
+        if values is None:
+            return
+
+        for field, value in values.items():
+            self.unhashable[field].discard(key)
+            try:
+                keys = self.indexes[field].get(value)
+            except TypeError:
+                continue
+
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.indexes[field][value]
+
     def put(self, key, data):
         with self.lock:
+            self.__index(key, data)
             try:
                 item = self.store[key]
                 item.data = data
@@ -75,6 +130,7 @@ class CacheStore(object):
                     self.store[k] = item = self.CacheItem()
                     created.append(k)
 
+                self.__index(k, v)
                 item.data = v
                 item.valid.set()
 
@@ -95,10 +151,9 @@ class CacheStore(object):
     def update_many(self, key, predicate, **kwargs):
         with self.lock:
             updated = []
-            for k, v in self.itervalid():
-                if predicate(v):
-                    if self.update_one(k, **kwargs):
-                        updated.append(key)
+            for k, v in self.itermatching(predicate):
+                if self.update_one(k, **kwargs):
+                    updated.append(k)
 
             return updated
 
@@ -114,6 +169,7 @@ class CacheStore(object):
         with self.lock:
             try:
                 del self.store[key]
+                self.__unindex(key)
                 return True
             except KeyError:
                 return False
@@ -124,6 +180,7 @@ class CacheStore(object):
             for key in keys:
                 try:
                     del self.store[key]
+                    self.__unindex(key)
                     removed.append(key)
                 except KeyError:
                     pass
@@ -134,6 +191,11 @@ class CacheStore(object):
         with self.lock:
             items = list(self.store.keys())
             self.store.clear()
+            self.indexed_values.clear()
+            for field in self.indexes:
+                self.indexes[field].clear()
+                self.unhashable[field].clear()
+
             return items
 
     def exists(self, key):
@@ -176,32 +238,214 @@ class CacheStore(object):
                 yield value.data
 
     def remove_predicate(self, predicate):
-        result = []
-        for k, v in self.itervalid():
-            if predicate(v):
-                self.remove(k)
-                result.append(k)
+        with self.lock:
+            return self.remove_many([k for k, v in self.itermatching(predicate)])
+
+    def plan(self, filter):
+        """
+        Returns set of keys that can possibly match given query filter,
+        or None if filter can't be answered from the indexes.
+        """
+        candidates = None
+        for f in filter:
+            if len(f) != 3:
+                continue
+
+            field, op, value = f
+            if op not in ('=', 'in'):
+                continue
+
+            values = [value] if op == '=' else value
+            if not isinstance(values, (list, tuple)):
+                continue
+
+            try:
+                if field == self.key_field:
+                    keys = builtins.set(v for v in values if v in self.store)
+                elif field in self.indexes:
+                    index = self.indexes[field]
+                    keys = builtins.set(self.unhashable[field])
+                    for v in values:
+                        keys.update(index.get(v, ()))
+                else:
+                    continue
+            except TypeError:
+                continue
 
-        return result
+            candidates = keys if candidates is None else candidates & keys
+
+        return candidates
+
+    def itercandidates(self, keys):
+        if self.key:
+            keys = sorted(keys, key=self.key)
+        else:
+            keys = sorted(keys)
+
+        for key in keys:
+            value = self.store.get(key)
+            if value and value.valid.is_set():
+                yield (key, value.data)
+
+    def itermatching(self, predicate):
+        """
+        Iterates over valid items matching predicate, which is either a callable
+        or a list of query filters (which makes use of the indexes).
+        """
+        if callable(predicate):
+            return ((k, v) for k, v in self.itervalid() if predicate(v))
+
+        candidates = self.plan(predicate)
+        items = self.itervalid() if candidates is None else self.itercandidates(candidates)
+        return ((k, v) for k, v in items if query([v], *predicate, single=True) is not None)
 
     def query(self, *filter, **params):
+        candidates = self.plan(filter)
+        if candidates is not None:
+            return query([v for _, v in self.itercandidates(candidates)], *filter, **params)
+
+        sort = params.get('sort')
+        if isinstance(sort, (list, tuple)) and len(sort) == 1:
+            sort = sort[0]
+
+        if self.key_field and not self.key and sort in (self.key_field, '-' + self.key_field):
+            # Store is already sorted by key
+            params = dict(params)
+            del params['sort']
+            values = self.validvalues()
+            if sort.startswith('-'):
+                values = (v.data for v in reversed(self.store.values()) if v.valid.is_set())
+
+            if not filter and not params.get('count') and (params.get('limit') or params.get('offset')):
+                offset = params.pop('offset', None) or 0
+                limit = params.pop('limit', None)
+                values = itertools.islice(values, offset, offset + limit if limit else None)
+
+            return query(list(values), *filter, **params)
+
         return query(list(self.validvalues()), *filter, **params)
 
 
+class EventBatch(object):
+    """
+    Changes of an EventCacheStore accumulated inside batch() blocks of a
+    single greenlet.
+    """
+    def __init__(self, window=None):
+        self.depth = 0
+        self.window = window
+        self.started = time.monotonic()
+        self.deleted = OrderedDict()
+        self.renamed = OrderedDict()
+        self.changed = OrderedDict()
+
+    @property
+    def expired(self):
+        return self.window is not None and time.monotonic() - self.started >= self.window
+
+    def take(self):
+        deleted = list(self.deleted)
+        renamed = [[o, n] for n, o in self.renamed.items()]
+        created = [k for k, v in self.changed.items() if v == 'create']
+        updated = [k for k, v in self.changed.items() if v == 'update']
+        self.deleted.clear()
+        self.renamed.clear()
+        self.changed.clear()
+        self.started = time.monotonic()
+        return (('delete', deleted), ('rename', renamed), ('create', created), ('update', updated))
+
+    def record(self, operation, ids):
+        for i in ids:
+            if operation == 'create':
+                if self.deleted.pop(i, None):
+                    self.changed[i] = 'update'
+                else:
+                    self.changed.setdefault(i, 'create')
+
+            elif operation == 'update':
+                self.changed.setdefault(i, 'update')
+
+            elif operation == 'delete':
+                if self.changed.pop(i, None) == 'create':
+                    continue
+
+                self.deleted[self.renamed.pop(i, i)] = True
+
+            elif operation == 'rename':
+                old, new = i
+                change = self.changed.pop(old, None)
+                if change == 'create':
+                    self.changed[new] = 'create'
+                    continue
+
+                orig = self.renamed.pop(old, old)
+                if orig != new:
+                    self.renamed[new] = orig
+
+                if change:
+                    self.changed[new] = change
+
+
 class EventCacheStore(CacheStore):
-    def __init__(self, dispatcher, name, key=None):
-        super(EventCacheStore, self).__init__(key=key)
+    """
+    CacheStore emitting `<name>.changed` events on every modification.
+
+    Inside a batch() block changes made by the same greenlet are accumulated
+    and merged, so that at most one event per operation type is emitted when
+    the outermost batch ends (or every `window` seconds, if given). Merged
+    events are emitted in delete, rename, create, update order, which keeps
+    them consistent regardless of how operations on the same ids were
+    interleaved. Changes made by other greenlets meanwhile are emitted
+    right away.
+    """
+    def __init__(self, dispatcher, name, key=None, indexes=None):
+        super(EventCacheStore, self).__init__(key=key, indexes=indexes, key_field='id')
         self.dispatcher = dispatcher
         self.ready = False
         self.name = name
+        self.batches = {}
+
+    @contextlib.contextmanager
+    def batch(self, window=None):
+        current = gevent.getcurrent()
+        batch = self.batches.get(current)
+        if batch is None:
+            batch = self.batches[current] = EventBatch(window)
+
+        batch.depth += 1
+        try:
+            yield self
+        finally:
+            batch.depth -= 1
+            if batch.depth == 0:
+                del self.batches[current]
+                self.flush_batch(batch)
+
+    def flush_batch(self, batch):
+        for operation, ids in batch.take():
+            if ids:
+                self.dispatcher.emit_event(f'{self.name}.changed', {
+                    'operation': operation,
+                    'ids': ids
+                })
+
+    def __emit(self, operation, ids):
+        batch = self.batches.get(gevent.getcurrent())
+        if batch is None:
+            self.dispatcher.emit_event(f'{self.name}.changed', {
+                'operation': operation,
+                'ids': ids
+            })
+            return
+
+        batch.record(operation, ids)
+        if batch.expired:
+            self.flush_batch(batch)
 
     def put(self, key, data):
         ret = super(EventCacheStore, self).put(key, data)
         if self.ready:
-            self.dispatcher.emit_event(f'{self.name}.changed', {
-                'operation': 'create' if ret else 'update',
-                'ids': [key]
-            })
+            self.__emit('create' if ret else 'update', [key])
 
         return ret
 
@@ -209,59 +453,38 @@ class EventCacheStore(CacheStore):
         created, updated = super(EventCacheStore, self).update(**kwargs)
         if self.ready:
             if created:
-                self.dispatcher.emit_event(f'{self.name}.changed', {
-                    'operation': 'create',
-                    'ids': created
-                })
+                self.__emit('create', created)
             if updated:
-                self.dispatcher.emit_event(f'{self.name}.changed', {
-                    'operation': 'update',
-                    'ids': updated
-                })
+                self.__emit('update', updated)
 
         return created, updated
 
     def update_one(self, key, **kwargs):
         if super(EventCacheStore, self).update_one(key, **kwargs):
-            self.dispatcher.emit_event(f'{self.name}.changed', {
-                'operation': 'update',
-                'ids': [key]
-            })
+            self.__emit('update', [key])
 
     def update_many(self, key, predicate, **kwargs):
         updated = super(EventCacheStore, self).update_many(key, predicate, **kwargs)
-        self.dispatcher.emit_event(f'{self.name}.changed', {
-            'operation': 'update',
-            'ids': updated
-        })
+        self.__emit('update', updated)
 
     def remove(self, key):
         ret = super(EventCacheStore, self).remove(key)
         if ret and self.ready:
-            self.dispatcher.emit_event(f'{self.name}.changed', {
-                'operation': 'delete',
-                'ids': [key]
-            })
+            self.__emit('delete', [key])
 
         return ret
 
     def remove_many(self, keys):
         ret = super(EventCacheStore, self).remove_many(keys)
         if ret and self.ready:
-            self.dispatcher.emit_event(f'{self.name}.changed', {
-                'operation': 'delete',
-                'ids': ret
-            })
+            self.__emit('delete', ret)
 
         return ret
 
     def clear(self):
         ret = super(EventCacheStore, self).clear()
         if ret and self.ready:
-            self.dispatcher.emit_event(f'{self.name}.changed', {
-                'operation': 'delete',
-                'ids': ret
-            })
+            self.__emit('delete', ret)
 
         return ret
 
@@ -276,21 +499,17 @@ class EventCacheStore(CacheStore):
             super(EventCacheStore, self).remove(oldkey)
 
         if self.ready:
-            self.dispatcher.emit_event(f'{self.name}.changed', {
-                'operation': 'rename',
-                'ids': [[oldkey, newkey]]
-            })
+            self.__emit('rename', [[oldkey, newkey]])
 
         return True
 
     def rename_many(self, pairs):
-        # XXX: not sending bulk rename event because GUI doesn't support them yet
-        with self.lock:
+        with self.lock, self.batch():
             for o, n in pairs:
                 self.rename(o, n)
 
     def propagate(self, event, callback=None):
-        with self.lock:
+        with self.lock, self.batch():
             if event['operation'] == 'delete':
                 self.remove_many(event['ids'])
                 return
@@ -303,7 +522,7 @@ class EventCacheStore(CacheStore):
                 self.update(**{i['id']: (callback(i) if callback else i) for i in event['entities']})
 
     def populate(self, collection, callback=None):
-        with self.lock:
+        with self.lock, self.batch():
             for i in collection:
                 obj = callback(i) if callback else i
                 if obj is not None:
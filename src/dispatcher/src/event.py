@@ -26,7 +26,14 @@
 #####################################################################
 
 
+import re
 import logging
+from bsd import fnmatch as cfnmatch
+from gevent.lock import RLock
+
+
+WILDCARD_CHARS = '*?[\\'
+MATCH_CACHE_SIZE = 4096
 
 
 class EventSource(object):
@@ -51,3 +58,115 @@ class EventSource(object):
 def sync(fn):
     fn.sync = True
     return fn
+
+
+class EventSubscriptionIndex(object):
+    """
+    Maps event names to subscribers (client connections).
+
+    Masks without wildcard characters are kept in a plain name->subscribers
+    map. Wildcard masks are grouped by their literal prefix (the part before
+    the first wildcard character), so matching an event only has to fnmatch
+    masks whose prefix is also a prefix of the event name. Results are
+    cached per event name until subscriptions change.
+    """
+    def __init__(self):
+        self.exact = {}
+        self.wildcard = {}
+        self.subscriptions = {}
+        self.match_cache = {}
+        self.lock = RLock()
+
+    @staticmethod
+    def split_mask(mask):
+        if not isinstance(mask, str):
+            return None, ''
+
+        for idx, ch in enumerate(mask):
+            if ch in WILDCARD_CHARS:
+                return None, mask[:idx]
+
+        return mask, None
+
+    @staticmethod
+    def match_mask(name, mask):
+        if isinstance(mask, str):
+            return cfnmatch(name, mask)
+
+        if isinstance(mask, re._pattern_type):
+            return mask.match(name) is not None
+
+        return False
+
+    def subscribe(self, subscriber, masks):
+        with self.lock:
+            current = self.subscriptions.setdefault(subscriber, set())
+            for mask in set(masks) - current:
+                exact, prefix = self.split_mask(mask)
+                if exact is not None:
+                    self.exact.setdefault(exact, set()).add(subscriber)
+                else:
+                    self.wildcard.setdefault(prefix, {}).setdefault(mask, set()).add(subscriber)
+
+                current.add(mask)
+
+            self.match_cache.clear()
+
+    def unsubscribe(self, subscriber, masks):
+        with self.lock:
+            current = self.subscriptions.get(subscriber)
+            if not current:
+                return
+
+            for mask in set(masks) & current:
+                exact, prefix = self.split_mask(mask)
+                if exact is not None:
+                    subscribers = self.exact[exact]
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del self.exact[exact]
+                else:
+                    group = self.wildcard[prefix]
+                    group[mask].discard(subscriber)
+                    if not group[mask]:
+                        del group[mask]
+
+                    if not group:
+                        del self.wildcard[prefix]
+
+                current.remove(mask)
+
+            if not current:
+                del self.subscriptions[subscriber]
+
+            self.match_cache.clear()
+
+    def remove(self, subscriber):
+        with self.lock:
+            self.unsubscribe(subscriber, self.subscriptions.get(subscriber, ()))
+
+    def match(self, name):
+        result = self.match_cache.get(name)
+        if result is not None:
+            return result
+
+        with self.lock:
+            matched = set(self.exact.get(name, ()))
+            for i in range(len(name) + 1):
+                group = self.wildcard.get(name[:i])
+                if not group:
+                    continue
+
+                for mask, subscribers in group.items():
+                    if subscribers <= matched:
+                        continue
+
+                    if self.match_mask(name, mask):
+                        matched |= subscribers
+
+            result = tuple(matched)
+            if len(self.match_cache) >= MATCH_CACHE_SIZE:
+                self.match_cache.clear()
+
+            self.match_cache[name] = result
+            return result
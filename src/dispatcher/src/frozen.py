@@ -0,0 +1,147 @@
+#+
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+import copy
+import datetime
+
+
+IMMUTABLE_TYPES = (str, bytes, int, float, bool, type(None), datetime.datetime, datetime.date)
+
+
+def readonly(*args, **kwargs):
+    raise TypeError('Object is read-only, use copy.deepcopy() or thaw() to get a mutable copy')
+
+
+class FrozenDict(dict):
+    """
+    Read-only dict sharing its values with the object it was created from.
+    Nested containers are frozen lazily, on first access.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if type(value) in (dict, list):
+            value = freeze(value)
+            dict.__setitem__(self, key, value)
+
+        return value
+
+    def __iter__(self):
+        # Overriding __iter__ forces dict(), {**d} and friends through
+        # keys() and __getitem__, so they can't reach unfrozen values
+        return dict.__iter__(self)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+
+        return default
+
+    def items(self):
+        return [(k, self[k]) for k in dict.keys(self)]
+
+    def values(self):
+        return [self[k] for k in dict.keys(self)]
+
+    def copy(self):
+        return thaw(self)
+
+    def __copy__(self):
+        return thaw(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return dict, (thaw(self),)
+
+    __setitem__ = __delitem__ = readonly
+    clear = pop = popitem = setdefault = update = __ior__ = readonly
+
+
+class FrozenList(list):
+    """
+    Read-only list. Items are frozen when the list is created, nested
+    containers below them are frozen lazily.
+    """
+    __slots__ = ()
+
+    def __init__(self, iterable=()):
+        list.__init__(self, (freeze(i) for i in iterable))
+
+    def copy(self):
+        return thaw(self)
+
+    def __copy__(self):
+        return thaw(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return list, (thaw(self),)
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = readonly
+    append = extend = insert = pop = remove = reverse = sort = clear = readonly
+
+
+def freeze(obj):
+    """
+    Returns read-only view of obj. Only the top level is copied (shallowly),
+    so freezing is cheap regardless of how large the object is.
+    """
+    t = type(obj)
+    if t is dict:
+        return FrozenDict(obj)
+
+    if t in (list, tuple):
+        return FrozenList(obj)
+
+    return obj
+
+
+def thaw(obj):
+    """
+    Returns mutable deep copy of obj. Faster than copy.deepcopy() for
+    JSON-like data; falls back to it for anything else.
+    """
+    t = type(obj)
+    if t in IMMUTABLE_TYPES:
+        return obj
+
+    if t is dict or t is FrozenDict:
+        return {k: thaw(v) for k, v in dict.items(obj)}
+
+    if t is list or t is FrozenList:
+        return [thaw(i) for i in list.__iter__(obj)]
+
+    if t is tuple:
+        return tuple(thaw(i) for i in obj)
+
+    return copy.deepcopy(obj)
@@ -28,7 +28,6 @@
 import gevent.monkey
 gevent.monkey.patch_all()
 
-import copy
 import os
 import sys
 import re
@@ -75,8 +74,10 @@ from services import ManagementService, DebugService, EventService, TaskService
 from services import LockService, PluginService, ShellService
 from schemas import register_general_purpose_schemas
 from balancer import Balancer
+from event import EventSubscriptionIndex
+from frozen import freeze, thaw
 from auth import PasswordAuthenticator, TokenStore, Token, User, Service
-from freenas.utils import FaultTolerantLogHandler, load_module_from_file, serialize_exception
+from freenas.utils import FaultTolerantLogHandler, load_module_from_file, serialize_exception, first_or_default
 from freenas.utils.trace_logger import TraceLogger, TRACE
 from freenas.serviced import checkin, push_status
 from freenas.logd import LogdLogHandler
@@ -332,6 +333,7 @@ class Dispatcher(object):
         self.event_handlers = {}
         self.hooks = {}
         self.plugins = {}
+        self.plugin_files = {}
         self.threads = []
         self.queues = {}
         self.providers = {}
@@ -342,6 +344,7 @@ class Dispatcher(object):
         self.logger = logging.getLogger('Main')
         self.token_store = TokenStore(self)
         self.event_delivery_lock = RLock()
+        self.event_subscriptions = EventSubscriptionIndex()
         self.rpc = None
         self.balancer = None
         self.datastore = None
@@ -369,7 +372,7 @@ class Dispatcher(object):
         self.logger.info('Initializing')
 
         self.datastore = get_datastore(self.configfile)
-        self.configstore = ConfigStore(self.datastore)
+        self.configstore = ConfigStore(self.datastore, cache=True)
 
         self.logger.info('Connected to datastore')
 
@@ -462,6 +465,8 @@ class Dispatcher(object):
                 self.logger.exception("Error initializing plugin %s: %s", i.filename, err.args)
 
     def reload_plugins(self):
+        self.plugin_files.clear()
+
         # Reload existing modules
         for i in list(self.plugins.values()):
             i.reload()
@@ -516,6 +521,36 @@ class Dispatcher(object):
                     exc_info=True
                 )
 
+    def get_module_file(self, module_name):
+        """
+        Returns path of the file a plugin module was loaded from. Modules not
+        loaded as plugins are looked up in plugin directories once and cached
+        until the next reload_plugins.
+        """
+        def match_file(f):
+            name, ext = os.path.splitext(f)
+            return module_name == name and ext in ['.py', '.pyc', '.so']
+
+        if module_name in self.plugin_files:
+            return self.plugin_files[module_name]
+
+        filename = None
+        for dir in self.plugin_dirs:
+            try:
+                for root, _, files in os.walk(dir):
+                    file = first_or_default(match_file, files)
+                    if file:
+                        filename = os.path.join(root, file)
+                        break
+            except OSError:
+                continue
+
+            if filename:
+                break
+
+        self.plugin_files[module_name] = filename
+        return filename
+
     def __discover_plugin_dir(self, dir):
         for root, dirnames, filenames in os.walk(dir):
             # Skipping disabled plugins, unles explicitly informed to load them
@@ -535,6 +570,7 @@ class Dispatcher(object):
             plugin = Plugin(self, path)
             plugin.assign_module(load_module_from_file(name, path))
             self.plugins[name] = plugin
+            self.plugin_files[name] = path
         except Exception as err:
             self.logger.exception("Cannot load plugin from %s", path)
             self.report_error('Cannot load plugin from {0}'.format(path), err)
@@ -559,9 +595,8 @@ class Dispatcher(object):
             # If there's no timestamp, assume event fired right now
             args.setdefault('timestamp', datetime.datetime.utcnow())
 
-            for srv in self.ws_servers:
-                for conn in srv.connections:
-                    conn.outgoing_events.put((name, args))
+            for conn in self.event_subscriptions.match(name):
+                conn.outgoing_events.put((name, args))
 
         for h in self.event_handlers.get(name, []):
             def wrapper(handler, name):
@@ -647,6 +682,7 @@ class Dispatcher(object):
     def register_task_handler(self, name, clazz):
         self.logger.debug("New task handler: {0}".format(name))
         self.tasks[name] = clazz
+        self.invalidate_validators()
 
     def register_task_alias(self, name, name2):
         self.logger.debug("New task alias: {0} -> {1}".format(name, name2))
@@ -654,6 +690,11 @@ class Dispatcher(object):
 
     def unregister_task_handler(self, name):
         del self.tasks[name]
+        self.invalidate_validators()
+
+    def invalidate_validators(self):
+        if self.balancer:
+            self.balancer.invalidate_validators()
 
     def register_task_hook(self, hook, name, condition=None):
         task_name, hook_name = hook.split(':')
@@ -682,6 +723,7 @@ class Dispatcher(object):
 
     def register_schema_definition(self, name, definition):
         self.rpc.register_schema_definition(name, definition)
+        self.invalidate_validators()
         if self.ready:
             def emit_changed_event():
                 self.dispatch_event('server.schema_document_changed', {
@@ -692,6 +734,7 @@ class Dispatcher(object):
 
     def unregister_schema_definition(self, name):
         self.rpc.unregister_schema_definition(name)
+        self.invalidate_validators()
 
     def require_collection(self, collection, pkey_type='uuid', **kwargs):
         if not self.datastore.collection_exists(collection):
@@ -700,23 +743,32 @@ class Dispatcher(object):
     def register_resource(self, res, parents=None, children=None):
         self.logger.debug('Resource added: {0}'.format(res.name))
         self.resource_graph.add_resource(res, parents, children)
+        self.notify_resources_changed()
 
     def update_resource(self, name, new_parents, new_children=None):
         self.logger.log(TRACE, 'Resource updated: {0}, new parents: {1}'.format(name, ', '.join(new_parents)))
         self.resource_graph.update_resource(name, new_parents, new_children)
+        self.notify_resources_changed()
 
     def rename_resource(self, oldname, newname):
         self.logger.log(TRACE, 'Resource renamed: {0} ->{1}'.format(oldname, newname))
         self.resource_graph.rename_resource(oldname, newname)
+        self.notify_resources_changed()
 
     def unregister_resource(self, name):
         self.logger.debug('Resource removed: {0}'.format(name))
         self.resource_graph.remove_resource(name)
+        self.notify_resources_changed()
 
     def unregister_resources(self, names):
         if names:
             self.logger.debug('Resources removed: {0}'.format(', '.join(names)))
             self.resource_graph.remove_resources(names)
+            self.notify_resources_changed()
+
+    def notify_resources_changed(self):
+        if self.balancer:
+            self.balancer.resources_changed()
 
     def resource_exists(self, name):
         return self.resource_graph.get_resource(name) is not None
@@ -825,6 +877,7 @@ class Dispatcher(object):
         })
 
         self.balancer.dispose_executors()
+        self.balancer.task_writer.flush()
         self.logger.warning('Unloading plugins')
         self.unload_plugins()
 
@@ -873,18 +926,33 @@ class DispatcherRpcContext(RpcContext):
         self.dispatcher = dispatcher
 
     def call_sync(self, name, *args, **kwargs):
+        """
+        Calls RPC method in-process. By default results are deep copied, so
+        callers are free to modify them. Callers only reading the results
+        should pass frozen=True to get read-only views sharing data with the
+        provider instead. no_copy=True returns results as-is and is only safe
+        when neither side modifies them afterwards.
+        """
         no_copy = kwargs.pop('no_copy', False)
+        frozen = kwargs.pop('frozen', False)
+
+        if no_copy:
+            wrap = lambda i: i
+        elif frozen:
+            wrap = freeze
+        else:
+            wrap = thaw
 
         def unpack_chunk(it):
             for chunk in it:
                 for item in chunk:
-                    yield item if no_copy else copy.deepcopy(item)
+                    yield wrap(item)
 
         result = self.dispatch_call(name, list(args), streaming=True, validation=False)
         if hasattr(result, '__next__'):
             return unpack_chunk(result)
 
-        return result if no_copy else copy.deepcopy(result)
+        return wrap(result)
 
 
 class DispatcherConnection(ServerConnection):
@@ -922,8 +990,9 @@ class DispatcherConnection(ServerConnection):
         }
 
     def __event_worker(self):
+        # Events are already filtered by Dispatcher.event_subscriptions
         for name, args in self.outgoing_events:
-            self.emit_event(name, args)
+            self.send_event(name, args)
 
     def log(self, level, msg):
         self.logger.log(level, '[{0}] {1}'.format(self.client_address, msg))
@@ -955,6 +1024,7 @@ class DispatcherConnection(ServerConnection):
 
             self.event_masks.remove(mask)
 
+        self.dispatcher.event_subscriptions.remove(self)
         self.outgoing_events.put(StopIteration)
         self.dispatcher.dispatch_event('server.client_disconnected', {
             'address': self.client_address,
@@ -1000,6 +1070,7 @@ class DispatcherConnection(ServerConnection):
                         ev.incref()
 
             self.event_masks = set.union(self.event_masks, set(event_masks))
+            self.dispatcher.event_subscriptions.subscribe(self, event_masks)
 
     def on_events_unsubscribe(self, id, event_masks):
         if not isinstance(event_masks, list):
@@ -1023,6 +1094,7 @@ class DispatcherConnection(ServerConnection):
                         ev.decref()
 
             self.event_masks = set.difference(self.event_masks, intersecting_unsubscribe_events)
+            self.dispatcher.event_subscriptions.unsubscribe(self, intersecting_unsubscribe_events)
 
     def on_events_event(self, id, data):
         if self.user is None:
@@ -1252,10 +1324,9 @@ class DispatcherConnection(ServerConnection):
 
     def emit_event(self, event, args):
         for i in list(self.event_masks):
-            if not match_event(event, i):
-                continue
-
-            self.send_event(event, args)
+            if match_event(event, i):
+                self.send_event(event, args)
+                return
 
     def emit_rpc_call(self, id, method, args):
         return self.send_call(id, method, args)
@@ -27,6 +27,7 @@
 
 
 import logging
+import contextlib
 import networkx as nx
 from gevent.lock import RLock
 from freenas.utils.trace_logger import TRACE
@@ -36,6 +37,7 @@ class Resource(object):
     def __init__(self, name):
         self.name = name
         self.busy = False
+        self.busy_descendants = 0
 
     def __str__(self):
         return "<Resource '{0}'>".format(self.name)
@@ -55,6 +57,8 @@ class ResourceGraph(object):
         self.root = Resource('root')
         self.resources = nx.DiGraph()
         self.resources.add_node(self.root)
+        self.names = {'root': self.root}
+        self.busy = set()
 
     def lock(self):
         self.mutex.acquire()
@@ -66,54 +70,79 @@ class ResourceGraph(object):
     def nodes(self):
         return self.resources.nodes()
 
+    def __mark_busy(self, resource, delta):
+        for i in nx.ancestors(self.resources, resource):
+            i.busy_descendants += delta
+
+    @contextlib.contextmanager
+    def __restructure(self):
+        # Busy descendant counters depend on graph shape, so take busy
+        # resources out of the counters before modifying edges and put
+        # them back afterwards. Only busy resources are walked.
+        for i in self.busy:
+            self.__mark_busy(i, -1)
+
+        try:
+            yield
+        finally:
+            self.busy = {i for i in self.busy if i in self.resources}
+            for i in self.busy:
+                self.__mark_busy(i, 1)
+
+    def __remove_node(self, resource):
+        for i in nx.descendants(self.resources, resource):
+            self.resources.remove_node(i)
+            self.names.pop(i.name, None)
+
+        self.resources.remove_node(resource)
+        self.names.pop(resource.name, None)
+
     def add_resource(self, resource, parents=None, children=None):
         with self.mutex:
             if not resource:
                 raise ResourceError('Invalid resource')
-    
+
             if self.get_resource(resource.name):
                 raise ResourceError('Resource {0} already exists'.format(resource.name))
-    
-            self.resources.add_node(resource)
-            if not parents:
-                parents = ['root']
-    
-            for p in parents:
-                node = self.get_resource(p)
-                if not node:
-                    continue
-    
-                self.resources.add_edge(node, resource)
-
-            for p in children or []:
-                node = self.get_resource(p)
-                if not node:
-                    raise ResourceError('Invalid child resource {0}'.format(p))
+
+            with self.__restructure():
+                self.resources.add_node(resource)
+                self.names[resource.name] = resource
+                if not parents:
+                    parents = ['root']
+
+                for p in parents:
+                    node = self.get_resource(p)
+                    if not node:
+                        continue
+
+                    self.resources.add_edge(node, resource)
+
+                for p in children or []:
+                    node = self.get_resource(p)
+                    if not node:
+                        raise ResourceError('Invalid child resource {0}'.format(p))
 
     def remove_resource(self, name):
         with self.mutex:
             resource = self.get_resource(name)
-    
+
             if not resource:
                 return
-    
-            for i in nx.descendants(self.resources, resource):
-                self.resources.remove_node(i)
-    
-            self.resources.remove_node(resource)
+
+            with self.__restructure():
+                self.__remove_node(resource)
 
     def remove_resources(self, names):
         with self.mutex:
-            for name in names:
-                resource = self.get_resource(name)
-    
-                if not resource:
-                    return
-    
-                for i in nx.descendants(self.resources, resource):
-                    self.resources.remove_node(i)
-    
-                self.resources.remove_node(resource)
+            with self.__restructure():
+                for name in names:
+                    resource = self.get_resource(name)
+
+                    if not resource:
+                        return
+
+                    self.__remove_node(resource)
 
     def rename_resource(self, oldname, newname):
         with self.mutex:
@@ -122,35 +151,45 @@ class ResourceGraph(object):
             if not resource:
                 return
 
+            del self.names[oldname]
             resource.name = newname
+            self.names[newname] = resource
 
     def update_resource(self, name, new_parents, new_children=None):
         with self.mutex:
             resource = self.get_resource(name)
-    
+
             if not resource:
                 return
-    
-            for i in self.resources.predecessors(resource):
-                self.resources.remove_edge(i, resource)
-    
-            for p in new_parents:
-                node = self.get_resource(p)
-                if not node:
-                    continue
-    
-                self.resources.add_edge(node, resource)
-
-            for p in new_children or []:
-                node = self.get_resource(p)
-                if not node:
-                    raise ResourceError('Invalid child resource {0}'.format(p))
-
-                self.resources.add_edge(resource, node)
+
+            with self.__restructure():
+                for i in list(self.resources.predecessors(resource)):
+                    self.resources.remove_edge(i, resource)
+
+                for p in new_parents:
+                    node = self.get_resource(p)
+                    if not node:
+                        continue
+
+                    self.resources.add_edge(node, resource)
+
+                for p in new_children or []:
+                    node = self.get_resource(p)
+                    if not node:
+                        raise ResourceError('Invalid child resource {0}'.format(p))
+
+                    self.resources.add_edge(resource, node)
 
     def get_resource(self, name):
-        f = [i for i in self.resources.nodes() if i.name == name]
-        return f[0] if len(f) > 0 else None
+        return self.names.get(name)
+
+    def get_resource_ancestors(self, name):
+        res = self.get_resource(name)
+        if not res:
+            return
+
+        for i in nx.ancestors(self.resources, res):
+            yield i.name
 
     def get_resource_dependencies(self, name):
         res = self.get_resource(name)
@@ -163,17 +202,26 @@ class ResourceGraph(object):
 
         with self.mutex:
             self.logger.debug('Acquiring following resources: %s', ','.join(names))
-    
+
+            resources = []
             for name in names:
                 res = self.get_resource(name)
                 if not res:
                     raise ResourceError('Resource {0} not found'.format(name))
-    
-                for i in nx.descendants(self.resources, res):
-                    if i.name not in names and i.busy:
-                        raise ResourceError('Cannot acquire, some of dependent resources are busy')
-    
-                res.busy = True
+
+                # Slow path only when something below is actually busy
+                if res.busy_descendants > 0:
+                    for i in nx.descendants(self.resources, res):
+                        if i.name not in names and i.busy:
+                            raise ResourceError('Cannot acquire, some of dependent resources are busy')
+
+                resources.append(res)
+
+            for res in resources:
+                if not res.busy:
+                    res.busy = True
+                    self.busy.add(res)
+                    self.__mark_busy(res, 1)
 
     def can_acquire(self, *names):
         if not names:
@@ -181,19 +229,15 @@ class ResourceGraph(object):
 
         with self.mutex:
             self.logger.log(TRACE, 'Trying to acquire following resources: %s', ','.join(names))
-    
+
             for name in names:
                 res = self.get_resource(name)
                 if not res:
                     return False
-    
-                if res.busy:
+
+                if res.busy or res.busy_descendants > 0:
                     return False
-    
-                for i in nx.descendants(self.resources, res):
-                    if i.busy:
-                        return False
-    
+
             return True
 
     def release(self, *names):
@@ -202,11 +246,13 @@ class ResourceGraph(object):
 
         with self.mutex:
             self.logger.debug('Releasing following resources: %s', ','.join(names))
-    
+
             for name in names:
                 res = self.get_resource(name)
-                if res:
+                if res and res.busy:
                     res.busy = False
+                    self.busy.discard(res)
+                    self.__mark_busy(res, -1)
 
     def draw(self, path):
         return nx.write_dot(nx.relabel_nodes(self.resources, lambda n: f'"{n.name}"'), path)
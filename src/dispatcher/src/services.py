@@ -112,6 +112,15 @@ class ManagementService(RpcService):
     def get_available_features(self, sender):
         return list(self.dispatcher.features)
 
+    def get_validator_cache_stats(self):
+        return self.dispatcher.balancer.get_validator_stats()
+
+    def get_datastore_cache_stats(self):
+        return self.dispatcher.datastore.get_cache_stats()
+
+    def get_configstore_cache_stats(self):
+        return self.dispatcher.configstore.get_cache_stats()
+
     def die_you_gravy_sucking_pig_dog(self):
         self.dispatcher.die()
 
@@ -398,12 +407,22 @@ class TaskService(RpcService):
         tid, url_list = self.__balancer.submit_with_download(task_name, args, sender)
         return tid, url_list
 
+    def __live_state(self, t, task):
+        # Stored document of a live task lags behind the task itself,
+        # so build the result from the task and keep just the timestamps
+        t = dict(t or {}, **task.__getstate__())
+        t['id'] = task.id
+        if task.progress:
+            t['progress'] = task.progress.__getstate__()
+
+        return t
+
     def status(self, id):
         t = self.__dispatcher.datastore_log.get_by_id('tasks', id)
         task = self.__balancer.get_task(id)
 
-        if task and task.progress:
-            t['progress'] = task.progress.__getstate__()
+        if task:
+            return self.__live_state(t, task)
 
         return t
 
@@ -466,9 +485,10 @@ class TaskService(RpcService):
     def query(self, filter=None, params=None):
         def extend(t):
             task = self.__balancer.get_task(t['id'])
-            if task and task.progress:
-                t['progress'] = task.progress.__getstate__()
-                return t
+            if task:
+                t = self.__live_state(t, task)
+                if task.progress:
+                    return t
 
             t['progress'] = {
                 'percentage': 100 if t['state'] == 'FINISHED' else 0,
@@ -0,0 +1,152 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+######################################################################
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from freenas.utils.query import query
+from cache import CacheStore
+
+
+def make_datasets():
+    return [
+        {'id': 'tank', 'pool': 'tank', 'type': 'FILESYSTEM', 'tags': ['a']},
+        {'id': 'tank/a', 'pool': 'tank', 'type': 'FILESYSTEM', 'tags': ['b']},
+        {'id': 'tank/b', 'pool': 'tank', 'type': 'VOLUME', 'tags': ['a', 'b']},
+        {'id': 'boot', 'pool': 'boot', 'type': 'FILESYSTEM', 'tags': []},
+        {'id': 'boot/ROOT', 'pool': 'boot', 'type': 'FILESYSTEM', 'tags': ['a']},
+    ]
+
+
+def ids(items):
+    return [i['id'] for i in items]
+
+
+class TestCacheStore(unittest.TestCase):
+    def setUp(self):
+        self.store = CacheStore(indexes=['pool', 'type', 'tags'], key_field='id')
+        for i in make_datasets():
+            self.store.put(i['id'], i)
+
+    def assertSameResult(self, *filter, **params):
+        # Store iterates in key order
+        expected = query(sorted(make_datasets(), key=lambda i: i['id']), *filter, **params)
+        self.assertEqual(self.store.query(*filter, **params), expected)
+
+    def test_plan(self):
+        self.assertEqual(self.store.plan([('pool', '=', 'boot')]), {'boot', 'boot/ROOT'})
+        self.assertEqual(self.store.plan([('pool', 'in', ['boot', 'nope'])]), {'boot', 'boot/ROOT'})
+        self.assertEqual(self.store.plan([('id', 'in', ['tank', 'nope'])]), {'tank'})
+        self.assertEqual(
+            self.store.plan([('pool', '=', 'tank'), ('type', '=', 'VOLUME')]),
+            {'tank/b'}
+        )
+
+    def test_plan_not_indexed(self):
+        self.assertIsNone(self.store.plan([]))
+        self.assertIsNone(self.store.plan([('name', '=', 'tank')]))
+        self.assertIsNone(self.store.plan([('pool', '!=', 'tank')]))
+        self.assertIsNone(self.store.plan([('or', [('pool', '=', 'tank'), ('pool', '=', 'boot')])]))
+        self.assertEqual(
+            self.store.plan([('name', '=', 'tank'), ('pool', '=', 'boot')]),
+            {'boot', 'boot/ROOT'}
+        )
+
+    def test_unhashable_values(self):
+        # List values can't be indexed, so they are always candidates
+        self.assertEqual(self.store.plan([('tags', '=', 'a')]), {i['id'] for i in make_datasets()})
+        self.assertSameResult(('tags', '=', ['a']))
+
+    def test_query_matches_full_scan(self):
+        self.assertSameResult(('pool', '=', 'tank'))
+        self.assertSameResult(('pool', '=', 'tank'), sort='-id')
+        self.assertSameResult(('pool', 'in', ['tank', 'boot']), ('type', '=', 'VOLUME'))
+        self.assertSameResult(('id', '=', 'boot'), single=True)
+        self.assertSameResult(('id', 'in', ['boot', 'tank/a']), count=True)
+        self.assertSameResult(('pool', '=', 'nope'))
+        self.assertSameResult(sort='id', limit=2, offset=1)
+        self.assertSameResult(sort='-id', limit=2)
+
+    def test_reindex_on_update(self):
+        self.store.put('tank/a', {'id': 'tank/a', 'pool': 'boot', 'type': 'FILESYSTEM', 'tags': []})
+        self.assertEqual(self.store.plan([('pool', '=', 'tank')]), {'tank', 'tank/b'})
+        self.assertEqual(self.store.plan([('pool', '=', 'boot')]), {'boot', 'boot/ROOT', 'tank/a'})
+
+        self.store.update(**{'tank/b': {'id': 'tank/b', 'pool': 'tank', 'type': 'FILESYSTEM', 'tags': []}})
+        self.assertEqual(self.store.plan([('type', '=', 'VOLUME')]), set())
+
+        self.store.update_one('tank', pool='other')
+        self.assertEqual(ids(self.store.query(('pool', '=', 'other'))), ['tank'])
+        self.assertEqual(self.store.plan([('pool', '=', 'tank')]), {'tank/b'})
+
+    def test_unindex_on_remove(self):
+        self.store.remove('tank/a')
+        self.store.remove_many(['boot', 'nope'])
+        self.assertEqual(self.store.plan([('pool', '=', 'tank')]), {'tank', 'tank/b'})
+        self.assertEqual(self.store.plan([('pool', '=', 'boot')]), {'boot/ROOT'})
+        self.assertEqual(self.store.plan([('tags', '=', 'a')]), {'tank', 'tank/b', 'boot/ROOT'})
+
+        self.store.clear()
+        self.assertEqual(self.store.plan([('pool', '=', 'tank')]), set())
+        self.assertEqual(self.store.indexed_values, {})
+
+    def test_rename(self):
+        self.store.rename('tank/a', 'tank/c')
+        self.assertEqual(self.store.plan([('pool', '=', 'tank')]), {'tank', 'tank/b', 'tank/c'})
+        self.assertEqual(ids(self.store.query(('id', '=', 'tank/c'))), ['tank/c'])
+        self.assertEqual(self.store.query(('id', '=', 'tank/a')), [])
+
+    def test_invalid_items_skipped(self):
+        self.store.invalidate('tank/a')
+        self.assertEqual(ids(self.store.query(('pool', '=', 'tank'))), ['tank', 'tank/b'])
+
+    def test_itermatching(self):
+        self.assertEqual(
+            [k for k, _ in self.store.itermatching([('pool', '=', 'tank'), ('type', '=', 'FILESYSTEM')])],
+            ['tank', 'tank/a']
+        )
+        self.assertEqual(
+            [k for k, _ in self.store.itermatching(lambda v: v['type'] == 'VOLUME')],
+            ['tank/b']
+        )
+        self.assertEqual(self.store.remove_predicate([('pool', '=', 'boot')]), ['boot', 'boot/ROOT'])
+        self.assertEqual(ids(self.store.query()), ['tank', 'tank/a', 'tank/b'])
+
+    def test_custom_key(self):
+        store = CacheStore(key=lambda k: -k, indexes=['pool'], key_field='id')
+        for i in range(5):
+            store.put(i, {'id': i, 'pool': 'tank' if i % 2 else 'boot'})
+
+        self.assertEqual(ids(store.query(('pool', '=', 'boot'))), [4, 2, 0])
+        self.assertEqual(ids(store.query()), [4, 3, 2, 1, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+######################################################################
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from event import EventSubscriptionIndex
+
+
+class TestEventSubscriptionIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = EventSubscriptionIndex()
+
+    def test_exact(self):
+        self.index.subscribe('a', ['task.created'])
+        self.index.subscribe('b', ['task.updated'])
+        self.assertEqual(set(self.index.match('task.created')), {'a'})
+        self.assertEqual(set(self.index.match('task.updated')), {'b'})
+        self.assertEqual(self.index.match('task.progress'), ())
+
+    def test_wildcard(self):
+        self.index.subscribe('a', ['task.*'])
+        self.index.subscribe('b', ['*'])
+        self.index.subscribe('c', ['entity-subscriber.*.changed'])
+        self.assertEqual(set(self.index.match('task.created')), {'a', 'b'})
+        self.assertEqual(set(self.index.match('entity-subscriber.volume.changed')), {'b', 'c'})
+        self.assertEqual(set(self.index.match('entity-subscriber.volume.query')), {'b'})
+        self.assertEqual(set(self.index.match('system.ready')), {'b'})
+
+    def test_exact_and_wildcard(self):
+        self.index.subscribe('a', ['task.created', 'task.*'])
+        self.assertEqual(self.index.match('task.created'), ('a',))
+
+    def test_unsubscribe(self):
+        self.index.subscribe('a', ['task.*', 'system.ready'])
+        self.index.subscribe('b', ['task.*'])
+        self.assertEqual(set(self.index.match('task.created')), {'a', 'b'})
+
+        self.index.unsubscribe('a', ['task.*'])
+        self.assertEqual(set(self.index.match('task.created')), {'b'})
+        self.assertEqual(set(self.index.match('system.ready')), {'a'})
+
+        self.index.unsubscribe('a', ['system.ready'])
+        self.assertEqual(self.index.match('system.ready'), ())
+        self.assertNotIn('a', self.index.subscriptions)
+
+    def test_unsubscribe_unknown(self):
+        self.index.subscribe('a', ['task.*'])
+        self.index.unsubscribe('a', ['system.*'])
+        self.index.unsubscribe('b', ['task.*'])
+        self.assertEqual(self.index.match('task.created'), ('a',))
+
+    def test_remove(self):
+        self.index.subscribe('a', ['task.*', 'system.ready', '*'])
+        self.index.remove('a')
+        self.assertEqual(self.index.match('task.created'), ())
+        self.assertEqual(self.index.match('system.ready'), ())
+        self.assertEqual(self.index.exact, {})
+        self.assertEqual(self.index.wildcard, {})
+
+    def test_cache_invalidated_on_change(self):
+        self.assertEqual(self.index.match('task.created'), ())
+        self.index.subscribe('a', ['task.*'])
+        self.assertEqual(self.index.match('task.created'), ('a',))
+        self.index.remove('a')
+        self.assertEqual(self.index.match('task.created'), ())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+######################################################################
+
+import os
+import sys
+import copy
+import pickle
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from frozen import FrozenDict, FrozenList, freeze, thaw
+
+
+def make_dataset():
+    return {
+        'id': 'tank/a',
+        'properties': {'used': {'value': '1G', 'parsed': 1073741824}},
+        'children': [{'id': 'tank/a/b', 'children': []}],
+        'tags': ('x', 'y')
+    }
+
+
+class TestFreeze(unittest.TestCase):
+    def test_read_only(self):
+        obj = freeze(make_dataset())
+        with self.assertRaises(TypeError):
+            obj['id'] = 'tank/b'
+
+        with self.assertRaises(TypeError):
+            obj['properties']['used']['value'] = '2G'
+
+        with self.assertRaises(TypeError):
+            obj['children'].append({})
+
+        with self.assertRaises(TypeError):
+            obj['children'][0]['children'].append({})
+
+        with self.assertRaises(TypeError):
+            obj.update({'id': 'tank/b'})
+
+        with self.assertRaises(TypeError):
+            del obj['id']
+
+    def test_shares_data_lazily(self):
+        source = make_dataset()
+        obj = freeze(source)
+        self.assertIsInstance(obj, FrozenDict)
+        self.assertIs(dict.__getitem__(obj, 'properties'), source['properties'])
+        self.assertIsInstance(obj['properties'], FrozenDict)
+        self.assertIsInstance(obj['children'], FrozenList)
+        self.assertIsInstance(obj['children'][0], FrozenDict)
+
+        # Source isn't modified by freezing nested values
+        self.assertIs(type(source['properties']), dict)
+
+    def test_read_access(self):
+        obj = freeze(make_dataset())
+        self.assertEqual(obj, make_dataset())
+        self.assertEqual(obj.get('missing', 1), 1)
+        self.assertIsInstance(obj.get('properties'), FrozenDict)
+        self.assertTrue(all(type(v) is not dict for v in obj.values()))
+        self.assertTrue(all(type(v) is not dict for _, v in obj.items()))
+        self.assertTrue(all(type(v) is not dict for v in dict(obj).values()))
+
+    def test_list(self):
+        obj = freeze([{'id': 1}, [2]])
+        self.assertIsInstance(obj, FrozenList)
+        self.assertIsInstance(obj[0], FrozenDict)
+        self.assertIsInstance(obj[1], FrozenList)
+        with self.assertRaises(TypeError):
+            obj[0] = None
+
+        with self.assertRaises(TypeError):
+            obj.sort()
+
+    def test_scalars(self):
+        self.assertEqual(freeze(1), 1)
+        self.assertEqual(freeze('a'), 'a')
+        self.assertIsNone(freeze(None))
+
+
+class TestThaw(unittest.TestCase):
+    def test_deep_copy(self):
+        source = make_dataset()
+        obj = thaw(source)
+        self.assertEqual(obj, source)
+        obj['properties']['used']['value'] = '2G'
+        obj['children'][0]['children'].append({})
+        self.assertEqual(source, make_dataset())
+
+    def test_frozen(self):
+        source = make_dataset()
+        obj = thaw(freeze(source))
+        self.assertIs(type(obj), dict)
+        self.assertIs(type(obj['properties']), dict)
+        self.assertIs(type(obj['children']), list)
+        obj['properties']['used']['value'] = '2G'
+        self.assertEqual(source, make_dataset())
+
+    def test_copy_of_frozen_is_mutable(self):
+        obj = freeze(make_dataset())
+        for clone in (copy.copy(obj), copy.deepcopy(obj), obj.copy(), pickle.loads(pickle.dumps(obj))):
+            self.assertIs(type(clone), dict)
+            clone['id'] = 'tank/b'
+            clone['properties']['used']['value'] = '2G'
+
+        self.assertEqual(obj['properties']['used']['value'], '1G')
+
+    def test_tuple_and_other_types(self):
+        class Opaque(object):
+            def __init__(self):
+                self.items = [1]
+
+        source = {'tags': ('x', ['y']), 'opaque': Opaque()}
+        obj = thaw(source)
+        self.assertIsInstance(obj['tags'], tuple)
+        self.assertIsNot(obj['tags'][1], source['tags'][1])
+        self.assertIsNot(obj['opaque'], source['opaque'])
+        self.assertEqual(obj['opaque'].items, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
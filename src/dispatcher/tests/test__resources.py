@@ -0,0 +1,106 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+######################################################################
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from resources import Resource, ResourceGraph, ResourceError
+
+
+class TestResourceGraph(unittest.TestCase):
+    def setUp(self):
+        # root -> system -> zpool:tank -> zfs:tank/a
+        #                -> zpool:boot
+        self.graph = ResourceGraph()
+        self.graph.add_resource(Resource('system'))
+        self.graph.add_resource(Resource('zpool:tank'), parents=['system'])
+        self.graph.add_resource(Resource('zpool:boot'), parents=['system'])
+        self.graph.add_resource(Resource('zfs:tank/a'), parents=['zpool:tank'])
+
+    def busy_descendants(self, name):
+        return self.graph.get_resource(name).busy_descendants
+
+    def test_acquire_release(self):
+        self.graph.acquire('zfs:tank/a')
+        self.assertEqual(self.busy_descendants('zpool:tank'), 1)
+        self.assertEqual(self.busy_descendants('system'), 1)
+        self.assertEqual(self.busy_descendants('root'), 1)
+        self.assertEqual(self.busy_descendants('zpool:boot'), 0)
+        self.assertFalse(self.graph.can_acquire('system'))
+        self.assertFalse(self.graph.can_acquire('zfs:tank/a'))
+        self.assertTrue(self.graph.can_acquire('zpool:boot'))
+
+        self.graph.release('zfs:tank/a')
+        for name in ('zpool:tank', 'system', 'root'):
+            self.assertEqual(self.busy_descendants(name), 0)
+
+        self.assertTrue(self.graph.can_acquire('system'))
+
+    def test_acquire_with_busy_descendant(self):
+        self.graph.acquire('zfs:tank/a')
+        with self.assertRaises(ResourceError):
+            self.graph.acquire('zpool:tank')
+
+    def test_acquire_twice_counts_once(self):
+        self.graph.acquire('zfs:tank/a')
+        self.graph.acquire('zfs:tank/a')
+        self.assertEqual(self.busy_descendants('system'), 1)
+        self.graph.release('zfs:tank/a')
+        self.graph.release('zfs:tank/a')
+        self.assertEqual(self.busy_descendants('system'), 0)
+
+    def test_update_moves_counters(self):
+        self.graph.acquire('zfs:tank/a')
+        self.graph.update_resource('zfs:tank/a', ['zpool:boot'])
+        self.assertEqual(self.busy_descendants('zpool:tank'), 0)
+        self.assertEqual(self.busy_descendants('zpool:boot'), 1)
+        self.assertEqual(self.busy_descendants('system'), 1)
+
+        self.graph.release('zfs:tank/a')
+        self.assertEqual(self.busy_descendants('zpool:boot'), 0)
+        self.assertEqual(self.busy_descendants('system'), 0)
+
+    def test_remove_busy(self):
+        self.graph.acquire('zfs:tank/a')
+        self.graph.remove_resource('zpool:tank')
+        self.assertIsNone(self.graph.get_resource('zfs:tank/a'))
+        self.assertEqual(self.busy_descendants('system'), 0)
+        self.assertEqual(self.graph.busy, set())
+        self.assertTrue(self.graph.can_acquire('system'))
+
+    def test_rename(self):
+        self.graph.rename_resource('zfs:tank/a', 'zfs:tank/b')
+        self.assertIsNone(self.graph.get_resource('zfs:tank/a'))
+        self.graph.acquire('zfs:tank/b')
+        self.assertEqual(self.busy_descendants('zpool:tank'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
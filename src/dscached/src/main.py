@@ -1023,7 +1023,7 @@ class Main(object):
             self.logger.error('Cannot initialize datastore: %s', str(err))
             sys.exit(1)
 
-        self.configstore = ConfigStore(self.datastore)
+        self.configstore = ConfigStore(self.datastore, cache=True)
 
     def init_dispatcher(self):
         def on_error(reason, **kwargs):
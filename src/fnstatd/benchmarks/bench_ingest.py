@@ -0,0 +1,143 @@
+#!/usr/local/bin/python3
+#+
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+#
+# Drives InputServer with a synthetic collectd stand-in: a client sending
+# graphite line protocol for a number of metrics over several intervals,
+# and reports the sustained ingest rate. Data sources use the default
+# schema layout, with lower resolution buckets kept in a scratch HDF5 file.
+#
+
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tables
+import gevent
+import gevent.socket
+
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from main import Main, InputServer, DataSource, DataSourceBucket
+
+
+class BenchConfig(object):
+    def __init__(self):
+        self.buckets = [
+            DataSourceBucket(0, {'interval': '10s', 'retention': '4h'}),
+            DataSourceBucket(1, {'interval': '60s', 'retention': '1d', 'consolidation': 'avg'}),
+            DataSourceBucket(2, {'interval': '5m', 'retention': '2y', 'consolidation': 'avg'})
+        ]
+        self.primary_bucket = self.buckets[0]
+
+    @property
+    def primary_interval(self):
+        return self.primary_bucket.interval
+
+
+class BenchContext(Main):
+    def __init__(self, path):
+        super(BenchContext, self).__init__()
+        self.hdf = tables.open_file(path, mode='w')
+        self.hdf_group = self.hdf.create_group('/', 'stats')
+        self.config = BenchConfig()
+        self.alert_config = {
+            'alert_high': None,
+            'alert_high_enabled': False,
+            'alert_low': None,
+            'alert_low_enabled': False
+        }
+
+    def get_data_source(self, name):
+        try:
+            return self.data_sources[name]
+        except KeyError:
+            ds = DataSource(self, name, self.config, dict(self.alert_config))
+            self.data_sources[name] = ds
+            return ds
+
+
+def collectd(address, metrics, intervals):
+    # Sends one burst per interval, the way collectd's write_graphite does
+    sock = gevent.socket.create_connection(address)
+    timestamp = int(time.time()) // 300 * 300
+    for i in range(intervals):
+        lines = [
+            'freenas.metric-{0}.value {1} {2}\n'.format(m, float(i + m), timestamp + i * 10)
+            for m in range(metrics)
+        ]
+        sock.sendall(''.join(lines).encode('utf-8'))
+
+    sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', metavar='METRICS', type=int, default=2000, help='Number of metrics')
+    parser.add_argument('-i', metavar='INTERVALS', type=int, default=60, help='Number of collection intervals')
+    parser.add_argument('-p', metavar='PORT', type=int, default=2103, help='Port to listen on')
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.hdf')
+    os.close(fd)
+
+    try:
+        context = BenchContext(path)
+        address = ('127.0.0.1', args.p)
+        server = InputServer(context, address)
+        server.start()
+        gevent.sleep(0.1)
+
+        # Populate data sources first, so that only ingest itself is measured
+        collectd(address, args.m, 1)
+        while len(context.data_sources) < args.m:
+            gevent.sleep(0.1)
+
+        start = time.monotonic()
+        collectd(address, args.m, args.i)
+        total = args.m * args.i
+        while sum(ds.primary_buffer.used_count + 1 for ds in context.data_sources.values()) < total + args.m:
+            gevent.sleep(0.01)
+
+        elapsed = time.monotonic() - start
+        print('{0} points from {1} metrics in {2:.3f}s ({3:.0f} points/s)'.format(
+            total, args.m, elapsed, total / elapsed
+        ))
+
+        server.stop()
+        context.hdf.close()
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
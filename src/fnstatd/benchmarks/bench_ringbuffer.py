@@ -0,0 +1,99 @@
+#!/usr/local/bin/python3
+#+
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+#
+# Pushes points into a number of PersistentRingBuffer tables (one per data
+# source, the way fnstatd lays out the stats file) and reports the sustained
+# write rate. With -f 1 every round is flushed, which approximates the old
+# write-per-point behaviour.
+#
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tables
+
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from ringbuffer import PersistentRingBuffer
+
+
+class DataPoint(tables.IsDescription):
+    timestamp = tables.Time32Col()
+    value = tables.FloatCol()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', metavar='TABLES', type=int, default=1000, help='Number of tables')
+    parser.add_argument('-s', metavar='SIZE', type=int, default=1440, help='Ring buffer size')
+    parser.add_argument('-r', metavar='ROUNDS', type=int, default=100, help='Number of points pushed to each table')
+    parser.add_argument('-f', metavar='ROUNDS', type=int, default=30, help='Flush every given number of rounds')
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.hdf')
+    os.close(fd)
+
+    try:
+        hdf = tables.open_file(path, mode='w')
+        group = hdf.create_group('/', 'stats')
+        buffers = [
+            PersistentRingBuffer(hdf.create_table(group, 'ds{0}'.format(i), DataPoint), args.s)
+            for i in range(args.t)
+        ]
+
+        timestamp = int(time.time())
+        start = time.monotonic()
+        for r in range(args.r):
+            for b in buffers:
+                b.push(timestamp + r * 60, float(r))
+
+            if (r + 1) % args.f == 0 or r == args.r - 1:
+                for b in buffers:
+                    b.flush()
+
+                hdf.flush()
+
+        elapsed = time.monotonic() - start
+        total = args.t * args.r
+        print('{0} points into {1} tables in {2:.3f}s ({3:.0f} points/s)'.format(total, args.t, elapsed, total / elapsed))
+
+        for b in buffers:
+            data = b.data
+            assert len(data) == min(args.r, args.s - 1)
+            assert data['value'][-1] == args.r - 1
+
+        hdf.close()
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
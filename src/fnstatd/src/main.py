@@ -42,10 +42,12 @@ import signal
 import time
 import collections
 import numpy as np
-import pandas as pd
+from pandas.tseries.frequencies import to_offset
 from datetime import datetime, timedelta
 import gevent
 import gevent.socket
+import gevent.event
+import gevent.queue
 import gevent.threadpool
 from bsd import setproctitle
 from gevent.lock import RLock
@@ -53,7 +55,7 @@ from gevent.server import StreamServer
 from freenas.dispatcher.client import Client, ClientError
 from freenas.dispatcher.rpc import RpcService, RpcException, accepts, returns, generator
 from datastore import DatastoreException, get_datastore
-from ringbuffer import MemoryRingBuffer, PersistentRingBuffer
+from ringbuffer import MemoryRingBuffer, PersistentRingBuffer, MemmapRingBuffer, memmap_path
 from freenas.utils.debug import DebugService
 from freenas.utils.trace_logger import TRACE
 from freenas.utils import configure_logging, to_timedelta, materialized_paths_to_tree
@@ -63,6 +65,18 @@ from freenas.serviced import checkin
 EVENT_RE = re.compile(r'^statd\.(.*)\.pulse$')
 DEFAULT_CONFIGFILE = '/usr/local/etc/middleware.conf'
 DEFAULT_DBFILE = 'stats.hdf'
+DEFAULT_MMAPDIR = 'stats.mmap'
+BACKENDS = ('hdf5', 'memmap')
+CONSOLIDATION_DELAY = 1
+FLUSH_INTERVAL = 30
+QUERY_CACHE_SIZE = 32
+STREAM_CHUNK_SIZE = 1024
+INPUT_BUFFER_SIZE = 256 * 1024
+ALERT_INTERVAL = 10
+ALERT_DURATION = 1
+ALERT_HYSTERESIS = 0.05
+ALERT_RATE_LIMIT = 300
+EPOCH = datetime(1970, 1, 1)
 threadpool = gevent.threadpool.ThreadPool(5)
 
 
@@ -78,12 +92,86 @@ def local_to_utc(t):
     return t.astimezone(dateutil.tz.tzutc()).replace(tzinfo=None)
 
 
+def to_timestamp(t):
+    return int((t - EPOCH).total_seconds())
+
+
+def parse_frequency(frequency):
+    try:
+        seconds = int(to_offset(frequency).nanos // 10 ** 9)
+    except ValueError:
+        raise RpcException(errno.EINVAL, 'Invalid frequency {0}'.format(frequency))
+
+    if seconds <= 0:
+        raise RpcException(errno.EINVAL, 'Frequency {0} is too small'.format(frequency))
+
+    return seconds
+
+
+def resample(timestamps, values, frequency):
+    """
+    Averages points into `frequency` second bins aligned to the UNIX epoch and
+    linearly interpolates empty bins. Returns timestamp of the first bin and
+    array of bin values.
+    """
+    if not len(timestamps):
+        return None, np.empty(0, dtype='f8')
+
+    bins = timestamps // frequency
+    first = int(bins.min())
+    bins -= first
+    count = int(bins.max()) + 1
+    valid = ~np.isnan(values)
+    sums = np.bincount(bins[valid], weights=values[valid], minlength=count)
+    counts = np.bincount(bins[valid], minlength=count)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = sums / counts
+
+    present = ~np.isnan(result)
+    if present.any() and not present.all():
+        x = np.arange(count)
+        leading = np.argmax(present)
+        result = np.interp(x, x[present], result[present])
+        result[:leading] = np.nan
+
+    return first * frequency, result
+
+
+def consolidate_mean(segments):
+    total = sum(float(np.nansum(s)) for s in segments)
+    count = sum(int(np.count_nonzero(~np.isnan(s))) for s in segments)
+    return total / count if count else float('nan')
+
+
+def consolidate_min(segments):
+    return float(np.fmin.reduce([np.fmin.reduce(s) for s in segments]))
+
+
+def consolidate_max(segments):
+    return float(np.fmax.reduce([np.fmax.reduce(s) for s in segments]))
+
+
+def consolidate_last(segments):
+    return float(segments[-1][-1])
+
+
+CONSOLIDATION_FUNCTIONS = {
+    'mean': consolidate_mean,
+    'avg': consolidate_mean,
+    'min': consolidate_min,
+    'max': consolidate_max,
+    'last': consolidate_last
+}
+
+
 class DataSourceBucket(object):
     def __init__(self, index, obj):
         self.index = index
         self.interval = to_timedelta(obj['interval'])
         self.retention = to_timedelta(obj['retention'])
-        self.consolidation = obj.get('consolidation')
+        self.consolidation = obj.get('consolidation') or 'mean'
+        self.consolidation_func = CONSOLIDATION_FUNCTIONS.get(self.consolidation, consolidate_mean)
 
     @property
     def covered_start(self):
@@ -139,28 +227,47 @@ class DataSource(object):
         self.last_value = 0
         self.events_enabled = False
         self.alerts = alert_config
+        self.query_cache = {}
+        self.query_generation = 0
+
+    def invalidate_query_cache(self):
+        # Queries running in the threadpool meanwhile must not cache their results
+        self.query_generation += 1
+        self.query_cache.clear()
 
     def create_buckets(self):
         # Primary bucket should be hold in memory
         buckets = [MemoryRingBuffer(self.config.buckets[0].intervals_count)]
 
-        # And others saved to HDF5 file
+        # And others saved to disk
         for idx, b in enumerate(self.config.buckets[1:]):
-            table = self.context.request_table('{0}#b{1}'.format(self.name, idx))
-            buckets.append(PersistentRingBuffer(table, b.intervals_count))
+            buckets.append(self.context.request_buffer('{0}#b{1}'.format(self.name, idx), b.intervals_count))
 
         self.logger.log(TRACE, 'Created {0} buckets'.format(len(buckets)))
         return buckets
 
     def submit(self, timestamp, value):
-        timestamp = round_timestamp(timestamp, self.config.primary_interval.total_seconds())
+        self.submit_many([timestamp], [value])
+
+    def submit_many(self, timestamps, values):
+        """
+        Submits a batch of points at once. Pulse event is sent only for
+        the last point of the batch. Alerts are evaluated by AlertEngine.
+        """
+        interval = self.config.primary_interval.total_seconds()
+        timestamps = (np.round(np.asarray(timestamps, dtype='f8') / interval) * interval).astype('i8')
+        values = np.asarray(values, dtype='f8')
+        tail = self.primary_buffer.tail
+        size = self.primary_buffer.size
         change = None
-        self.primary_buffer.push(timestamp, value)
+        self.primary_buffer.push_many(timestamps, values)
+        self.invalidate_query_cache()
 
         for b in self.config.buckets[1:]:
-            if timestamp % b.interval.total_seconds() == 0:
-                self.persist(timestamp, self.bucket_buffers[b.index], b)
+            for i in np.flatnonzero(timestamps % int(b.interval.total_seconds()) == 0):
+                self.context.schedule_consolidation(self, b, int(timestamps[i]), (tail + i + 1) % size)
 
+        value = float(values[-1])
         if math.isnan(value):
             value = None
 
@@ -174,101 +281,221 @@ class DataSource(object):
                 'nolog': True
             })
 
-        last_in_range = True
-        if self.last_value is not None:
-            if (self.alerts['alert_low_enabled']) and (self.last_value < self.alerts['alert_low']):
-                last_in_range = False
-            elif (self.alerts['alert_high_enabled']) and (self.last_value > self.alerts['alert_high']):
-                last_in_range = False
-
         self.last_value = value
 
-        if value is not None:
-            if last_in_range:
-                if self.alerts['alert_high_enabled']:
-                    if value > self.alerts['alert_high']:
-                        self.emit_alert_high()
-                if self.alerts['alert_low_enabled']:
-                    if value < self.alerts['alert_low']:
-                        self.emit_alert_low()
-
-    def persist(self, timestamp, buffer, bucket):
-        def doit():
-            count = bucket.interval.total_seconds() / self.config.buckets[0].interval.total_seconds()
-            data = self.bucket_buffers[0].data
-            mean = np.mean(list(zip(*data[-count:]))[1])
-            buffer.push(timestamp, mean)
+    def consolidate(self, bucket, tail):
+        count = int(bucket.interval.total_seconds() / self.primary_interval.total_seconds())
+        segments = self.primary_buffer.segments(count, tail)
+        if not segments:
+            return None
+
+        return bucket.consolidation_func(segments)
 
-        threadpool.apply(doit)
+    def persist(self, timestamp, bucket, tail):
+        value = self.consolidate(bucket, tail)
+        if value is not None:
+            self.bucket_buffers[bucket.index].push(timestamp, value)
+            self.invalidate_query_cache()
+
+    def fetch(self, buckets, start, end):
+        # Buckets are ordered from the finest one, coarser buckets only
+        # fill in the time before the finer ones begin
+        timestamps = []
+        values = []
+        for b in buckets:
+            ts, v = self.bucket_buffers[b.index].between(start, end)
+            if len(ts):
+                timestamps.insert(0, ts)
+                values.insert(0, v)
+                end = int(ts[0]) - 1
+
+        if not timestamps:
+            return np.empty(0, dtype='i8'), np.empty(0, dtype='f8')
+
+        return np.concatenate(timestamps), np.concatenate(values)
 
     def query(self, start, end, frequency):
+        """
+        Returns (first bin timestamp, values array) for given time range and
+        frequency in seconds. Range is aligned to bin boundaries, results are
+        cached until next data point arrives.
+        """
         self.logger.debug('Query: start={0}, end={1}, frequency={2}'.format(start, end, frequency))
+        key = (to_timestamp(start) // frequency, -(-to_timestamp(end) // frequency), frequency)
+        result = self.query_cache.get(key)
+        if result is not None:
+            return result
+
         buckets = list(self.config.get_covered_buckets(start, end))
 
         def doit():
-            df = pd.DataFrame()
-
-            for b in buckets:
-                new = self.bucket_buffers[b.index].df
-                if new is not None:
-                    df = pd.concat((df, new))
-
-            df = df.reset_index().drop_duplicates(subset='index').set_index('index')
-            if len(buckets):
-                df = df.sort()[0]
-                df = df[start:end]
-                df = df.resample(frequency, how='mean').interpolate()
-            return df
-
-        return threadpool.apply(doit)
-
-    def check_alerts(self):
-        if self.last_value is not None:
-            if self.alerts['alert_high_enabled']:
-                if self.last_value > self.alerts['alert_high']:
-                    self.emit_alert_high()
-
-            if self.alerts['alert_low_enabled']:
-                if self.last_value < self.alerts['alert_low']:
-                    self.emit_alert_low()
-
-    def emit_alert_high(self):
-        unit, last_value = self.context.client.call_sync('stat.normalize', self.name, self.last_value)
-        unit, alert_high = self.context.client.call_sync('stat.normalize', self.name, self.alerts['alert_high'])
-
-        if last_value:
-            self.context.client.call_sync('alert.emit', {
-                'name': 'stat.{0}.too_high'.format(self.name),
-                'description': 'Value of {0} has exceeded maximum permissible value {1}. Current {2}'.format(
-                    self.name,
-                    str(alert_high) + unit,
-                    str(last_value) + unit
-                ),
-                'severity': 'WARNING'
-            })
+            timestamps, values = self.fetch(buckets, key[0] * frequency, key[1] * frequency)
+            return resample(timestamps, values, frequency)
 
-    def emit_alert_low(self):
-        unit, last_value = self.context.client.call_sync('stat.normalize', self.name, self.last_value)
-        unit, alert_low = self.context.client.call_sync('stat.normalize', self.name, self.alerts['alert_low'])
-
-        if last_value:
-            self.context.client.call_sync('alert.emit', {
-                'name': 'stat.{0}.too_high'.format(self.name),
-                'description': 'Value of {0} has gone under minimum permissible value {1}. Current {2}'.format(
-                    self.name,
-                    str(alert_low) + unit,
-                    str(last_value) + unit
-                ),
-                'severity': 'WARNING'
-            })
+        generation = self.query_generation
+        result = threadpool.apply(doit)
+        if generation != self.query_generation:
+            return result
 
+        if len(self.query_cache) >= QUERY_CACHE_SIZE:
+            self.query_cache.clear()
+
+        self.query_cache[key] = result
+        return result
+
+
+class AlertEngine(object):
+    """
+    Evaluates alert thresholds of all data sources once per tick.
+
+    A source enters the high (low) state after its value stays above (below)
+    the threshold for `alert_duration` ticks and leaves it only once the value
+    gets back past the threshold by `alert_hysteresis` (relative). Alerts are
+    emitted from a separate greenlet, at most once per ALERT_RATE_LIMIT seconds
+    for given source and direction.
+    """
+    NORMAL, HIGH, LOW = 0, 1, -1
 
-class InputServer(object):
     def __init__(self, context):
+        self.context = context
+        self.logger = logging.getLogger('AlertEngine')
+        self.names = []
+        self.state = np.zeros(0, dtype='i1')
+        self.high_count = np.zeros(0, dtype='i4')
+        self.low_count = np.zeros(0, dtype='i4')
+        self.thresholds = {}
+        self.last_emit = {}
+        self.queue = gevent.queue.Queue()
+        self.suppressed = 0
+
+    def sync(self):
+        # Data sources are only ever added, so new ones are appended
+        count = len(self.context.data_sources)
+        if count == len(self.names):
+            return
+
+        self.names.extend(list(self.context.data_sources.keys())[len(self.names):])
+        grow = len(self.names) - len(self.state)
+        self.state = np.concatenate((self.state, np.zeros(grow, dtype='i1')))
+        self.high_count = np.concatenate((self.high_count, np.zeros(grow, dtype='i4')))
+        self.low_count = np.concatenate((self.low_count, np.zeros(grow, dtype='i4')))
+
+    def reset(self, name):
+        # Alert configuration changed, let the next tick evaluate source from scratch
+        if name in self.names:
+            idx = self.names.index(name)
+            self.state[idx] = self.NORMAL
+            self.high_count[idx] = 0
+            self.low_count[idx] = 0
+
+        self.last_emit.pop((name, self.HIGH), None)
+        self.last_emit.pop((name, self.LOW), None)
+        for key in [k for k in self.thresholds if k[0] == name]:
+            del self.thresholds[key]
+
+    def evaluate(self):
+        self.sync()
+        sources = [self.context.data_sources[n] for n in self.names]
+        count = len(sources)
+        if not count:
+            return
+
+        def threshold(ds, kind):
+            if ds.alerts['alert_{0}_enabled'.format(kind)] and ds.alerts['alert_{0}'.format(kind)] is not None:
+                return ds.alerts['alert_{0}'.format(kind)]
+
+            return np.nan
+
+        values = np.fromiter((np.nan if ds.last_value is None else ds.last_value for ds in sources), 'f8', count)
+        high = np.fromiter((threshold(ds, 'high') for ds in sources), 'f8', count)
+        low = np.fromiter((threshold(ds, 'low') for ds in sources), 'f8', count)
+        duration = np.fromiter((ds.alerts.get('alert_duration') or ALERT_DURATION for ds in sources), 'i4', count)
+        hysteresis = np.fromiter((ds.alerts.get('alert_hysteresis') or ALERT_HYSTERESIS for ds in sources), 'f8', count)
+
+        # NaN values and thresholds compare false
+        with np.errstate(invalid='ignore'):
+            self.high_count = np.where(values > high, self.high_count + 1, 0)
+            self.low_count = np.where(values < low, self.low_count + 1, 0)
+            clear_high = (self.state == self.HIGH) & ~(values > high - np.abs(high) * hysteresis)
+            clear_low = (self.state == self.LOW) & ~(values < low + np.abs(low) * hysteresis)
+
+        self.state[clear_high | clear_low] = self.NORMAL
+        fire_high = (self.state != self.HIGH) & (self.high_count >= duration)
+        fire_low = (self.state != self.LOW) & (self.low_count >= duration)
+        self.state[fire_high] = self.HIGH
+        self.state[fire_low] = self.LOW
+
+        for idx in np.flatnonzero(fire_high):
+            self.schedule(sources[idx], self.HIGH, values[idx], high[idx])
+
+        for idx in np.flatnonzero(fire_low):
+            self.schedule(sources[idx], self.LOW, values[idx], low[idx])
+
+    def schedule(self, ds, kind, value, threshold):
+        now = time.monotonic()
+        last = self.last_emit.get((ds.name, kind))
+        if last is not None and now - last < ALERT_RATE_LIMIT:
+            self.suppressed += 1
+            self.logger.debug('Suppressed alert for {0}'.format(ds.name))
+            return
+
+        self.last_emit[(ds.name, kind)] = now
+        self.queue.put((ds.name, kind, float(value), float(threshold)))
+
+    def normalize(self, name, value):
+        return self.context.client.call_sync('stat.normalize', name, value)
+
+    def normalize_threshold(self, name, threshold):
+        # Thresholds only change with alert configuration, so their
+        # normalized form is kept until the next reset()
+        key = (name, threshold)
+        entry = self.thresholds.get(key)
+        if entry is None:
+            entry = self.thresholds[key] = tuple(self.normalize(name, threshold))
+
+        return entry
+
+    def emit(self, name, kind, value, threshold):
+        unit, value = self.normalize(name, value)
+        unit, threshold = self.normalize_threshold(name, threshold)
+        if not value:
+            return
+
+        if kind == self.HIGH:
+            description = 'Value of {0} has exceeded maximum permissible value {1}. Current {2}'
+        else:
+            description = 'Value of {0} has gone under minimum permissible value {1}. Current {2}'
+
+        self.context.client.call_sync('alert.emit', {
+            'name': 'stat.{0}.too_high'.format(name),
+            'description': description.format(name, str(threshold) + unit, str(value) + unit),
+            'severity': 'WARNING'
+        })
+
+    def emit_worker(self):
+        while True:
+            name, kind, value, threshold = self.queue.get()
+            try:
+                self.emit(name, kind, value, threshold)
+            except (OSError, RpcException) as err:
+                self.logger.warning('Cannot emit alert for {0}: {1}'.format(name, str(err)))
+
+    def worker(self):
+        while True:
+            gevent.sleep(ALERT_INTERVAL)
+            try:
+                self.evaluate()
+            except Exception as err:
+                self.logger.warning('Cannot evaluate alerts: {0}'.format(str(err)))
+
+
+class InputServer(object):
+    def __init__(self, context, address=('127.0.0.1', 2003)):
         super(InputServer, self).__init__()
         self.context = context
         self.thread = None
-        self.server = StreamServer(('127.0.0.1', 2003), handle=self.handle)
+        self.sources = {}
+        self.server = StreamServer(address, handle=self.handle)
 
     def start(self):
         self.thread = gevent.spawn(self.server.serve_forever)
@@ -276,17 +503,82 @@ class InputServer(object):
     def stop(self):
         gevent.kill(self.thread)
 
+    def get_data_source(self, name):
+        # Maps metric name as sent by collectd directly to the data source
+        try:
+            return self.sources[name]
+        except KeyError:
+            _, _, datapoint = name.decode('utf-8').partition('.')
+            ds = self.context.get_data_source('localhost.{0}'.format(datapoint))
+            self.sources[name] = ds
+            return ds
+
+    def ingest(self, data):
+        batch = collections.OrderedDict()
+        invalid = 0
+
+        for line in data.split(b'\n'):
+            try:
+                name, value, timestamp = line.split()
+                timestamp = float(timestamp)
+                value = float(value)
+            except ValueError:
+                if line.strip():
+                    invalid += 1
+                continue
+
+            points = batch.get(name)
+            if points is None:
+                points = batch[name] = ([], [])
+
+            points[0].append(timestamp)
+            points[1].append(value)
+
+        if invalid:
+            self.context.logger.warning('Ignored {0} malformed input lines'.format(invalid))
+
+        submitted = 0
+        for name, (timestamps, values) in batch.items():
+            try:
+                self.get_data_source(name).submit_many(timestamps, values)
+                submitted += len(timestamps)
+            except Exception as err:
+                self.context.logger.warning('Cannot submit {0} points to {1}: {2}'.format(
+                    len(timestamps),
+                    name.decode('utf-8', 'replace'),
+                    str(err)
+                ))
+
+        return submitted
+
     def handle(self, socket, address):
-        fd = socket.makefile()
+        remainder = b''
+        overlong = False
         while True:
-            line = fd.readline()
-            if not line:
+            data = socket.recv(INPUT_BUFFER_SIZE)
+            if not data:
                 break
 
-            name, value, timestamp = line.split()
-            _, _, datapoint = name.partition('.')
-            ds = self.context.get_data_source('localhost.{0}'.format(datapoint))
-            ds.submit(int(timestamp), float(value))
+            data, sep, remainder = (remainder + data).rpartition(b'\n')
+            if overlong:
+                # Drop the rest of a line which didn't fit in the buffer
+                if not sep:
+                    remainder = b''
+                    continue
+
+                _, _, data = data.partition(b'\n')
+                overlong = False
+
+            if len(remainder) > INPUT_BUFFER_SIZE:
+                self.context.logger.warning('Ignored 1 malformed input lines')
+                remainder = b''
+                overlong = True
+
+            if data:
+                self.ingest(data)
+
+        if remainder and not overlong:
+            self.ingest(remainder)
 
         socket.shutdown(gevent.socket.SHUT_RDWR)
         socket.close()
@@ -350,7 +642,7 @@ class OutputService(RpcService):
         start = params.pop('start', None)
         end = params.pop('end', datetime.utcnow())
         timespan = params.pop('timespan', None)
-        frequency = params.pop('frequency', '10S')
+        frequency = parse_frequency(params.pop('frequency', '10S'))
 
         if start is None and timespan is None:
             raise RpcException(errno.EINVAL, 'Either "start" or "timespan" is required')
@@ -372,23 +664,41 @@ class OutputService(RpcService):
             if not ds:
                 raise RpcException(errno.ENOENT, 'Data source {0} not found'.format(data_source))
 
-            df = ds.query(start, end, frequency)
-            for i in range(len(df)):
-                yield str(df[i])
+            _, values = ds.query(start, end, frequency)
+            for i in range(0, len(values), STREAM_CHUNK_SIZE):
+                yield from values[i:i + STREAM_CHUNK_SIZE].astype(str).tolist()
 
             return
 
         if type(data_source) is list:
-            final = pd.DataFrame()
+            results = []
             for ds_name in data_source:
                 ds = self.context.data_sources.get(ds_name)
                 if not ds:
                     raise RpcException(errno.ENOENT, 'Data source {0} not found'.format(ds_name))
 
-                final[ds_name] = ds.query(start, end, frequency)
+                results.append(ds.query(start, end, frequency))
+
+            if not results or results[0][0] is None:
+                return
+
+            # Rows span the bins of the first data source, other columns are aligned to them
+            first, values = results[0]
+            columns = []
+            for ts, v in results:
+                column = np.full(len(values), np.nan)
+                if ts is not None:
+                    offset = (ts - first) // frequency
+                    lo = max(0, offset)
+                    hi = min(len(values), offset + len(v))
+                    if lo < hi:
+                        column[lo:hi] = v[lo - offset:hi - offset]
+
+                columns.append(column)
 
-            for i in range(len(final)):
-                yield [str(final[col][i]) for col in data_source]
+            for i in range(0, len(values), STREAM_CHUNK_SIZE):
+                chunk = [c[i:i + STREAM_CHUNK_SIZE].astype(str).tolist() for c in columns]
+                yield from (list(row) for row in zip(*chunk))
 
             return
 
@@ -418,7 +728,7 @@ class AlertService(RpcService):
             self.context.datastore.update('statd.alerts', name, alert_config)
 
         ds.alerts = alert_config
-        ds.check_alerts()
+        self.context.alert_engine.reset(name)
 
 
 class DataPoint(tables.IsDescription):
@@ -433,11 +743,16 @@ class Main(object):
         self.datastore = None
         self.hdf = None
         self.hdf_group = None
+        self.backend = 'hdf5'
+        self.mmap_dir = None
         self.config = None
         self.event_queue = collections.deque()
         self.event_lock = RLock()
+        self.consolidation_queue = []
+        self.consolidation_event = gevent.event.Event()
         self.logger = logging.getLogger('statd')
         self.data_sources = {}
+        self.alert_engine = AlertEngine(self)
 
     def init_datastore(self):
         try:
@@ -456,6 +771,14 @@ class Main(object):
             directory = '/var/tmp/statd'
             if not os.path.exists(directory):
                 os.makedirs(directory)
+
+        if self.backend == 'memmap':
+            self.mmap_dir = os.path.join(directory, DEFAULT_MMAPDIR)
+            if not os.path.exists(self.mmap_dir):
+                os.makedirs(self.mmap_dir)
+
+            return
+
         self.hdf = tables.open_file(os.path.join(directory, DEFAULT_DBFILE), mode='a')
         if not hasattr(self.hdf.root, 'stats'):
             self.hdf.create_group('/', 'stats')
@@ -471,6 +794,12 @@ class Main(object):
         except Exception as e:
             self.logger.error(str(e))
 
+    def request_buffer(self, name, size):
+        if self.backend == 'memmap':
+            return MemmapRingBuffer(memmap_path(self.mmap_dir, name), size)
+
+        return PersistentRingBuffer(self.request_table(name), size)
+
     def init_alert_config(self, name):
         config_name = name if self.datastore.exists('statd.alerts', ('id', '=', name)) else 'default'
         alert_config = self.datastore.get_by_id('statd.alerts', config_name)
@@ -543,6 +872,7 @@ class Main(object):
     def die(self):
         self.logger.warning('Exiting')
         self.server.stop()
+        self.flush_tables()
         self.client.disconnect()
         sys.exit(0)
 
@@ -561,12 +891,63 @@ class Main(object):
                     self.client.send_event_burst(list(self.event_queue))
                     self.event_queue.clear()
 
+    def schedule_consolidation(self, ds, bucket, timestamp, tail=None):
+        # Remember where primary buffer ends now, so that points submitted
+        # before the batch gets processed don't leak into this interval
+        if tail is None:
+            tail = ds.primary_buffer.tail
+
+        self.consolidation_queue.append((ds, bucket, timestamp, tail))
+        self.consolidation_event.set()
+
+    def consolidate(self, batch, flush=False):
+        for ds, bucket, timestamp, tail in batch:
+            try:
+                ds.persist(timestamp, bucket, tail)
+            except Exception as err:
+                self.logger.warning('Cannot consolidate {0}: {1}'.format(ds.name, str(err)))
+
+        if flush:
+            self.flush_tables()
+
+    def flush_tables(self):
+        count = 0
+        for ds in list(self.data_sources.values()):
+            for buffer in ds.bucket_buffers[1:]:
+                count += buffer.flush()
+
+        if count:
+            if self.hdf:
+                self.hdf.flush()
+
+            self.logger.log(TRACE, 'Flushed {0} points'.format(count))
+
+    def consolidation_worker(self):
+        # Consolidation and flushing share a single worker, so persistent
+        # buffers are never written to from two threads at once
+        last_flush = time.monotonic()
+        while True:
+            batch = []
+            if self.consolidation_event.wait(FLUSH_INTERVAL):
+                # Let the rest of current collection interval arrive
+                gevent.sleep(CONSOLIDATION_DELAY)
+                self.consolidation_event.clear()
+                batch, self.consolidation_queue = self.consolidation_queue, []
+
+            flush = time.monotonic() - last_flush >= FLUSH_INTERVAL
+            if flush:
+                last_flush = time.monotonic()
+
+            if batch or flush:
+                threadpool.apply(self.consolidate, (batch, flush))
+
     def checkin(self):
         checkin()
 
     def main(self):
         parser = argparse.ArgumentParser()
         parser.add_argument('-c', metavar='CONFIG', default=DEFAULT_CONFIGFILE, help='Middleware config file')
+        parser.add_argument('-b', metavar='BACKEND', default='hdf5', choices=BACKENDS, help='Storage backend for persistent buckets')
         args = parser.parse_args()
         configure_logging('fnstatd', 'DEBUG')
         setproctitle('fnstatd')
@@ -576,9 +957,13 @@ class Main(object):
         gevent.signal(signal.SIGTERM, self.die)
         gevent.signal(signal.SIGINT, self.die)
         gevent.spawn(self.event_worker)
+        gevent.spawn(self.consolidation_worker)
+        gevent.spawn(self.alert_engine.worker)
+        gevent.spawn(self.alert_engine.emit_worker)
 
         self.server = InputServer(self)
         self.config = args.c
+        self.backend = args.b
         self.init_datastore()
         self.init_dispatcher()
         self.init_database()
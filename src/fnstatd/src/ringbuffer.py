@@ -26,11 +26,66 @@
 #####################################################################
 
 
+import os
 import time
 import numpy as np
 import pandas as pd
 
 
+MEMMAP_MAGIC = b'FNRB'
+MEMMAP_VERSION = 1
+MEMMAP_HEADER_SIZE = 64
+MEMMAP_HEADER_DTYPE = np.dtype([
+    ('magic', 'S4'),
+    ('version', '<u4'),
+    ('size', '<u8'),
+    ('head', '<u8'),
+    ('tail', '<u8')
+])
+MEMMAP_RECORD_DTYPE = np.dtype([
+    ('timestamp', '<i8'),
+    ('value', '<f8')
+])
+
+
+def memmap_path(directory, name):
+    return os.path.join(directory, '{0}.rb'.format(name.replace('/', '_')))
+
+
+def ring_between(timestamps, values, head, tail, size, start, end, copy=True):
+    """
+    Binary searches timestamps of a ring buffer for points with
+    start <= timestamp <= end. If the points don't wrap around and `copy`
+    is False, views of the buffer are returned.
+    """
+    if head == tail:
+        return np.empty(0, dtype='i8'), np.empty(0, dtype='f8')
+
+    if tail > head:
+        parts = [(head, tail)]
+    else:
+        parts = [(head, size), (0, tail)]
+
+    selected = []
+    for lo, hi in parts:
+        first = lo + np.searchsorted(timestamps[lo:hi], start, side='left')
+        last = lo + np.searchsorted(timestamps[lo:hi], end, side='right')
+        if first < last:
+            selected.append((first, last))
+
+    if len(selected) == 1:
+        first, last = selected[0]
+        if copy:
+            return timestamps[first:last].copy(), values[first:last].copy()
+
+        return timestamps[first:last], values[first:last]
+
+    return (
+        np.concatenate([timestamps[a:b] for a, b in selected] or [np.empty(0, dtype='i8')]),
+        np.concatenate([values[a:b] for a, b in selected] or [np.empty(0, dtype='f8')])
+    )
+
+
 class MemoryRingBuffer(object):
     def __init__(self, size):
         self.store = np.zeros(size, dtype='M8[s],f8')
@@ -72,20 +127,79 @@ class MemoryRingBuffer(object):
 
         return pd.DataFrame(index=self.data['timestamp'], data=self.data['value'])
 
+    def segments(self, count, tail=None):
+        """
+        Returns views of the value column covering last `count` elements
+        ending at `tail` (current tail by default). Result is a list of one
+        or two arrays, depending on whether the range wraps around.
+        """
+        if tail is None:
+            tail = self.tail
+
+        available = tail - self.head if tail >= self.head else self.size - self.head + tail
+        count = min(count, available)
+        if count <= 0:
+            return []
+
+        values = self.store['value']
+        start = tail - count
+        if start >= 0:
+            return [values[start:tail]]
+
+        return [values[start % self.size:], values[:tail]]
+
+    def between(self, start, end):
+        """
+        Returns (timestamps, values) arrays of points with start <= timestamp <= end.
+        Timestamps are given and returned as UNIX timestamps in seconds. Points are
+        located using binary search, only the selected range is copied.
+        """
+        return ring_between(
+            self.store['timestamp'].view('i8'),
+            self.store['value'],
+            self.head, self.tail, self.size,
+            start, end
+        )
+
     def push(self, timestamp, value):
         self.store[self.tail] = (timestamp, value)
         self.tail = (self.tail + 1) % self.size
         if self.head == self.tail:
             self.head = (self.head + 1) % self.size
 
+    def push_many(self, timestamps, values):
+        count = len(timestamps)
+        if count == 0:
+            return
+
+        used = self.tail - self.head if self.tail >= self.head else self.size - self.head + self.tail
+        # Only last `size` points can fit, skip the rest
+        keep = min(count, self.size)
+        index = (self.tail + np.arange(count - keep, count)) % self.size
+        self.store['timestamp'].view('i8')[index] = timestamps[-keep:]
+        self.store['value'][index] = values[-keep:]
+        self.tail = (self.tail + count) % self.size
+        self.head = (self.tail - min(used + count, self.size - 1)) % self.size
+
     def pop(self):
         pass
 
 
 class PersistentRingBuffer(object):
+    """
+    Ring buffer stored in a PyTables table.
+
+    Pushed points are kept in memory until flush() writes them out with at
+    most two slice assignments. The head attribute is advanced past rows
+    about to be overwritten before they're written and tail only after, so
+    after a crash the table describes the last flushed state, possibly
+    missing its oldest rows. Flushing the HDF5 file itself is up to the
+    caller.
+    """
     def __init__(self, table, size):
         self.table = table
         self.size = size
+        self.pending = []
 
         if (
             not hasattr(self.table.attrs, 'tail')
@@ -97,53 +211,305 @@ class PersistentRingBuffer(object):
             self.table.attrs.head = 0
             self.fill_initial()
 
+        self.head = int(self.table.attrs.head)
+        self.tail = int(self.table.attrs.tail)
+
     @property
     def empty(self):
-        return self.table.attrs.head == self.table.attrs.tail
+        return self.head == self.tail
 
     @property
     def used_count(self):
         if self.empty:
             return 0
 
-        if self.table.attrs.tail > self.table.attrs.head:
-            return self.table.attrs.tail - self.table.attrs.head - 1
+        if self.tail > self.head:
+            return self.tail - self.head - 1
 
-        if self.table.attrs.head > self.table.attrs.tail:
-            return (self.size - self.table.attrs.head) + self.table.attrs.tail - 1
+        if self.head > self.tail:
+            return (self.size - self.head) + self.tail - 1
 
     @property
-    def data(self):
-        if self.empty:
+    def flushed_data(self):
+        head = self.table.attrs.head
+        tail = self.table.attrs.tail
+
+        if head == tail:
             return None
 
-        if self.table.attrs.tail > self.table.attrs.head:
-            return self.table[self.table.attrs.head:self.table.attrs.tail]
+        if tail > head:
+            return self.table[head:tail]
 
-        if self.table.attrs.head > self.table.attrs.tail:
-            return np.concatenate((self.table[self.table.attrs.head:], self.table[:self.table.attrs.tail]))
+        return np.concatenate((self.table[head:], self.table[:tail]))
+
+    @property
+    def data(self):
+        pending = self.pending
+        flushed = self.flushed_data
+        if not pending:
+            return flushed
+
+        rows = np.array(pending, dtype=self.table.dtype)
+        if flushed is not None:
+            rows = np.concatenate((flushed, rows))
+
+        return rows[-(self.size - 1):]
 
     @property
     def df(self):
         if self.empty:
             return None
 
+        data = self.data
         return pd.DataFrame(
-            index=pd.to_datetime(self.data['timestamp'], unit='s', utc=True),
-            data=self.data['value']
+            index=pd.to_datetime(data['timestamp'], unit='s', utc=True),
+            data=data['value']
         )
 
     def fill_initial(self):
         self.table.truncate(self.size)
         self.table.flush()
 
+    def between(self, start, end):
+        """
+        Returns (timestamps, values) arrays of points with start <= timestamp <= end.
+        Flushed rows are located using binary search over the table, so only
+        the selected rows are read from the file.
+        """
+        pending = self.pending
+        head = int(self.table.attrs.head)
+        tail = int(self.table.attrs.tail)
+        count = tail - head if tail >= head else self.size - head + tail
+
+        # Oldest flushed rows may have been already overwritten by pending ones
+        skip = max(0, count + len(pending) - (self.size - 1))
+        first = max(skip, self.search(head, count, start))
+        last = self.search(head, count, end, right=True)
+        parts = []
+
+        if first < last:
+            first = (head + first) % self.size
+            last = (head + last - 1) % self.size + 1
+            if first < last:
+                parts.append(self.table.read(first, last))
+            else:
+                parts.append(self.table.read(first, self.size))
+                parts.append(self.table.read(0, last))
+
+        if pending:
+            rows = np.array(pending[-(self.size - 1):], dtype=self.table.dtype)
+            parts.append(rows[(rows['timestamp'] >= start) & (rows['timestamp'] <= end)])
+
+        if not parts:
+            return np.empty(0, dtype='i8'), np.empty(0, dtype='f8')
+
+        rows = np.concatenate(parts) if len(parts) > 1 else parts[0]
+        return rows['timestamp'].astype('i8'), rows['value'].astype('f8')
+
+    def search(self, head, count, timestamp, right=False):
+        # Binary search over flushed rows in ring order, reading single cells
+        column = self.table.cols.timestamp
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = column[(head + mid) % self.size]
+            if value < timestamp or (right and value == timestamp):
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
     def push(self, timestamp, value):
-        self.table[self.table.attrs.tail] = (timestamp, value)
-        self.table.attrs.tail = (self.table.attrs.tail + 1) % self.size
-        if self.table.attrs.head == self.table.attrs.tail:
-            self.table.attrs.head = (self.table.attrs.head + 1) % self.size
+        self.pending.append((timestamp, value))
+        self.tail = (self.tail + 1) % self.size
+        if self.head == self.tail:
+            self.head = (self.head + 1) % self.size
 
-        self.table.flush()
+    def flush(self):
+        pending, self.pending = self.pending, []
+        if not pending:
+            return 0
+
+        # Older points would be overwritten anyway
+        rows = np.array(pending[-self.size:], dtype=self.table.dtype)
+        start = (self.tail - len(rows)) % self.size
+        end = start + len(rows)
+
+        head = int(self.table.attrs.head)
+        tail = int(self.table.attrs.tail)
+        used = tail - head if tail >= head else self.size - head + tail
+        overwritten = max(0, used + len(rows) - (self.size - 1))
+
+        # Drop rows about to be overwritten from the table first
+        if overwritten >= used:
+            self.table.attrs.head = tail
+        elif overwritten:
+            self.table.attrs.head = self.head
+
+        if end <= self.size:
+            self.table[start:end] = rows
+        else:
+            split = self.size - start
+            self.table[start:] = rows[:split]
+            self.table[:end - self.size] = rows[split:]
+
+        self.table.attrs.head = self.head
+        self.table.attrs.tail = self.tail
+        return len(pending)
+
+    def pop(self):
+        pass
+
+
+class MemmapRingBuffer(object):
+    """
+    Ring buffer stored in a fixed-size file mapped into memory: a small
+    header holding size, head and tail followed by `size` records.
+
+    Pushes write the record and header in place. When the buffer is full,
+    head is advanced before the record is overwritten and tail only after,
+    so the header never covers a partially written record.
+    """
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.pushed = 0
+
+        if not self.valid():
+            self.create()
+
+        self.header = np.memmap(path, dtype=MEMMAP_HEADER_DTYPE, mode='r+', shape=(1,))
+        self.store = np.memmap(path, dtype=MEMMAP_RECORD_DTYPE, mode='r+', offset=MEMMAP_HEADER_SIZE, shape=(size,))
+        self.head = int(self.header['head'][0])
+        self.tail = int(self.header['tail'][0])
+
+    def valid(self):
+        try:
+            header = np.fromfile(self.path, dtype=MEMMAP_HEADER_DTYPE, count=1)
+            length = os.path.getsize(self.path)
+        except (OSError, ValueError):
+            return False
+
+        if len(header) != 1:
+            return False
+
+        header = header[0]
+        return (
+            header['magic'] == MEMMAP_MAGIC
+            and header['version'] == MEMMAP_VERSION
+            and header['size'] == self.size
+            and header['head'] < self.size
+            and header['tail'] < self.size
+            and length == MEMMAP_HEADER_SIZE + self.size * MEMMAP_RECORD_DTYPE.itemsize
+        )
+
+    def create(self):
+        header = np.zeros(1, dtype=MEMMAP_HEADER_DTYPE)
+        header['magic'] = MEMMAP_MAGIC
+        header['version'] = MEMMAP_VERSION
+        header['size'] = self.size
+
+        with open(self.path, 'wb') as f:
+            f.write(header.tobytes().ljust(MEMMAP_HEADER_SIZE, b'\0'))
+            f.truncate(MEMMAP_HEADER_SIZE + self.size * MEMMAP_RECORD_DTYPE.itemsize)
+
+    @property
+    def empty(self):
+        return self.head == self.tail
+
+    @property
+    def used_count(self):
+        if self.empty:
+            return 0
+
+        if self.tail > self.head:
+            return self.tail - self.head - 1
+
+        if self.head > self.tail:
+            return (self.size - self.head) + self.tail - 1
+
+    @property
+    def data(self):
+        if self.empty:
+            return None
+
+        if self.tail > self.head:
+            return np.array(self.store[self.head:self.tail])
+
+        return np.concatenate((self.store[self.head:], self.store[:self.tail]))
+
+    @property
+    def df(self):
+        if self.empty:
+            return None
+
+        data = self.data
+        return pd.DataFrame(
+            index=pd.to_datetime(data['timestamp'], unit='s', utc=True),
+            data=data['value']
+        )
+
+    def between(self, start, end):
+        """
+        Returns (timestamps, values) arrays of points with start <= timestamp <= end.
+        Unless the range wraps around, these are views of the mapped file.
+        """
+        return ring_between(
+            self.store['timestamp'],
+            self.store['value'],
+            self.head, self.tail, self.size,
+            start, end,
+            copy=False
+        )
+
+    def push(self, timestamp, value):
+        tail = (self.tail + 1) % self.size
+        if tail == self.head:
+            self.head = (self.head + 1) % self.size
+            self.header['head'] = self.head
+
+        self.store[self.tail] = (timestamp, value)
+        self.tail = tail
+        self.header['tail'] = self.tail
+        self.pushed += 1
+
+    def push_many(self, timestamps, values):
+        count = len(timestamps)
+        if count == 0:
+            return
+
+        used = self.tail - self.head if self.tail >= self.head else self.size - self.head + self.tail
+        overwritten = max(0, used + count - (self.size - 1))
+        keep = min(count, self.size)
+        index = (self.tail + np.arange(count - keep, count)) % self.size
+        self.tail = (self.tail + count) % self.size
+        self.head = (self.tail - min(used + count, self.size - 1)) % self.size
+
+        # Drop records about to be overwritten from the header first
+        if overwritten >= used:
+            self.header['head'] = self.header['tail']
+        elif overwritten:
+            self.header['head'] = self.head
+
+        self.store['timestamp'][index] = timestamps[-keep:]
+        self.store['value'][index] = values[-keep:]
+        self.header['head'] = self.head
+        self.header['tail'] = self.tail
+        self.pushed += count
+
+    def flush(self):
+        pushed, self.pushed = self.pushed, 0
+        if pushed:
+            self.store.flush()
+            self.header.flush()
+
+        return pushed
+
+    def close(self):
+        self.flush()
+        del self.store
+        del self.header
 
     def pop(self):
         pass
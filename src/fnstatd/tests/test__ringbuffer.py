@@ -0,0 +1,200 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+######################################################################
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from ringbuffer import MemmapRingBuffer, MemoryRingBuffer, ring_between
+
+
+def make_ring(size, points):
+    # Lays out `points` consecutive timestamps starting at 1 the way pushes would
+    timestamps = np.zeros(size, dtype='i8')
+    values = np.zeros(size, dtype='f8')
+    tail = 0
+    head = 0
+    for ts in range(1, points + 1):
+        timestamps[tail] = ts
+        values[tail] = ts * 10
+        tail = (tail + 1) % size
+        if tail == head:
+            head = (head + 1) % size
+
+    return timestamps, values, head, tail
+
+
+class TestRingBetween(unittest.TestCase):
+    def assertRange(self, result, start, end):
+        timestamps, values = result
+        self.assertEqual(timestamps.tolist(), list(range(start, end + 1)))
+        self.assertEqual(values.tolist(), [float(i * 10) for i in range(start, end + 1)])
+
+    def test_empty(self):
+        timestamps, values, head, tail = make_ring(8, 0)
+        result = ring_between(timestamps, values, head, tail, 8, 0, 100)
+        self.assertEqual(len(result[0]), 0)
+        self.assertEqual(len(result[1]), 0)
+
+    def test_contiguous(self):
+        timestamps, values, head, tail = make_ring(8, 5)
+        self.assertRange(ring_between(timestamps, values, head, tail, 8, 0, 100), 1, 5)
+        self.assertRange(ring_between(timestamps, values, head, tail, 8, 2, 4), 2, 4)
+        self.assertRange(ring_between(timestamps, values, head, tail, 8, 6, 100), 1, 0)
+
+    def test_wraparound(self):
+        # 12 points in a ring of 8 leave 7 newest ones, wrapped around the end
+        timestamps, values, head, tail = make_ring(8, 12)
+        self.assertGreater(head, tail)
+        self.assertRange(ring_between(timestamps, values, head, tail, 8, 0, 100), 6, 12)
+        self.assertRange(ring_between(timestamps, values, head, tail, 8, 7, 10), 7, 10)
+        self.assertRange(ring_between(timestamps, values, head, tail, 8, 6, 7), 6, 7)
+        self.assertRange(ring_between(timestamps, values, head, tail, 8, 9, 12), 9, 12)
+        self.assertRange(ring_between(timestamps, values, head, tail, 8, 13, 100), 1, 0)
+
+    def test_copy(self):
+        timestamps, values, head, tail = make_ring(8, 5)
+        ts, vs = ring_between(timestamps, values, head, tail, 8, 2, 4)
+        ts[0] = -1
+        self.assertEqual(timestamps[1], 2)
+
+        ts, vs = ring_between(timestamps, values, head, tail, 8, 2, 4, copy=False)
+        self.assertTrue(np.shares_memory(ts, timestamps))
+        self.assertTrue(np.shares_memory(vs, values))
+
+        # Wrapped results have to be copied anyway
+        timestamps, values, head, tail = make_ring(8, 12)
+        ts, vs = ring_between(timestamps, values, head, tail, 8, 0, 100, copy=False)
+        self.assertFalse(np.shares_memory(ts, timestamps))
+
+
+class TestMemoryRingBuffer(unittest.TestCase):
+    def test_push_many_matches_push(self):
+        for count in (1, 3, 7, 8, 9, 20):
+            for prefill in (0, 2, 7, 13):
+                single = MemoryRingBuffer(8)
+                batch = MemoryRingBuffer(8)
+                for ts in range(prefill):
+                    single.push(ts, ts)
+                    batch.push(ts, ts)
+
+                timestamps = np.arange(prefill, prefill + count, dtype='i8')
+                for ts in timestamps:
+                    single.push(int(ts), float(ts))
+
+                batch.push_many(timestamps, timestamps.astype('f8'))
+                self.assertEqual((batch.head, batch.tail), (single.head, single.tail))
+                self.assertEqual(
+                    batch.between(0, 1000)[0].tolist(),
+                    single.between(0, 1000)[0].tolist()
+                )
+
+
+class TestMemmapRingBuffer(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_push(self):
+        rb = MemmapRingBuffer(self.path('push'), 8)
+        self.assertTrue(rb.empty)
+        for ts in range(1, 13):
+            rb.push(ts, ts * 10)
+
+        self.assertEqual(rb.data['timestamp'].tolist(), list(range(6, 13)))
+        ts, vs = rb.between(8, 11)
+        self.assertEqual(ts.tolist(), [8, 9, 10, 11])
+        self.assertEqual(vs.tolist(), [80.0, 90.0, 100.0, 110.0])
+        rb.close()
+
+    def test_push_many_matches_push(self):
+        for count in (1, 3, 7, 8, 9, 20):
+            for prefill in (0, 2, 7, 13):
+                name = '{0}-{1}'.format(count, prefill)
+                single = MemmapRingBuffer(self.path(name + '-single'), 8)
+                batch = MemmapRingBuffer(self.path(name + '-batch'), 8)
+                for ts in range(prefill):
+                    single.push(ts, ts)
+                    batch.push(ts, ts)
+
+                timestamps = np.arange(prefill, prefill + count, dtype='i8')
+                for ts in timestamps:
+                    single.push(int(ts), float(ts))
+
+                batch.push_many(timestamps, timestamps.astype('f8'))
+                self.assertEqual((batch.head, batch.tail), (single.head, single.tail))
+                self.assertEqual(int(batch.header['head'][0]), batch.head)
+                self.assertEqual(int(batch.header['tail'][0]), batch.tail)
+                self.assertEqual(batch.data.tolist(), single.data.tolist())
+                self.assertEqual(batch.flush(), prefill + count)
+                single.close()
+                batch.close()
+
+    def test_reopen(self):
+        rb = MemmapRingBuffer(self.path('reopen'), 8)
+        rb.push_many(np.arange(1, 11, dtype='i8'), np.arange(1, 11, dtype='f8'))
+        rb.close()
+
+        rb = MemmapRingBuffer(self.path('reopen'), 8)
+        self.assertEqual(rb.data['timestamp'].tolist(), list(range(4, 11)))
+        rb.push(11, 11)
+        self.assertEqual(rb.between(9, 100)[0].tolist(), [9, 10, 11])
+        rb.close()
+
+    def test_recreate_on_size_change(self):
+        rb = MemmapRingBuffer(self.path('resize'), 8)
+        rb.push(1, 1)
+        rb.close()
+
+        rb = MemmapRingBuffer(self.path('resize'), 16)
+        self.assertTrue(rb.empty)
+        self.assertEqual(os.path.getsize(self.path('resize')), 64 + 16 * 16)
+        rb.close()
+
+    def test_recreate_on_corrupted_header(self):
+        with open(self.path('corrupted'), 'wb') as f:
+            f.write(b'garbage')
+
+        rb = MemmapRingBuffer(self.path('corrupted'), 8)
+        self.assertTrue(rb.empty)
+        rb.push(1, 1)
+        self.assertEqual(rb.data['timestamp'].tolist(), [1])
+        rb.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -51,6 +51,8 @@ from freenas.utils.debug import DebugService
 
 
 FLUSH_INTERVAL = 180
+FLUSH_BATCH_SIZE = 1000
+STORE_MAXLEN = 100000
 RCVBUF_MINSIZE = 80 * 1024  # same as in syslogd
 SYSLOG_PATTERN = re.compile(r'<(?P<priority>\d+)>(?P<syslog_timestamp>\w+\s+\d+\s+\d+:\d+:\d+) (?P<identifier>[\w\[\]]+): (?P<message>.*)')
 KLOG_PATTERN = re.compile(r'<(?P<priority>\d+)>(?P<message>.*)')
@@ -88,6 +90,9 @@ class LoggingService(RpcService):
             self.context.flush = bool(enable)
             self.context.cv.notify_all()
 
+    def get_stats(self):
+        return self.context.get_stats()
+
     def push(self, entry):
         creds = get_sender().credentials
         if creds:
@@ -114,12 +119,15 @@ class LoggingService(RpcService):
 
     @generator
     def query(self, filter=None, params=None):
+        # Entries being flushed may show up in the datastore before they leave memory
+        memory = list(self.context.flushing) + list(self.context.store)
+        ids = {i['id'] for i in memory}
         ds_results = self.context.datastore.query_stream('syslog', *(filter or []), **(params or {})) \
             if self.context.datastore \
             else []
 
         return q.query(
-            itertools.chain(ds_results, self.context.store),
+            itertools.chain((i for i in ds_results if i['id'] not in ids), memory),
             *(filter or []),
             stream=True,
             **(params or {})
@@ -232,6 +240,7 @@ class SyslogForwarder(object):
 class Context(object):
     def __init__(self):
         self.store = collections.deque()
+        self.flushing = collections.deque()
         self.lock = threading.Lock()
         self.seqno = 0
         self.rpc_server = Server(self)
@@ -250,10 +259,19 @@ class Context(object):
         self.rpc.register_service_instance('logd.logging', LoggingService(self))
         self.rpc.register_service_instance('logd.debug', DebugService())
         self.cv = threading.Condition()
+        self.stats = {
+            'flushes': 0,
+            'flush_errors': 0,
+            'flushed': 0,
+            'dropped': 0,
+            'last_flush_latency': None,
+            'max_flush_latency': None,
+            'last_flush_at': None
+        }
 
     def init_configstore(self):
         ds = datastore.get_datastore()
-        self.configstore = datastore.config.ConfigStore(ds)
+        self.configstore = datastore.config.ConfigStore(ds, cache=True)
 
     def init_datastore(self):
         try:
@@ -331,6 +349,10 @@ class Context(object):
                 pass
 
         with self.lock:
+            if len(self.store) >= STORE_MAXLEN:
+                self.store.popleft()
+                self.stats['dropped'] += 1
+
             priority, facility = parse_priority(item['priority'])
             item.update({
                 'id': str(uuid.uuid4()),
@@ -377,15 +399,68 @@ class Context(object):
                         logging.warning('Flush skipped')
                         continue
 
-                logging.debug('Attempting to flush logs')
-                with self.lock:
-                    for i in self.store:
-                        self.datastore.insert('syslog', i)
+                exiting = self.exiting
+
+            self.flush_store()
+            if exiting:
+                return
+
+    def flush_store(self):
+        logging.debug('Attempting to flush logs')
+        started_at = time.monotonic()
 
-                    self.store.clear()
+        # Producers only wait for the swap, writes happen off the lock
+        with self.lock:
+            items, self.store = self.store, collections.deque()
+            self.flushing = items
 
-                if self.exiting:
-                    return
+        try:
+            while items:
+                # Stays in flushing, and visible to queries, until it's stored
+                batch = list(itertools.islice(items, FLUSH_BATCH_SIZE))
+                try:
+                    self.datastore.insert_many('syslog', batch)
+                except datastore.DuplicateKeyException:
+                    # Part of the batch got stored by an earlier failed flush
+                    for i in batch:
+                        try:
+                            self.datastore.insert('syslog', i)
+                        except datastore.DuplicateKeyException:
+                            pass
+
+                for _ in batch:
+                    items.popleft()
+
+                self.stats['flushed'] += len(batch)
+        except Exception as err:
+            logging.warning('Cannot flush logs: {0}'.format(err))
+            self.stats['flush_errors'] += 1
+            with self.lock:
+                # Put unflushed items back in front of the ones which arrived meanwhile
+                self.flushing = collections.deque()
+                items.extend(self.store)
+                overflow = len(items) - STORE_MAXLEN
+                for _ in range(max(0, overflow)):
+                    items.popleft()
+                    self.stats['dropped'] += 1
+
+                self.store = items
+            return
+        finally:
+            latency = time.monotonic() - started_at
+            self.stats['last_flush_latency'] = latency
+            self.stats['max_flush_latency'] = max(latency, self.stats['max_flush_latency'] or 0)
+
+        self.flushing = collections.deque()
+        self.stats['flushes'] += 1
+        self.stats['last_flush_at'] = datetime.utcnow()
+
+    def get_stats(self):
+        return dict(
+            self.stats,
+            queue_depth=len(self.store),
+            flushing=len(self.flushing)
+        )
 
     def sigusr1(self, signo, frame):
         with self.cv:
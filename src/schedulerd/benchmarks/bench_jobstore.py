@@ -0,0 +1,133 @@
+#!/usr/local/bin/python3
+#+
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+#
+# Measures the cost of a scheduler wakeup (collecting due jobs, rescheduling
+# them and computing the next wakeup time) with a few thousand cron jobs
+# loaded into FreeNASJobStore. Uses an in-memory stand-in for the datastore
+# so only the job store itself is measured.
+#
+
+import os
+import sys
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+import pytz
+from apscheduler.util import datetime_to_utc_timestamp
+
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from store import FreeNASJobStore
+
+
+class MemoryDatastore(object):
+    def __init__(self, documents):
+        self.documents = {d['id']: d for d in documents}
+        self.writes = 0
+
+    def query(self, collection, *filter, **params):
+        return [dict(d) for d in self.documents.values()]
+
+    def upsert_many(self, collection, items, config=False):
+        self.writes += 1
+        self.documents.update(items)
+
+    def delete_many(self, collection, pkeys):
+        self.writes += 1
+        for i in pkeys:
+            self.documents.pop(i, None)
+
+    def close(self):
+        pass
+
+
+class Scheduler(object):
+    timezone = pytz.utc
+
+
+def job(*args, **kwargs):
+    pass
+
+
+def generate(count, now):
+    for i in range(count):
+        yield {
+            'id': 'job{0}'.format(i),
+            'name': 'job{0}'.format(i),
+            'next_run_time': datetime_to_utc_timestamp(now + timedelta(seconds=random.randint(1, 86400))),
+            'task': 'test.sleep',
+            'args': [],
+            'enabled': True,
+            'hidden': False,
+            'protected': False,
+            'schedule': {'minute': str(i % 60), 'hour': '*'}
+        }
+
+
+def run(count, wakeups):
+    now = datetime.now(pytz.utc)
+    ds = MemoryDatastore(generate(count, now))
+    store = FreeNASJobStore(ds)
+
+    start = time.monotonic()
+    store.start(Scheduler(), 'default')
+    load_time = time.monotonic() - start
+
+    fired = 0
+    start = time.monotonic()
+    for i in range(wakeups):
+        due = store.get_due_jobs(now)
+        for j in due:
+            j.next_run_time = j.trigger.get_next_fire_time(j.next_run_time, now)
+            store.update_job(j)
+
+        fired += len(due)
+        now = store.get_next_run_time()
+
+    wakeup_time = time.monotonic() - start
+    store.shutdown()
+
+    print('{0} jobs: load {1:.3f}s, {2} wakeups in {3:.3f}s ({4:.1f}us/wakeup), {5} jobs fired, {6} datastore writes'.format(
+        count, load_time, wakeups, wakeup_time, wakeup_time / wakeups * 1000000, fired, ds.writes
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', metavar='COUNT', type=int, nargs='+', default=[1000, 10000], help='Number of jobs')
+    parser.add_argument('-w', metavar='WAKEUPS', type=int, default=10000, help='Number of scheduler wakeups')
+    args = parser.parse_args()
+
+    for count in args.n:
+        run(count, args.w)
+
+
+if __name__ == '__main__':
+    main()
@@ -26,64 +26,201 @@
 #####################################################################
 
 import time
+import heapq
+import itertools
+import threading
+from collections import OrderedDict
 from apscheduler.jobstores.base import BaseJobStore, JobLookupError, ConflictingIdError
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.util import datetime_to_utc_timestamp, utc_timestamp_to_datetime
 from apscheduler.job import Job
-from datastore import get_datastore, DuplicateKeyException, DatastoreException
+from datastore import get_datastore, DatastoreException
+
+
+FLUSH_INTERVAL = 1
 
 
 class FreeNASJobStore(BaseJobStore):
-    def __init__(self):
-        self.ds = get_datastore()
+    """
+    Job store backed by the calendar_tasks collection.
+
+    Jobs are loaded once on start and then served from memory: a dict indexed
+    by job id plus a heap of (next_run_time, seq, job id) entries for scheduled
+    jobs. Heap entries are invalidated lazily, i.e. an entry is only valid if
+    its timestamp still matches the one stored for the job. Changes are
+    written back to the datastore in batches by a flush thread.
+
+    Jobs are stored and handed out as copies, the scheduler modifies jobs it
+    gets from the store before passing them to update_job().
+    """
+    def __init__(self, ds=None):
+        self.ds = ds or get_datastore()
         self._scheduler = None
         self._jobstore_alias = None
+        self.lock = threading.RLock()
+        self.jobs = {}
+        self.heap = []
+        self.seq = itertools.count()
+        self.pending = OrderedDict()
+        self.flush_event = threading.Event()
+        self.flush_thread = None
+        self.running = False
 
     def start(self, scheduler, alias):
         self._scheduler = scheduler
         self._jobstore_alias = alias
+        self.load()
+        self.running = True
+        self.flush_thread = threading.Thread(target=self.flush_worker, daemon=True, name='FreeNASJobStore flush')
+        self.flush_thread.start()
 
     @property
     def connection(self):
         return self.ds
 
+    def load(self):
+        failed_job_ids = []
+        with self.lock:
+            self.jobs.clear()
+            self.heap = []
+            for document in self.ds.query('calendar_tasks'):
+                try:
+                    self._put(self._reconstitute_job(document))
+                except:
+                    self._logger.exception('Unable to restore job "%s" -- removing it', document['id'])
+                    failed_job_ids.append(document['id'])
+
+        # Remove all the jobs we failed to restore
+        if failed_job_ids:
+            self.ds.delete_many('calendar_tasks', failed_job_ids)
+
+    def _put(self, job):
+        timestamp = datetime_to_utc_timestamp(job.next_run_time)
+        self.jobs[job.id] = (job, timestamp)
+        if timestamp is not None:
+            heapq.heappush(self.heap, (timestamp, next(self.seq), job.id))
+
+        # Rebuild the heap once stale entries start to dominate it
+        if len(self.heap) > 2 * len(self.jobs) + 64:
+            self.heap = [e for e in self.heap if self._valid(e)]
+            heapq.heapify(self.heap)
+
+    def _valid(self, entry):
+        timestamp, _, job_id = entry
+        current = self.jobs.get(job_id)
+        return current is not None and current[1] == timestamp
+
+    def _clean_top(self):
+        while self.heap and not self._valid(self.heap[0]):
+            heapq.heappop(self.heap)
+
+    def _schedule_write(self, job_id, document):
+        self.pending[job_id] = document
+        self.flush_event.set()
+
+    def _copy(self, job):
+        clone = Job.__new__(Job)
+        clone.__setstate__(job.__getstate__())
+        clone._scheduler = self._scheduler
+        clone._jobstore_alias = self._jobstore_alias
+        return clone
+
     def lookup_job(self, job_id):
-        document = self.ds.get_by_id('calendar_tasks', job_id)
-        return self._reconstitute_job(document) if document else None
+        with self.lock:
+            entry = self.jobs.get(job_id)
+            return self._copy(entry[0]) if entry else None
 
     def get_due_jobs(self, now):
         timestamp = datetime_to_utc_timestamp(now)
-        return self._get_jobs(('next_run_time', '<=', timestamp))
+        with self.lock:
+            due = []
+            self._clean_top()
+            while self.heap and self.heap[0][0] <= timestamp:
+                entry = heapq.heappop(self.heap)
+                if self._valid(entry):
+                    due.append(entry)
+
+            for entry in due:
+                heapq.heappush(self.heap, entry)
+
+            return [self._copy(self.jobs[job_id][0]) for _, _, job_id in due]
 
     def get_next_run_time(self):
-        document = self.ds.query('calendar_tasks', ('next_run_time', '!=', None), sort='next_run_time', single=True)
-        return utc_timestamp_to_datetime(document['next_run_time']) if document else None
+        with self.lock:
+            self._clean_top()
+            return utc_timestamp_to_datetime(self.heap[0][0]) if self.heap else None
 
     def get_all_jobs(self):
-        jobs = self._get_jobs()
-        self._fix_paused_jobs_sorting(jobs)
-        return jobs
+        with self.lock:
+            jobs = sorted(
+                self.jobs.values(),
+                key=lambda j: (j[1] is None, j[1] or 0)
+            )
+
+            return [self._copy(job) for job, _ in jobs]
 
     def add_job(self, job):
-        try:
-            self.ds.insert('calendar_tasks', self._serialize_job(job))
-        except DuplicateKeyException:
-            raise ConflictingIdError(job.id)
+        with self.lock:
+            if job.id in self.jobs:
+                raise ConflictingIdError(job.id)
+
+            self._put(self._copy(job))
+            self._schedule_write(job.id, self._serialize_job(job))
 
     def update_job(self, job):
-        self.ds.update('calendar_tasks', job.id, self._serialize_job(job))
+        with self.lock:
+            if job.id not in self.jobs:
+                raise JobLookupError(job.id)
+
+            self._put(self._copy(job))
+            self._schedule_write(job.id, self._serialize_job(job))
 
     def remove_job(self, job_id):
+        with self.lock:
+            if self.jobs.pop(job_id, None) is None:
+                raise JobLookupError(job_id)
+
+            self._schedule_write(job_id, None)
+
+    def remove_all_jobs(self):
+        with self.lock:
+            for job_id in self.jobs:
+                self._schedule_write(job_id, None)
+
+            self.jobs.clear()
+            self.heap = []
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = OrderedDict()
+
+        deleted = [job_id for job_id, document in pending.items() if document is None]
+        updated = [(job_id, document) for job_id, document in pending.items() if document is not None]
+
         try:
-            self.ds.delete('calendar_tasks', job_id)
+            if deleted:
+                self.ds.delete_many('calendar_tasks', deleted)
+
+            if updated:
+                self.ds.upsert_many('calendar_tasks', updated)
         except DatastoreException:
-            raise JobLookupError(job_id)
+            self._logger.exception('Cannot save jobs, will retry')
+            with self.lock:
+                for job_id, document in pending.items():
+                    self.pending.setdefault(job_id, document)
 
-    def remove_all_jobs(self):
-        for i in self.get_all_jobs():
-            self.ds.delete('calendar_tasks', i.id)
+    def flush_worker(self):
+        while self.running:
+            self.flush_event.wait()
+            self.flush_event.clear()
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
 
     def shutdown(self):
+        self.running = False
+        self.flush_event.set()
+        self.flush()
         self.ds.close()
 
     def _serialize_job(self, job):
@@ -134,21 +271,5 @@ class FreeNASJobStore(BaseJobStore):
         job._jobstore_alias = self._alias
         return job
 
-    def _get_jobs(self, *conditions):
-        jobs = []
-        failed_job_ids = []
-        for document in self.ds.query('calendar_tasks', *conditions, sort='next_run_time'):
-            try:
-                jobs.append(self._reconstitute_job(document))
-            except:
-                self._logger.exception('Unable to restore job "%s" -- removing it', document['id'])
-                failed_job_ids.append(document['id'])
-
-        # Remove all the jobs we failed to restore
-        for i in failed_job_ids:
-            self.ds.delete('calendar_tasks', i)
-
-        return jobs
-
     def __repr__(self):
         return '<%s (client=%s)>' % (self.__class__.__name__, self.client)